@@ -1,6 +1,6 @@
 from Trellis3D import Trellis3D
 #from Trellis import Trellis
-from channel import channel
+from channel import channel, alignment, INSERT, DELETE
 import multiprocessing
 import pandas as pd
 import numpy as np
@@ -18,41 +18,19 @@ def run(n,PI,PD,PS,return_list):
     transmitted,recieved = C.generate_bigram_input_output(n,PI=PI,PD=PD,PS=PS)
     changes = C.changes
     likelihoods = T3D.forward_backward(transmitted,recieved,PI=PI,PD=PD,PS=PS)
-    predictions = []
 
-    i,j = 0,0
+    #Every transmitted symbol is scored against the recieved symbol it is aligned with (the next one after a deletion)
+    i,j = alignment(changes)
+    scored = (changes != INSERT) & (j < len(recieved))
 
-    for change in changes:
+    basis = list(likelihoods[0])
+    p = np.array([[likelihoods[index][symbol] for symbol in basis] for index in range(len(transmitted))])
+    symbol_hat = np.array(basis)[p.argmax(axis=1)] # First most likely symbol, like max(p,key = lambda x: p[x])
+    predictions = symbol_hat[i[scored]] == np.array(recieved)[j[scored]]
 
-        if change == 'insert':
-            j+=1
-            
-        elif change == 'transmit' or change == 'substitute':
-
-            p = likelihoods[i]
-            symbol = recieved[j]
-            symbol_hat = max(p,key = lambda x: p[x])
-            #print(f'likeilihood distribution {p} and estimated symbol {symbol_hat}')
-            predictions.append(symbol_hat==symbol)
-            i+=1
-            j+=1
-            pass
-        elif change == 'delete':
-            p = likelihoods[i]
-            if j == len(recieved) : continue
-            symbol = recieved[j]
-            symbol_hat = max(p,key = lambda x: p[x])
-            #print(f'likeilihood distribution {p} and estimated symbol {symbol_hat}')
-            predictions.append(symbol_hat==symbol)
-
-            i+=1
-            #For now pass but later implement changes for deletion
-            pass
-
-
-    deletions = changes.count('delete') *100.0/ len(predictions)
-
-    errors = predictions.count(False) *100.0/ len(predictions)
+    deletions = (changes == DELETE).sum() *100.0/ len(predictions)
+
+    errors = (~predictions).sum() *100.0/ len(predictions)
 
     return_list.append(errors)
 
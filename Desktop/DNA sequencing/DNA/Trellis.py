@@ -1,4 +1,34 @@
 from pyvis import network as net
+import numpy as np
+from functools import lru_cache
+
+
+@lru_cache(maxsize=32)
+def triangular(a,n):
+    '''(n,n) lower triangular matrix of a**(row - column), cached as every row of a lattice needs the same ones'''
+    powers = np.subtract.outer(np.arange(n),np.arange(n))
+    return np.where(powers >= 0,float(a)**np.maximum(powers,0),0.0)
+
+
+def linear_runs(a,c,block=None):
+    '''x[k] = a*x[k-1] + c[k] along the last axis, exactly
+
+    c is cut in blocks (~sqrt(n) by default) solved together by one triangular matrix, the ends of
+    the blocks are then carried into the following blocks by a second one, so there is no Python loop over k.
+    The same runs as linear_runs in final_decoder/trellis_stream.py, which this folder does not import'''
+    n = c.shape[-1]
+    block = block or max(1,int(np.ceil(np.sqrt(n))))
+    blocks = -(-n//block)
+
+    padded = np.zeros(c.shape[:-1] + (blocks*block,))
+    padded[...,:n] = c
+    x = padded.reshape(c.shape[:-1] + (blocks,block)) @ triangular(a,block).T
+
+    #Block b starts from every earlier block end decayed by a**block
+    ends = x[...,-1] @ triangular(float(a)**block,blocks).T
+    x[...,1:,:] += float(a)**np.arange(1,block+1) * ends[...,:-1,None]
+
+    return x.reshape(c.shape[:-1] + (blocks*block,))[...,:n]
 
 
 class Trellis:
@@ -15,12 +45,17 @@ class Trellis:
         self.values = {} # Alpha Gamma Beta for each edge    ( str node1, str node2 ) : value
         self.probabilities = {} # Index of transmitted calculates all the diagonal values to get the P(s) and P(t)
         self.transitions = {} # Normalises the probabilities  0,1,2,3.. : (p(transmission),p(subsititution)) normalises the probabilities
+        self.scales = None # Sum of each row of alphas of the array engine, the betas are divided by the same scales
 
 
     def reinitialise(self):
         self.__init__()
 
-    def forward_backward(self,transmitted,recieved,Pi=0.1,Pd=0.1,Ps=0.2):
+    def forward_backward(self,transmitted,recieved,Pi=0.1,Pd=0.1,Ps=0.2,engine='dict'):
+        '''engine = 'dict' builds the string node graph, engine = 'array' runs the rows of the lattice on NumPy arrays'''
+        if engine == 'array': return self.array_forward_backward(transmitted,recieved,Pi,Pd,Ps)
+        elif engine != 'dict': raise ValueError(f'Unknown Trellis engine {engine}')
+
         self.__init__()
 
         for j in range(len(recieved)+1):
@@ -132,6 +167,55 @@ class Trellis:
 
         return self.transitions
 
+    def array_forward_backward(self,transmitted,recieved,Pi=0.1,Pd=0.1,Ps=0.2):
+        '''Same transitions as forward_backward as an (N,2) array of (p(transmission),p(substitution)) for each transmitted index
+
+        self.alphas and self.betas are (M+1,N+1) arrays, row j holds the nodes (0,j) ... (N,j). Each row of
+        alphas is divided by its sum self.scales[j] and the betas by the same scales, so n = 1000 does not underflow.
+        Diagonal edges are transmissions where transmitted[i] == recieved[j] (the match mask) and substitutions elsewhere'''
+        self.__init__()
+
+        N,M = len(transmitted),len(recieved)
+        Pt = round(1 - Pi - Pd - Ps,1)
+
+        match = np.array(list(transmitted))[:,None] == np.array(list(recieved))[None,:] # (N,M)
+        gammas = np.where(match,Pt,Ps) # Diagonal edge (i,j) --> (i+1,j+1)
+
+        alphas = np.zeros((M+1,N+1))
+        betas = np.zeros((M+1,N+1))
+        scales = np.zeros(M+1)
+
+        #Forwards, insertion (i,j-1) --> (i,j), transmission/substitution (i-1,j-1) --> (i,j), deletion runs (i-1,j) --> (i,j) along the row
+        entering = np.zeros(N+1)
+        entering[0] = 1.0
+        for j in range(M+1):
+            if j:
+                entering = Pi*alphas[j-1]
+                entering[1:] += gammas[:,j-1]*alphas[j-1,:-1]
+            row = linear_runs(Pd,entering)
+            scales[j] = row.sum()
+            alphas[j] = row / scales[j]
+
+        #Backwards, the same edges leaving each node, deletion runs (i,j) --> (i+1,j) back along the row
+        leaving = np.zeros(N+1)
+        leaving[N] = 1.0
+        for j in range(M,-1,-1):
+            if j < M:
+                leaving = Pi*betas[j+1]
+                leaving[:-1] += gammas[:,j]*betas[j+1,1:]
+                leaving /= scales[j+1]
+            betas[j] = linear_runs(Pd,leaving[::-1])[::-1]
+
+        #Diagonal edges alpha * gamma * beta, the 1/scales[j+1] puts every row on the same scale
+        values = alphas[:-1,:-1].T * gammas * betas[1:,1:].T / scales[1:]
+        t = np.where(match,values,0.0).sum(axis=1)
+        s = np.where(match,0.0,values).sum(axis=1)
+
+        self.alphas,self.betas,self.scales = alphas,betas,scales
+        self.transitions = np.stack([t/(s+t),s/(s+t)],axis=1)
+
+        return self.transitions
+
     def draw_trellis(self,transmitted,recieved,name = 'my_net.html',directed =True,Pi=0.1,Pd=0.1,Ps=0.2):
         self.forward_backward(transmitted,recieved,Pi=0.1,Pd=0.1,Ps=0.2)
 
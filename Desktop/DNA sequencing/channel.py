@@ -1,11 +1,46 @@
 import random
+import numpy as np
+
+
+OPTIONS = ['transmit','substitute','insert','delete'] # Codes of the change logs
+TRANSMIT,SUBSTITUTE,INSERT,DELETE = range(4)
+CODES = {option:q for q,option in enumerate(OPTIONS)}
+
+
+def alignment(changes):
+    '''(transmitted index, recieved index) of every event of a change log
+
+    A transmission or substitution is at the pair of symbols it links, a deletion at its transmitted
+    symbol and the recieved symbol after it, an insertion at its recieved symbol and the transmitted
+    symbol after it'''
+    changes = np.asarray(changes)
+    consuming = changes != INSERT
+    emitting = changes != DELETE
+    return np.cumsum(consuming) - consuming, np.cumsum(emitting) - emitting
+
+
+def recieved_index(changes):
+    '''Index in the output of every transmitted symbol, -1 where it was deleted'''
+    changes = np.asarray(changes)
+    i,j = alignment(changes)
+    consumed = changes[changes != INSERT]
+    return np.where(consumed == DELETE,-1,j[changes != INSERT])
+
+
+def transmitted_index(changes):
+    '''Index in the input of every recieved symbol, -1 where it was inserted'''
+    changes = np.asarray(changes)
+    i,j = alignment(changes)
+    emitted = changes[changes != DELETE]
+    return np.where(emitted == INSERT,-1,i[changes != DELETE])
+
 
 class channel:
 
     def __init__(self):
         self.input = None
         self.output = None
-        self.changes = []
+        self.changes = np.zeros(0,dtype=np.uint8) # OPTIONS code of every event of the last call, 1 byte each
     
 
     def generate_sequence(self,n=10,bits = False):
@@ -22,10 +57,11 @@ class channel:
         options = ['transmit','substitute','insert','delete']
         weights = [Pt,Ps,Pi,Pd]
         output =[]
+        changes = bytearray() # OPTIONS codes of the events of this call
         while i <n:
             choice = random.choices(options,weights=weights)[0]
             #print(i,choice)
-            self.changes.append(choice)
+            changes.append(CODES[choice])
             
 
             if choice == 'transmit':
@@ -40,6 +76,7 @@ class channel:
             elif choice == 'delete':
                 pass
             i+=1
+        self.changes = np.frombuffer(changes,dtype=np.uint8) # Events of this call only
         self.output = output
         return 
     
@@ -52,6 +89,7 @@ class channel:
         output =[]
         choice = None
 
+        changes = bytearray() # OPTIONS codes of the events of this call
         while i <n:
             Pi,Pd,Ps = probability_distribution
             Pt = round(1 - Pi - Pd - Ps,1)
@@ -59,7 +97,7 @@ class channel:
             #print(f'Probability distribution {choice} {probability_distribution}')
 
             choice = random.choices(options,weights=weights)[0]
-            self.changes.append(choice)
+            changes.append(CODES[choice])
             
 
             if choice == 'transmit':
@@ -79,6 +117,7 @@ class channel:
         
             i+=1
 
+        self.changes = np.frombuffer(changes,dtype=np.uint8) # Events of this call only
         self.output = output
         return 
 
@@ -1,5 +1,5 @@
 from Trellis import Trellis
-from channel import channel
+from channel import channel, INSERT, TRANSMIT
 import numpy as np
 import pandas as pd
 import time
@@ -90,30 +90,13 @@ def run():
 
             t,r = c.generate_input_output(n,Pi=Pi,Pd=Pd,Ps=Ps)
             changes = c.changes
-            guesses = T.forward_backward(t,r,Pi=Pi,Pd=Pd,Ps=Ps)
+            guesses = T.forward_backward(t,r,Pi=Pi,Pd=Pd,Ps=Ps,engine='array')
 
+            #Change of every transmitted symbol, only the transmitted ones are scored (substitutions never were)
+            consumed = changes[changes != INSERT]
+            results = guesses[consumed == TRANSMIT,0] > 0.5
 
-            i = 0
-
-            results = []
-
-
-            for change in changes:
-                if change == 'insert': continue
-
-                elif change == 'delete':
-                    i+=1
-                    continue
-
-                elif change == 'transmit':
-                    results.append(guesses[i][0] > 0.5)
-
-                elif change == 'transmit': 
-                    results.append(guesses[i][1] > 0.5)
-
-                i+=1
-
-            count = results.count(False) *100.0/ len(results)
+            count = (~results).sum() *100.0/ len(results)
             percentage.append(count)
             print(counter, round(counter *100.0/ (points*3*repeats),2),' percent')
             counter +=1
@@ -2,21 +2,31 @@ import random
 import matplotlib.pyplot as plt
 import numpy as np
 import sys
+import multiprocessing
+import contextlib
 from progress_bar import progress_bar
 import time
 from channel import channel
 from sparsifier import Sparsifier
+import sequences
+import trellis_arrays
+import trellis_budget
+import trellis_skeleton
+import trellis_stats
+import trellis_stream
+import trellis_window
 
 
 class Trellis3D:
 
 
-    def __init__(self,sparse_distribution,bits=False) :
+    def __init__(self,sparse_distribution,bits=False,debug=False,threads=None,tile=8192,budget=None,policy=None) :
         self.nodes = [] # List of nodes as their str values, '(i,j,d)'
         self.tuples = {} #Converts from string node to tuple key = string : value = tuple
         self.my_graph = {} # Node and its neighbouring nodes that it leads to  node --> [neighbour]
         self.reverse_graph = {} # Node and its incoming nodes  node <-- [neighbour]
         self.edges = {} # Edge ( str node1, str node2 ) : Gamma value  , gamma is Pi,Pd,Ps
+        self.skeleton = None # trellis_skeleton.Skeleton shared by every trellis of the same lengths
 
 
         self.basis = ['A','C','T','G']
@@ -33,314 +43,524 @@ class Trellis3D:
         self.alphas = {} #Alphas for each node                 str node : alpha 
         self.betas = {} # Betas for each node                  str node : beta
 
-        self.values = {} # Alpha * Gamma * Beta for each edge    ( str node1, str node2 ) : value
+        self.values = {} # Alpha * Gamma * Beta for each edge    ( str node1, str node2 ) : value, only with debug
+        self.debug = debug
         self.probabilities = {} # Unnormalised probabilities for each transmitted index {0: {A:pA ... T:pT }, 1 :{} , .... }
         self.likelihoods = {} #Index of each transmitted with normalised probabilities
+        self.lattice = None # trellis_arrays.Lattice layout of the alphas and betas planes for the array engine
+        self.band_loss = 0.0 # Fraction of P(recieved | watermark) carried by the paths that leave the max_drift band
+        self.scales = None # Scaling factor of each anti-diagonal of the array engine alphas and betas
+        self.log_likelihood = None # log P(recieved | watermark)
+        self.read_likelihoods = None # (R,N,4) likelihoods of each read for multi_read_forward_backward
+        self.wavefront = trellis_arrays.Wavefront(threads,tile) if threads else None # Threads of the array engine anti-diagonals
+        self.pruned_mass = None # Fraction of P(recieved | watermark) carried by the paths beam pruning dropped
+        self.beam_fallback = False # True when beam pruning dropped too much mass and the exact recursions were used
+        self.stream = None # trellis_stream.Stream of the read being extended by extend_read
+        self.stats = None # trellis_stats.TrellisStats of the last decode, phase timings and sizes
+        self.budget = budget # Bytes a decode may use with engine = 'auto', None for no limit
+        self.policy = policy or trellis_budget.choose # policy(N,M,budget,max_drift) --> trellis_budget.Estimate of the mode to run
+        self.mode = None # trellis_budget.Estimate picked by the policy for the last engine = 'auto' decode
+        self.fit_history = None # (log likelihood, PI, PD, PS) of every baum_welch iteration
         #sys.setrecursionlimit(5_000)
 
         self.q_mapping  = {0:'A', 1:'C', 2:'G', 3:'T'}
         self.base_mapping = {'A':0, 'C':1, 'G':2, 'T':3}
         self.sparse_distribution = sparse_distribution
-        
+        self.table = trellis_arrays.substitution_table(sparse_distribution) # (n,4) array of the sparse distribution, shared by every read
 
+    def close(self):
+        '''Shuts down the threads of the wavefront, the Trellis3D can still decode without them'''
+        if self.wavefront: self.wavefront.close()
+        self.wavefront = None
 
-    def forward_backward(self,watermark,recieved,PI,PD,PS):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exception):
+        self.close()
+
+
+    def forward_backward(self,watermark,recieved,PI,PD,PS,engine='dict',max_drift=None,checkpoint=None,beam=None,tolerance=1e-4,priors=None):
+        '''engine = 'dict' builds the string node graph, engine = 'array' uses the NumPy planes of trellis_arrays
+        max_drift only keeps the nodes with |j - i| <= max_drift (array engine)
+        checkpoint only keeps every checkpoint-th anti-diagonal of alphas, True for ~sqrt(N+M) (array engine)
+        beam prunes the nodes below beam times the largest alpha of their anti-diagonal (array engine)
+        priors is an (N,4) array of sparse symbol priors for each index replacing the sparse distribution (array engine)
+        engine = 'auto' lets self.policy pick the array engine mode that fits in self.budget'''
+
+        if engine == 'auto': return self.auto_forward_backward(watermark,recieved,PI,PD,PS,max_drift,priors)
+        if engine == 'array': return self.array_forward_backward(watermark,recieved,PI,PD,PS,max_drift,checkpoint,beam,tolerance,priors)
+        elif engine != 'dict': raise ValueError(f'Unknown Trellis engine {engine}')
+        if max_drift is not None: raise ValueError('max_drift needs the array engine')
+        if checkpoint is not None: raise ValueError('checkpoint needs the array engine')
+        if beam is not None: raise ValueError('beam needs the array engine')
+        if priors is not None: raise ValueError('priors needs the array engine')
 
-        startup = time.time()
-        
         #Initialise probability distributions
         self.PI = PI
         self.PD = PD
         self.PS = PS
         
-        depth = [0,-2,2]  # T , I , D  -- Trellis 3rd dimension
+        self.edges = {}
+        self.alphas = {}
+        self.betas = {}
+        self.values = {}
+        self.likelihoods = {}
 
-        start = time.time()
+        stats = self.stats = trellis_stats.TrellisStats('dict',len(watermark),len(recieved))
 
+        with stats.phase('nodes'):
+            #Nodes, neighbours and traversal order only depend on the lengths and are shared between decodes
+            skeleton = trellis_skeleton.cache.get(len(watermark),len(recieved))
 
-        #Initialise all the nodes
-        for j in range(len(recieved)+1):
-            for i in range(len(watermark)+1):
-                for d in depth:
-                    if d == -2 and j == 0: continue
-                    if d == 2 and i == 0: continue
+            self.nodes = skeleton.nodes
+            self.tuples = skeleton.tuples
+            self.my_graph = skeleton.my_graph
+            self.reverse_graph = skeleton.reverse_graph
+            self.toor = skeleton.toor
+            self.toor_name = skeleton.toor_name
+            self.skeleton = skeleton
 
-                    if d == 0 and ((j==0 and i!=0) or (i==0 and j!=0)): continue
+        with stats.phase('edges'):
+            #Sparse distribution part of every transmission edge (i,j) --> (i+1,j+1) in one gather
+            lattice = trellis_arrays.Lattice(len(watermark),len(recieved))
+            gammas = trellis_arrays.transmission_gammas(lattice,self.table,self.symbols(watermark),self.symbols(recieved)[None])[0].tolist()
 
+            #Edge gammas, the depth of the neighbour gives the type of the edge
+            for node in self.nodes[:-1]:
+                i,j,d = self.tuples[node]
 
-                    node = str((i,j,d))
-                    self.nodes.append(node)
-                    self.tuples[node] = (i,j,d)
-            
+                if d == 0: probability_distribution = self.PS
+                elif d == -2: probability_distribution = self.PI
+                elif d == 2: probability_distribution = self.PD
 
-        self.toor = (len(watermark)+2,len(recieved)+2,0)
-        self.toor_name = str(self.toor)
-        self.nodes.append(self.toor_name)
-        self.tuples[self.toor_name] = self.toor
+                Pi,Pd,Ps = probability_distribution
+                #Ps is now affected by the sparse distrubution and similarly for Pt
 
-        self.my_graph = {node:[] for node in self.nodes}  # the neighbours directed from the node
-        self.reverse_graph = {node:[] for node in self.nodes} #the neighbours directed to the node
+                normalisation = 1-Pi-Pd # Probability for transmission/substitution
 
+                for neighbour in self.my_graph[node]:
+                    d1 = self.tuples[neighbour][2]
 
-        probability_distribution = None
-        n = len(self.sparse_distribution)
+                    if neighbour == self.toor_name: self.edges[(node,neighbour)] = 1.0
 
-        #print(f'Time taken for initialising the nodes {time.time() - startup}s')
-        start = time.time()
+                    #Insertion
+                    elif d1 == -2: self.edges[(node,neighbour)] = Pi
 
+                    #Deletion
+                    elif d1 == 2: self.edges[(node,neighbour)] = Pd
 
-        #Assigning all the neighbours and edges
-        for node in self.my_graph:
-            i,j,d = self.tuples[node]
+                    #Transmission
+                    else: self.edges[(node,neighbour)] =  normalisation*gammas[i][j]
 
-            if d == 0: probability_distribution = self.PS
-            elif d == -2: probability_distribution = self.PI
-            elif d == 2: probability_distribution = self.PD
 
-            Pi,Pd,Ps = probability_distribution
-            #Ps is now affected by the sparse distrubution and similarly for Pt
+        with stats.phase('forward'):
+            #Forward algorithm along the cached topological order
+            self.alphas[str((0,0,0))] = 1
 
+            for node in skeleton.order[1:]:
+                f = 0
+                for neighbour in self.reverse_graph[node]:
+                    f += self.edges[(neighbour,node)]*self.alphas[neighbour] # neighbour --> node
+                self.alphas[node] = f
 
-            normalisation = 1-Pi-Pd # Probability for transmission/substitution
 
-            #Insertion
-            if j+1 <= len(recieved):
-                neighbour = str((i,j+1,-2))
-                self.my_graph[node].append(neighbour)
-                self.edges[(node,neighbour)] = Pi
-                self.reverse_graph[neighbour].append(node)
+        with stats.phase('backward'):
+            #Backward algorithm along the reversed order
+            self.betas[self.toor_name] = 1.0
 
-            #Deletion
-            if i+1 <= len(watermark):
-                neighbour = str((i+1,j,2))
-                self.my_graph[node].append(neighbour)
-                self.edges[(node,neighbour)] = Pd
-                self.reverse_graph[neighbour].append(node)
-            
-            #Transmission
-            if i+1 <= len(watermark) and j+1 <= len(recieved):
-                neighbour = str((i+1,j+1,0))
-                self.my_graph[node].append(neighbour)
-                self.reverse_graph[neighbour].append(node)
+            for node in skeleton.reverse_order[1:]:
+                b = 0
+                for neighbour in self.my_graph[node]:
+                    b += self.edges[(node,neighbour)]*self.betas[neighbour] # node --> neighbour
+                self.betas[node] = b
 
-                ti = self.base_mapping[watermark[i]] 
-                ri = self.base_mapping[recieved[j]]
-                di = str((ri-ti)%4)
+        self.log_likelihood = np.log(self.alphas[self.toor_name])
 
-                #Normalise these in accordance to transmissions
-                #Is normalisation necessary?
 
-                self.edges[(node,neighbour)] =  normalisation*self.sparse_distribution[i%n][di]
+        with stats.phase('likelihoods'):
+            self.output_likelihoods(watermark,recieved)
 
+        stats.nodes,stats.edges = len(self.nodes),len(self.edges)
+        stats.finish()
 
-        for d in depth:
-            node = str((len(watermark),len(recieved),d))
-            self.my_graph[node].append(self.toor_name)
-            self.reverse_graph[self.toor_name].append(node)
+        return self.likelihoods
 
-            self.edges[(node,self.toor_name)] = 1.0
+    def array_forward_backward(self,watermark,recieved,PI,PD,PS,max_drift=None,checkpoint=None,beam=None,tolerance=1e-4,priors=None):
+        '''Forward backward algorithm on dense arrays, self.alphas and self.betas are (3,N+1,M+1) arrays
+        with the T, I, D planes instead of str node dictionaries
 
-        self.my_graph[self.toor_name] = []        
+        With max_drift = W the planes are (3,N+1,2W+1) and only hold the band |j - i| <= W,
+        self.band_loss is the fraction of P(recieved | watermark) carried by the paths that leave the band,
+        1 - P_band / P (0 when it was wide enough)
 
+        Each anti-diagonal is scaled by self.scales so long strands do not underflow,
+        self.log_likelihood is log P(recieved | watermark)
 
-        self.alphas[str((0,0,0))] = 1
+        With checkpoint = k the alphas are only kept at every k-th anti-diagonal and recomputed
+        during the backward sweep, self.alphas and self.betas are then None
 
-        self.counter =0 
+        With beam = b the nodes whose alphas are below b times the largest alpha of their anti-diagonal
+        are dropped and the others are only computed where they can be reached. self.pruned_mass is the
+        fraction of P(recieved | watermark) carried by the dropped paths, 1 - P_beam / P, which moves the
+        likelihoods by about as much. Above tolerance the exact recursions are run instead and
+        self.beam_fallback is True
 
-        total = len(watermark)*(len(recieved)+1) + (len(watermark)+1)*len(recieved) + len(watermark)*len(recieved) +1
+        priors is an (N,4) array with the prior of each sparse symbol at each index, e.g. from the LDPC
+        extrinsic information (see turbo.py), used instead of the sparse distribution'''
 
-        #print(f'Time taken for initialising the edges {time.time() - start}s')
-        
-        
+        probabilities = self.array_reads(watermark,[recieved],PI,PD,PS,max_drift,checkpoint,beam,tolerance,priors)
 
+        #Only one read, drop the read axis
+        if checkpoint is None: self.alphas,self.betas = self.alphas[0],self.betas[0]
+        self.scales = self.scales[0]
+        self.band_loss,self.log_likelihood = self.band_loss[0],self.log_likelihood[0]
+        self.pruned_mass = self.pruned_mass[0]
 
-        def forward(node):
-            '''Forward algorithm using recursion'''
-            self.counter +=1
-            #progress_bar(self.counter,total)
+        self.likelihoods = self.likelihood_dict(probabilities[0])
 
-            
-            if node == str((0,0,0)) : return 1
-            if node in self.alphas: 
-                return self.alphas[node]
+        return self.likelihoods
 
+    def auto_forward_backward(self,watermark,recieved,PI,PD,PS,max_drift=None,priors=None):
+        '''Runs the full, banded, checkpointed or windowed array engine, whichever self.policy picks for self.budget
 
-            neighbours = self.reverse_graph[node]
-            output = 0
+        The policy gets the lengths before anything is allocated and returns a trellis_budget.Estimate,
+        kept in self.mode. max_drift is the band the caller trusts, None lets the policy pick one'''
 
-            for neighbour in neighbours:
-                value = self.edges[(neighbour,node)] #neighbour --> node transition
-                if neighbour in self.alphas:
-                    f = self.alphas[neighbour]
-                else:
-                    f = forward(neighbour)
+        self.mode = self.policy(len(watermark),len(recieved),self.budget,max_drift)
+        options = self.mode.options
 
-                output += f*value
-                
+        if self.mode.mode == 'window':
+            if priors is not None: raise ValueError('priors needs the full, banded or checkpointed array engine')
+            self.stats = trellis_stats.TrellisStats('window',len(watermark),len(recieved),max_drift=options['max_drift'])
+            with self.stats.phase('window'):
+                self.likelihoods = dict(self.windowed_forward_backward(watermark,recieved,PI,PD,PS,options['max_drift'],options.get('lag'),options.get('block')))
+            self.stats.finish()
+        else:
+            checkpoint = options.get('checkpoint') if self.mode.mode == 'checkpoint' else None
+            self.array_forward_backward(watermark,recieved,PI,PD,PS,options.get('max_drift'),checkpoint,priors=priors)
 
-            self.alphas[node] = output
+        self.stats.mode.update({'policy':self.mode.mode,'estimated bytes':self.mode.bytes,'estimated seconds':self.mode.seconds})
 
-            return self.alphas[node]
+        return self.likelihoods
 
+    def multi_read_forward_backward(self,watermark,reads,PI,PD,PS,max_drift=None,checkpoint=None,beam=None,tolerance=1e-4):
+        '''Joint likelihoods of the transmitted symbols given several reads of the same watermark
 
-        def forward_stack():
-            '''Forward algorithm using a stack instead of recursive stack'''
-            stack = [self.toor_name]
-            order = [str((0,0,0))]
+        All the reads go through the array engine together, self.alphas and self.betas are
+        (R,3,N+1,width) arrays and self.read_likelihoods holds the (R,N,4) likelihoods of each read.
+        The returned likelihoods are the prior times the product of the read likelihoods, in the
+        same format as forward_backward so they can go straight to Sparsifier.decoder'''
 
-            while stack:
-                node = stack[-1]
-                neighbours = self.reverse_graph[node]
+        self.read_likelihoods = self.array_reads(watermark,reads,PI,PD,PS,max_drift,checkpoint,beam,tolerance)
 
-                mylist = [neighbour in self.alphas for neighbour in neighbours]
-                if all(mylist):
-                    f = 0
-                    for neighbour in neighbours:
-                        value = self.edges[(neighbour,node)] # neighbour --> node
-                        f += value*self.alphas[neighbour]
-                    self.alphas[node] = f
-                    stack.pop(-1)
-                    order.append(node)
-                
-                else:
-                    for neighbour in neighbours:
-                        if neighbour not in self.alphas: stack.append(neighbour)
+        w = self.symbols(watermark)
+        probabilities = trellis_arrays.combine_reads(self.read_likelihoods,w,self.table)
 
-            return order
+        self.likelihoods = self.likelihood_dict(probabilities)
 
-        #start1 = time.time()
-        #forward(self.toor_name)
-        #print(f'Time taken for recursion {time.time() - start1}s')
+        return self.likelihoods
 
+    def batch_forward_backward(self,pairs,PI,PD,PS,max_drift=None,max_waste=0.1,batch=32):
+        '''Likelihoods of many (watermark, recieved) pairs, a list with the (N,4) likelihoods of each pair in the A,C,G,T order
 
-        start2 = time.time()
-        order = forward_stack()
-        #print(f'Time taken for forward stack {time.time() - start2}s')
+        The pairs are grouped by length into batches of at most batch pairs (trellis_arrays.buckets) that
+        are padded to their longest watermark and read, with at most max_waste of the nodes padding.
+        Each batch runs through the array engine at once, self.log_likelihood holds log P(recieved | watermark) of every pair'''
 
-     
+        self.PI = PI
+        self.PD = PD
+        self.PS = PS
 
-        self.betas[self.toor_name] = 1.0
-        self.counter = 0
-        
-        
+        insertion,deletion,transmission = trellis_arrays.edge_probabilities(PI,PD,PS)
 
-        def backward(node):
+        likelihoods = [None]*len(pairs)
+        self.log_likelihood = np.zeros(len(pairs))
 
-            self.counter +=1
-            #progress_bar(self.counter,total)
+        shapes = [(len(watermark),len(recieved)) for watermark,recieved in pairs]
+        stats = self.stats = trellis_stats.TrellisStats('batch',max(N for N,M in shapes),max(M for N,M in shapes),len(pairs),max_drift=max_drift,max_waste=max_waste,batch=batch)
 
-            if node == self.toor_name : return 1.0
-            if node in self.betas: 
-                return self.betas[node]
-            
-            
+        with stats.phase('buckets'):
+            batches = trellis_arrays.buckets(shapes,max_waste,batch,max_drift)
 
-            neighbours = self.my_graph[node]
-            output = 0
+        for positions in batches:
+            watermarks = [self.symbols(pairs[b][0]) for b in positions]
+            reads = [self.symbols(pairs[b][1]) for b in positions]
+            rows = [len(w) for w in watermarks]
 
-            for neighbour in neighbours:
-                value = self.edges[(node,neighbour)] #neighbour --> node transition
-                if neighbour in self.betas: 
-                    b = self.betas[neighbour]
-                else:
-                    b = backward(neighbour)
-                output += b*value
-                
+            lattice = trellis_arrays.Lattice(max(rows),[len(r) for r in reads],max_drift,rows)
+            w = trellis_arrays.pad_reads(watermarks)
+            r = trellis_arrays.pad_reads(reads)
+
+            nodes,edges = lattice.size()
+            stats.nodes += nodes
+            stats.edges += edges
+
+            with stats.phase('gammas'):
+                gammas = trellis_arrays.transmission_gammas(lattice,self.table,w,r)
+            with stats.phase('forward'):
+                alphas,scales,lost = trellis_arrays.forward(lattice,gammas,insertion,deletion,transmission,self.wavefront)
+                final = trellis_arrays.final_alpha(lattice,alphas)
+            with stats.phase('backward'):
+                betas = trellis_arrays.backward(lattice,gammas,insertion,deletion,transmission,scales,final,self.wavefront)
+
+            with stats.phase('likelihoods'):
+                probabilities = trellis_arrays.symbol_probabilities(lattice,alphas,betas,gammas,scales,w,r,self.table,deletion,transmission)
+            log_likelihoods = trellis_arrays.log_likelihood(final,scales,lattice)
+
+            for k,b in enumerate(positions):
+                likelihoods[b] = probabilities[k,:rows[k]]
+                self.log_likelihood[b] = log_likelihoods[k]
+
+        stats.finish(batches=len(batches))
+        return likelihoods
+
+    def baum_welch(self,pairs,PI,PD,PS,iterations=20,tolerance=1e-6,max_drift=None,max_waste=0.1,batch=64,processes=None):
+        '''Fits PI, PD and PS of the bigram channel to many (watermark, recieved) pairs by expectation maximisation
+
+        Every iteration runs the batched array engine over all the pairs, adds up the expected edges leaving
+        the T, I and D planes (trellis_arrays.expected_counts) and re-estimates every depth from them, until
+        the log likelihood improves by less than tolerance of itself. processes shares the batches out over a
+        multiprocessing Pool. The inserted symbols are uniform and a substitution is uniform over the other
+        symbols. A probability that starts at 0 stays 0, pass the zeros of the channel model as 0.
+        For reads of known strands use Trellis3D({0:{'0':1,'1':0,'2':0,'3':0}}) with the strands as the watermarks.
+
+        Returns (PI, PD, PS), self.fit_history holds (log likelihood, PI, PD, PS) of every iteration'''
+
+        shapes = [(len(watermark),len(recieved)) for watermark,recieved in pairs]
+        stats = self.stats = trellis_stats.TrellisStats('baum welch',max(N for N,M in shapes),max(M for N,M in shapes),len(pairs),max_drift=max_drift,max_waste=max_waste,batch=batch)
+
+        #The padded batches are built once and reused by every iteration
+        with stats.phase('buckets'):
+            batches = []
+            for positions in trellis_arrays.buckets(shapes,max_waste,batch,max_drift):
+                watermarks = [self.symbols(pairs[b][0]) for b in positions]
+                reads = [self.symbols(pairs[b][1]) for b in positions]
+                rows = [len(w) for w in watermarks]
+
+                lattice = trellis_arrays.Lattice(max(rows),[len(r) for r in reads],max_drift,rows)
+                batches.append((lattice,trellis_arrays.pad_reads(watermarks),trellis_arrays.pad_reads(reads)))
+                stats.nodes += lattice.size()[0]
+
+        self.fit_history = []
 
-            self.betas[node] = output
+        with multiprocessing.Pool(processes) if processes else contextlib.nullcontext() as pool:
+            for iteration in range(iterations):
+                insertion,deletion,transmission = trellis_arrays.edge_probabilities(PI,PD,PS)
+                insertion = insertion / len(self.basis) # Probability of the edge and of the inserted symbol
 
-            return self.betas[node]
+                #Share of the transmission edges leaving each depth that substitute
+                substitution = np.divide([PS[2],PI[2],PD[2]],transmission,out=np.zeros(3),where=transmission > 0)
+                tables = [trellis_arrays.substitution_channel(self.table,p) for p in substitution]
+                substituting = [table - (1 - p) * self.table for table,p in zip(tables,substitution)] # Part of the table that comes from a substitution
 
+                with stats.phase('expectation'):
+                    if pool is None:
+                        results = [trellis_arrays.expectation(b,tables,substituting,insertion,deletion,transmission,self.wavefront) for b in batches]
+                    else:
+                        results = pool.starmap(trellis_arrays.expectation,[(b,tables,substituting,insertion,deletion,transmission) for b in batches])
 
+                counts = sum(counts for counts,total in results)
+                total = sum(total for counts,total in results)
 
-        def backward_stack():
-            '''Forward algorithm using a stack instead of recursive stack'''
-            stack = [str((0,0,0))] 
-            reverse_order = [self.toor_name]
+                self.fit_history.append((total,PI,PD,PS))
+                PI,PD,PS = trellis_arrays.channel_parameters(counts,PI,PD,PS)
 
-            while stack:
-                node = stack[-1]
-                neighbours = self.my_graph[node]
+                if iteration and abs(total - self.fit_history[-2][0]) <= tolerance*abs(total): break
 
-                mylist = [neighbour in self.betas for neighbour in neighbours]
-                if all(mylist):
-                    b = 0
-                    for neighbour in neighbours:
-                        value = self.edges[(node,neighbour)] # node --> neighbour
-                        b += value*self.betas[neighbour]
-                    self.betas[node] = b
-                    stack.pop(-1)
-                    reverse_order.append(node)
-                
-                else:
-                    for neighbour in neighbours:
-                        if neighbour not in self.betas: stack.append(neighbour)
+        self.PI,self.PD,self.PS = PI,PD,PS
+        stats.finish(iterations=len(self.fit_history),log_likelihood=self.fit_history[-1][0])
+        return PI, PD, PS
 
-            return reverse_order
+    def windowed_forward_backward(self,watermark,recieved,PI,PD,PS,max_drift,lag=None,block=None):
+        '''Generator of (i, {'A': pA, ... 'T': pT}) for every transmitted index i in order, for reads too long to hold the lattice
 
+        Fixed-lag smoothing on the max_drift band, a block of indices is emitted once the forward pass
+        is lag indices past it (4*max_drift by default), so only O((block + lag) * max_drift) values are kept.
+        The likelihoods are approximate until lag is long enough for the channel to forget the flat betas'''
 
-        #starting = str((0,0,0))
-        #backward(starting)
+        if lag is None: lag = 4*max_drift
+        if block is None: block = lag
 
-        start3 = time.time()
-        reverse_order = backward_stack()
-        #print(f'Time taken for backwards stack {time.time() - start3}s')
+        self.PI = PI
+        self.PD = PD
+        self.PS = PS
+
+        w = self.symbols(watermark)
+        r = self.symbols(recieved)
+
+        insertion,deletion,transmission = trellis_arrays.edge_probabilities(PI,PD,PS)
+
+        for i,probabilities in trellis_window.fixed_lag(w,r,self.table,insertion,deletion,transmission,max_drift,lag,block):
+            yield i,{symbol:probabilities[self.base_mapping[symbol]] for symbol in self.basis}
+
+    def start_read(self,watermark,PI,PD,PS):
+        '''Starts decoding a read that is still being sequenced, see extend_read and stream_likelihoods'''
+
+        self.PI = PI
+        self.PD = PD
+        self.PS = PS
+
+        insertion,deletion,transmission = trellis_arrays.edge_probabilities(PI,PD,PS)
+        self.stream = trellis_stream.Stream(self.symbols(watermark),self.table,insertion,deletion,transmission)
+
+    def extend_read(self,recieved):
+        '''Appends recieved symbols to the read, only the forward recursion of the new columns is run'''
+        if self.stream is None: raise ValueError('start_read has to be called before extend_read')
+        self.stream.extend(self.symbols(recieved))
 
+    def stream_likelihoods(self,complete=False):
+        '''Likelihoods of each transmitted symbol given the read so far
 
-        start4 = time.time()
-        #print(f'Time taken for forward backwards algorithm {end-start} seconds with {len(watermark)} symbols {len(watermark)**2} squared')
-        self.output_likelihoods(watermark,recieved)
+        The backward pass is only rerun if the read grew since the last call. The transmitted symbols
+        the read has not reached yet get the sparse distribution. complete=True once the whole read
+        has been appended, the likelihoods are then the same as forward_backward'''
+        if self.stream is None: raise ValueError('start_read has to be called before stream_likelihoods')
 
-        #print(f'time taken for likelihoods calculations {time.time() - start4}s with {len(self.edges)} number of edges and nodes {total}')
+        self.likelihoods = self.likelihood_dict(self.stream.probabilities(complete))
         return self.likelihoods
 
-    def output_likelihoods(self,watermark,recieved):
+    def viterbi(self,watermark,recieved,PI,PD,PS,max_drift=None):
+        '''Most likely alignment of the recieved read to the watermark (max-product instead of sum-product)
+
+        Returns the path as an int8 array with one code per step, trellis_arrays.OPERATIONS[code] is
+        'transmit', 'substitute' (recieved symbol differs from the watermark), 'insert' or 'delete',
+        and the log probability of the path'''
 
-        self.probabilities = {i:{symbol:0 for symbol in self.basis} for i in range(len(watermark))}   
-        # 0,1,2,3...: {'A': A likelihood, 'C' : C likelihood, ...}
+        w = self.symbols(watermark)
+        r = self.symbols(recieved)[None]
 
-        for edge in self.edges:
-            node = edge[0]
-            neighbour = edge[1]
+        lattice = trellis_arrays.Lattice(len(w),len(recieved),max_drift)
+        stats = self.stats = trellis_stats.TrellisStats('viterbi',len(w),len(recieved),max_drift=max_drift)
+        stats.nodes,stats.edges = lattice.size()
 
+        with stats.phase('gammas'):
+            gammas = trellis_arrays.transmission_gammas(lattice,self.table,w,r)
+        insertion,deletion,transmission = trellis_arrays.edge_probabilities(PI,PD,PS)
 
-            self.values[edge] = self.alphas[node]*self.betas[neighbour]*self.edges[edge]
+        with stats.phase('viterbi'):
+            paths,log_probabilities = trellis_arrays.viterbi(lattice,gammas,w,r,insertion,deletion,transmission)
 
-            node = self.tuples[node] #Converts to tuples
-            neighbour = self.tuples[neighbour]
+        stats.finish()
+        return paths[0], log_probabilities[0]
 
-            if node[2] == 0: distribution = self.PS
-            elif node[2] == 2: distribution = self.PD
-            elif node[2] == -2: distribution = self.PI
+    def array_reads(self,watermark,reads,PI,PD,PS,max_drift=None,checkpoint=None,beam=None,tolerance=1e-4,priors=None):
+        '''Runs the array engine on every read of the watermark, returns the (R,N,4) symbol likelihoods'''
 
+        self.PI = PI
+        self.PD = PD
+        self.PS = PS
 
-            Pi,Pd,Ps = distribution
-            Pt = round(1 - Pi - Pd - Ps,1)
+        w = self.symbols(watermark)
+        r = trellis_arrays.pad_reads([self.symbols(read) for read in reads])
 
-            # Havent included deletions horizontal, only does transmissions/substitutions likelihoods
-            if node[0]+1 == neighbour[0] and node[1]+1 == neighbour[1]:
-                r = recieved[node[1]]
-                self.probabilities[node[0]][r] += self.values[edge]
+        table = self.table
+        if priors is not None:
+            table = np.asarray(priors,dtype=float)
+            if table.shape != (len(w),4): raise ValueError(f'priors has to be a ({len(w)},4) array, recieved {table.shape}')
 
-            # Deletions horizontal transitions
+        self.lattice = trellis_arrays.Lattice(len(w),[len(read) for read in reads],max_drift)
 
-            if node[0]+1 == neighbour[0] and node[1] == neighbour[1]:
-                w = watermark[node[0]]
+        insertion,deletion,transmission = trellis_arrays.edge_probabilities(PI,PD,PS)
 
-                for q in self.sparse_distribution[node[0]%len(self.sparse_distribution)]:
-                    p = self.values[edge]*self.sparse_distribution[node[0]%len(self.sparse_distribution)][q]
+        def ghost(lattice,gammas=None):
+            '''Ghost of the mass lost by the recursions, on lattice with its stored gammas'''
+            return trellis_arrays.Ghost(lattice,table,w,r,insertion,deletion,transmission,gammas)
 
+        def leak():
+            '''Ghost of the paths that leave the band'''
+            return ghost(trellis_arrays.Lattice(len(w),self.lattice.lengths)) if max_drift is not None else None
 
-                    t = (self.base_mapping[w] +int(q)) % 4
+        self.pruned_mass = np.zeros(len(reads))
+        self.beam_fallback = False
+        if beam is not None and checkpoint is not None: raise ValueError('beam pruning needs the stored planes, not checkpoint')
+        if checkpoint is True: checkpoint = max(1,int(np.sqrt(len(w) + self.lattice.M)))
 
-                    self.probabilities[node[0]][self.q_mapping[t]] += p
+        threads = self.wavefront.threads if self.wavefront else None
+        stats = self.stats = trellis_stats.TrellisStats('array',len(w),self.lattice.M,len(reads),max_drift=max_drift,checkpoint=checkpoint,beam=beam,threads=threads)
+        stats.nodes,stats.edges = self.lattice.size()
 
+        if checkpoint is not None:
+            self.alphas,self.betas = None,None
+            with stats.phase('checkpointed'):
+                probabilities,self.scales,self.band_loss,final = trellis_arrays.checkpointed_probabilities(self.lattice,table,w,r,insertion,deletion,transmission,checkpoint,self.wavefront,leak())
+            self.log_likelihood = trellis_arrays.log_likelihood(final,self.scales)
 
-        
-        for key,symbols_dict in self.probabilities.items():
-            s = sum(value for value in symbols_dict.values())
+            stats.finish(band_loss=float(self.band_loss.max()))
+            return probabilities
+
+        with stats.phase('gammas'):
+            gammas = trellis_arrays.transmission_gammas(self.lattice,table,w,r)
+
+        pruning = trellis_arrays.Beam(beam,ghost(self.lattice,gammas)) if beam is not None else None
+
+        with stats.phase('forward'):
+            self.alphas,self.scales,self.band_loss = trellis_arrays.forward(self.lattice,gammas,insertion,deletion,transmission,self.wavefront,pruning,leak())
+            final = trellis_arrays.final_alpha(self.lattice,self.alphas)
+
+        if pruning is not None:
+            self.pruned_mass = pruning.pruned
+
+            #The pruned paths carried too much of the likelihood, run the exact recursions instead
+            if (pruning.pruned > tolerance).any() or (final <= 0).any():
+                self.beam_fallback = True
+                pruning = None
+                with stats.phase('fallback forward'):
+                    self.alphas,self.scales,self.band_loss = trellis_arrays.forward(self.lattice,gammas,insertion,deletion,transmission,self.wavefront,leak=leak())
+                    final = trellis_arrays.final_alpha(self.lattice,self.alphas)
+
+        self.log_likelihood = trellis_arrays.log_likelihood(final,self.scales)
+        with stats.phase('backward'):
+            self.betas = trellis_arrays.backward(self.lattice,gammas,insertion,deletion,transmission,self.scales,final,self.wavefront,pruning)
+
+        with stats.phase('likelihoods'):
+            probabilities = trellis_arrays.symbol_probabilities(self.lattice,self.alphas,self.betas,gammas,self.scales,w,r,table,deletion,transmission)
+
+        stats.finish(band_loss=float(self.band_loss.max()),pruned_mass=float(self.pruned_mass.max()),beam_fallback=self.beam_fallback)
+        return probabilities
+
+    def symbols(self,sequence):
+        '''Integer array of a sequence, the canonical uint8 codes of sequences.py or A,C,G,T letters'''
+        return sequences.encode(sequence).astype(int)
+
+    def likelihood_dict(self,probabilities):
+        '''Converts (N,4) likelihoods in the A,C,G,T order to {0: {'A': pA, ... 'T': pT}, 1: {}, ...}'''
+        return {i:{symbol:probabilities[i,self.base_mapping[symbol]] for symbol in self.basis} for i in range(len(probabilities))}
+
+    def output_likelihoods(self,watermark,recieved):
+        '''Likelihoods of each transmitted symbol from alpha * gamma * beta of the edges leaving each row
+
+        Transmission/substitution edges vote for the recieved symbol, deletion edges are spread over the
+        symbols allowed by the sparse distribution. The edges are the arrays of the cached skeleton,
+        self.values (alpha * gamma * beta of every edge, used by draw_3D) is only filled in debug mode'''
+
+        w = self.symbols(watermark)
+        r = self.symbols(recieved)
+        N = len(w)
+
+        insertion,deletion,transmission = trellis_arrays.edge_probabilities(self.PI,self.PD,self.PS)
+
+        alphas = np.array([self.alphas[node] for node in self.nodes],dtype=float)
+        betas = np.array([self.betas[node] for node in self.nodes],dtype=float)
+        planes = self.skeleton.planes
+
+        #Transmission/substitution edges (i,j) --> (i+1,j+1)
+        source,target,i,j = self.skeleton.transmissions
+        gammas = transmission[planes[source]] * self.table[i % len(self.table),(r[j]-w[i]) % 4]
+        probabilities = np.zeros((N,4))
+        np.add.at(probabilities,(i,r[j]),alphas[source]*gammas*betas[target])
+
+        #Deletion edges (i,j) --> (i+1,j)
+        source,target,i = self.skeleton.deletions
+        deleted = np.bincount(i,alphas[source]*deletion[planes[source]]*betas[target],minlength=N)
+
+        rows = np.arange(N)
+        probabilities[rows[:,None],(w[:,None] + np.arange(4)) % 4] += deleted[:,None] * self.table[rows % len(self.table)]
+
+        self.probabilities = self.likelihood_dict(probabilities)
+        self.likelihoods = self.likelihood_dict(probabilities / probabilities.sum(axis=1,keepdims=True))
 
-            self.likelihoods[key] = {k:v/s for k,v in symbols_dict.items()}
+        if self.debug: self.values = {edge:self.alphas[edge[0]]*self.betas[edge[1]]*gamma for edge,gamma in self.edges.items()}
 
         
     def draw_3D(self,watermark,recieved):
@@ -467,7 +687,7 @@ if __name__ == '__main__':
     print(recieved)
 
 
-    Trellis3d = Trellis3D(sparse_distribution)
+    Trellis3d = Trellis3D(sparse_distribution,debug=True)
 
 
     Trellis3d.forward_backward(watermark,recieved,PI=PI,PD=PD,PS=PS)
@@ -1,11 +1,151 @@
 import random
+import numpy as np
+import sequences
+
+
+OPTIONS = ['transmit','substitute','insert','delete'] # Codes of the change logs
+TRANSMIT,SUBSTITUTE,INSERT,DELETE = range(4)
+CODES = {option:q for q,option in enumerate(OPTIONS)}
+
+
+def alignment(changes):
+    '''(transmitted index, recieved index) of every event of a change log
+
+    A transmission or substitution is at the pair of symbols it links, a deletion at its transmitted
+    symbol and the recieved symbol after it, an insertion at its recieved symbol and the transmitted
+    symbol after it'''
+    changes = np.asarray(changes)
+    consuming = changes != INSERT
+    emitting = changes != DELETE
+    return np.cumsum(consuming) - consuming, np.cumsum(emitting) - emitting
+
+
+def recieved_index(changes):
+    '''Index in the output of every transmitted symbol, -1 where it was deleted'''
+    changes = np.asarray(changes)
+    i,j = alignment(changes)
+    consumed = changes[changes != INSERT]
+    return np.where(consumed == DELETE,-1,j[changes != INSERT])
+
+
+def transmitted_index(changes):
+    '''Index in the input of every recieved symbol, -1 where it was inserted'''
+    changes = np.asarray(changes)
+    i,j = alignment(changes)
+    emitted = changes[changes != DELETE]
+    return np.where(emitted == INSERT,-1,i[changes != DELETE])
+
+
+def markov_events(cumulative,following,uniforms,state):
+    '''Events of Markov chains whose event distribution only depends on the state the last event left
+
+    cumulative (S,4) cumulative event probabilities of each state, following (4,) state each event leads to,
+    uniforms (R,K) one uniform per event of each of the R chains, state (R,) their states before the first
+    event. Every step is a map from the state before to the state after, written as the integer sum
+    map[s] * S**s. The maps are composed by doubling through a (S**S,S**S) table, log2(K) NumPy lookups
+    give the state before every event at once. Only meant for a few states, S = 3 has 27 maps
+
+    Returns the (R,K) events and the (R,) states after the last one'''
+    R,K = uniforms.shape
+    S = len(cumulative)
+    digits = S**np.arange(S)
+    state = np.asarray(state)
+
+    candidates = np.minimum((uniforms[:,None,:,None] >= cumulative[None,:,None,:]).sum(axis=3),3) # (R,S,K) event from each state
+    maps = (following[candidates] * digits[None,:,None]).sum(axis=1) # (R,K) code of the state after step k for each state before it
+
+    #compose[a,b] is the code of the map b then a
+    decoded = (np.arange(S**S)[:,None] // digits) % S
+    compose = decoded[:,decoded] @ digits
+
+    shift = 1
+    while shift < K:
+        maps[:,shift:] = compose[maps[:,shift:],maps[:,:-shift]]
+        shift *= 2
+
+    states = np.empty((R,K),dtype=int)
+    states[:,0] = state
+    states[:,1:] = (maps[:,:-1] // S**state[:,None]) % S
+    return np.take_along_axis(candidates,states[:,None,:],axis=1)[:,0], (maps[:,-1] // S**state) % S
+
+
+def replay(sequence,changes,draws,offsets=None,symbols=4):
+    '''Output of a recorded realization on sequence, see Realization
+
+    Each read of changes[offsets[r]:offsets[r+1]] must transmit, substitute or delete exactly len(sequence)
+    symbols. Returns the uint8 output, and its offsets when offsets is given'''
+    sequence = sequences.encode(sequence,sequences.BASES if symbols == 4 else sequences.BITS)
+    changes = np.asarray(changes)
+    draws = np.asarray(draws)
+    single = offsets is None
+    if single: offsets = [0,len(changes)]
+    offsets = np.asarray(offsets)
+
+    consuming = changes != INSERT
+    consumed = np.concatenate([[0],np.cumsum(consuming)])
+    if (np.diff(consumed[offsets]) != len(sequence)).any():
+        raise ValueError(f'The realization is of inputs of length {np.diff(consumed[offsets]).tolist()[:5]}, recieved a sequence of length {len(sequence)}')
+
+    #Input symbol each event is at, counted from the start of its read
+    index = consumed[:-1] - np.repeat(consumed[offsets[:-1]],np.diff(offsets))
+    output = sequence[np.minimum(index,len(sequence)-1)] if len(sequence) else np.zeros(len(changes),dtype=np.uint8)
+    substituted = changes == SUBSTITUTE
+    output[substituted] = (output[substituted] + draws[substituted]) % symbols
+    inserted = changes == INSERT
+    output[inserted] = draws[inserted]
+
+    emitting = changes != DELETE
+    if single: return output[emitting]
+    emitted = np.concatenate([[0],np.cumsum(emitting)])
+    return output[emitting], emitted[offsets]
+
+
+class Realization:
+    '''One draw of the channel noise, the events and the symbols drawn for them, replayable onto any
+    input of the same length so decoder variants can be compared on identical noise
+
+    changes holds the OPTIONS codes of the events, draws the shift of the symbol at every substitution
+    (1 ... symbols-1, the output is (input + shift) % symbols) and the inserted symbol at every insertion,
+    0 elsewhere. offsets is the start of every read in changes for coverage_bigram_channel, None for one read'''
+
+
+    def __init__(self,changes,draws,offsets=None,symbols=4):
+        self.changes = np.asarray(changes,dtype=np.uint8)
+        self.draws = np.asarray(draws,dtype=np.uint8)
+        self.offsets = None if offsets is None else np.asarray(offsets)
+        self.symbols = symbols
+        if len(self.changes) != len(self.draws): raise ValueError(f'Every change needs a draw, recieved {len(self.changes)} changes and {len(self.draws)} draws')
+
+    def __len__(self):
+        '''Length of the input the realization replays onto'''
+        end = len(self.changes) if self.offsets is None else self.offsets[1]
+        return int((self.changes[:end] != INSERT).sum())
+
+    def replay(self,sequence):
+        '''uint8 output of sequence through the recorded noise, (output, offsets) for several reads'''
+        return replay(sequence,self.changes,self.draws,self.offsets,self.symbols)
+
+    def save(self,path):
+        arrays = {'changes':self.changes,'draws':self.draws,'symbols':self.symbols}
+        if self.offsets is not None: arrays['offsets'] = self.offsets
+        np.savez(path,**arrays)
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as arrays:
+            return cls(arrays['changes'],arrays['draws'],arrays['offsets'] if 'offsets' in arrays else None,int(arrays['symbols']))
+
 
 class channel:
 
     def __init__(self):
         self.input = None
         self.output = None
-        self.changes = []
+        self.changes = np.zeros(0,dtype=np.uint8) # OPTIONS code of every event of the last call, 1 byte each
+        self.draws = np.zeros(0,dtype=np.uint8) # Substitution shift or inserted symbol of every event, see Realization
+        self.symbol_count = 4 # Size of the alphabet of the last call
+        self.offsets = None # Start of every read in self.output and its end, coverage_bigram_channel
+        self.change_offsets = None # Same for self.changes
     
 
     def generate_sequence(self,n=10,bits = False):
@@ -19,13 +159,17 @@ class channel:
         i,n = 0,len(sequence)
         bases = ['A','C','G','T']
         if bits: bases = ['0','1']
+        if isinstance(sequence,np.ndarray): sequence = sequences.decode(sequence,''.join(bases)) # The loop works on letters
         options = ['transmit','substitute','insert','delete']
         weights = [Pt,Ps,Pi,Pd]
         output =[]
+        changes = bytearray() # OPTIONS codes of the events of this call
+        draws = bytearray() # Symbols drawn for them, see Realization
         while i <n:
             choice = random.choices(options,weights=weights)[0]
             #print(i,choice)
-            self.changes.append(choice)
+            changes.append(CODES[choice])
+            draws.append(0)
             
 
             if choice == 'transmit':
@@ -34,12 +178,18 @@ class channel:
                 new_choice = bases[:]
                 new_choice.remove(sequence[i])
                 output.append(random.choice(new_choice))
+                draws[-1] = (bases.index(output[-1]) - bases.index(sequence[i])) % len(bases)
             elif choice == 'insert':
                 output.append(random.choice(bases))
+                draws[-1] = bases.index(output[-1])
                 i-=1
             elif choice == 'delete':
                 pass
             i+=1
+        self.changes = np.frombuffer(changes,dtype=np.uint8)
+        self.draws = np.frombuffer(draws,dtype=np.uint8)
+        self.offsets = self.change_offsets = None
+        self.symbol_count = len(bases)
         self.output = output
         return 
     
@@ -48,10 +198,13 @@ class channel:
         i,n = 0,len(sequence)
         bases = ['A','C','G','T']
         if bits: bases = ['0','1']
+        if isinstance(sequence,np.ndarray): sequence = sequences.decode(sequence,''.join(bases)) # The loop works on letters
         options = ['transmit','substitute','insert','delete']
         output =[]
         choice = None
 
+        changes = bytearray() # OPTIONS codes of the events of this call
+        draws = bytearray() # Symbols drawn for them, see Realization
         while i <n:
             Pi,Pd,Ps = probability_distribution
             Pt = round(1 - Pi - Pd - Ps,1)
@@ -59,7 +212,8 @@ class channel:
             #print(f'Probability distribution {choice} {probability_distribution}')
 
             choice = random.choices(options,weights=weights)[0]
-            self.changes.append(choice)
+            changes.append(CODES[choice])
+            draws.append(0)
             
 
             if choice == 'transmit':
@@ -69,9 +223,11 @@ class channel:
                 new_choice = bases[:]
                 new_choice.remove(sequence[i])
                 output.append(random.choice(new_choice))
+                draws[-1] = (bases.index(output[-1]) - bases.index(sequence[i])) % len(bases)
                 probability_distribution = PS
             elif choice == 'insert':
                 output.append(random.choice(bases))
+                draws[-1] = bases.index(output[-1])
                 i-=1
                 probability_distribution = PI
             elif choice == 'delete':
@@ -79,12 +235,127 @@ class channel:
         
             i+=1
 
+        self.changes = np.frombuffer(changes,dtype=np.uint8)
+        self.draws = np.frombuffer(draws,dtype=np.uint8)
+        self.offsets = self.change_offsets = None
+        self.symbol_count = len(bases)
         self.output = output
         return output
 
 
 
 
+    def symbols(self,sequence,bases):
+        '''uint8 codes of a sequence, see sequences.encode'''
+        return sequences.encode(sequence,''.join(bases))
+
+    def emit(self,sequence,events,kept,bases,rng):
+        '''(R,K) output symbols of the events, integers indexing bases, and the mask of the ones that are output
+
+        self.draws is left with the symbols drawn for the kept events, see Realization'''
+        consuming = events != INSERT
+        index = np.minimum(np.cumsum(consuming,axis=1) - consuming,len(sequence)-1) # Input symbol each event is at
+
+        draws = np.zeros(events.shape,dtype=np.uint8)
+        output = sequence[index]
+        substituted = events == SUBSTITUTE
+        draws[substituted] = rng.integers(1,len(bases),substituted.sum())
+        output[substituted] = (output[substituted] + draws[substituted]) % len(bases)
+        inserted = events == INSERT
+        draws[inserted] = rng.integers(0,len(bases),inserted.sum())
+        output[inserted] = draws[inserted]
+
+        self.draws,self.symbol_count = draws[kept],len(bases)
+        return output, kept & (events != DELETE)
+
+    def draw_events(self,n,reads,draw):
+        '''(reads,K) events and the mask of the ones that happened, each read stops once n input symbols are
+        transmitted, substituted or deleted. draw(k) gives (reads,k) more events'''
+        events,kept = [],[]
+        remaining = np.full(reads,n)
+        while (remaining > 0).any():
+            chunk = draw(int(1.25*remaining.max()) + 16)
+            consuming = chunk != INSERT
+            kept.append(np.cumsum(consuming,axis=1) - consuming < remaining[:,None])
+            events.append(chunk)
+            remaining = np.maximum(remaining - consuming.sum(axis=1),0)
+
+        if not events: return np.zeros((reads,0),dtype=int),np.zeros((reads,0),dtype=bool)
+        return np.concatenate(events,axis=1),np.concatenate(kept,axis=1)
+
+    def bigram_events(self,n,reads,PI,PD,PS,rng):
+        '''(reads,K) events of the bigram channel and their mask, see draw_events'''
+        #States 0 : after a transmission or substitution (PS), 1 : after an insertion (PI), 2 : after a deletion (PD)
+        weights = np.array([[round(1 - Pi - Pd - Ps,1),Ps,Pi,Pd] for Pi,Pd,Ps in (PS,PI,PD)])
+        cumulative = np.cumsum(weights / weights.sum(axis=1,keepdims=True),axis=1)
+        following = np.array([0,0,1,2])
+
+        state = [np.zeros(reads,dtype=int)] # Every read starts after a transmission
+        def draw(k):
+            events,state[0] = markov_events(cumulative,following,rng.random((reads,k)),state[0])
+            return events
+
+        return self.draw_events(n,reads,draw)
+
+    def array_channel(self,sequence,Pi=0.15,Pd=0.15,Ps=0.15,bits=False,rng=None):
+        '''Same channel as channel() with every event drawn at once by a numpy.random.Generator
+
+        self.output holds the uint8 codes of the bases (sequences.py), self.changes the uint8 OPTIONS codes of the events'''
+        bases = ['A','C','G','T']
+        if bits: bases = ['0','1']
+        if rng is None: rng = np.random.default_rng() # Fresh entropy, forked workers do not share a generator
+        sequence = self.symbols(sequence,bases)
+
+        weights = np.array([1-Pi-Pd-Ps,Ps,Pi,Pd])
+        weights = weights / weights.sum()
+
+        events,kept = self.draw_events(len(sequence),1,lambda k : rng.choice(4,size=(1,k),p=weights))
+        output,emitted = self.emit(sequence,events,kept,bases,rng)
+        self.changes,self.output = events[kept].astype(np.uint8),output[emitted]
+        self.offsets = self.change_offsets = None
+        return self.output
+
+    def array_bigram_channel(self,sequence,PI = [0.5,0.0,0.1],PD = [0.0,0.5,0.1],PS = [0.1,0.1,0.1],bits=False,rng=None):
+        '''Same channel as bigram_channel() with the event chain sampled by markov_events from cumulative tables
+
+        self.output holds the uint8 codes of the bases (sequences.py), self.changes the uint8 OPTIONS codes of the events'''
+        bases = ['A','C','G','T']
+        if bits: bases = ['0','1']
+        if rng is None: rng = np.random.default_rng() # Fresh entropy, forked workers do not share a generator
+        sequence = self.symbols(sequence,bases)
+
+        events,kept = self.bigram_events(len(sequence),1,PI,PD,PS,rng)
+        output,emitted = self.emit(sequence,events,kept,bases,rng)
+        self.changes,self.output = events[kept].astype(np.uint8),output[emitted]
+        self.offsets = self.change_offsets = None
+        return self.output
+
+    def coverage_bigram_channel(self,sequence,reads,PI = [0.5,0.0,0.1],PD = [0.0,0.5,0.1],PS = [0.1,0.1,0.1],bits=False,rng=None):
+        '''reads independent reads of the same sequence through the bigram channel, all drawn together
+
+        Returns (output, offsets), read r is output[offsets[r]:offsets[r+1]] as uint8 indexes of the bases,
+        np.split(output,offsets[1:-1]) gives views of every read. self.changes and self.change_offsets
+        hold the OPTIONS codes of every read in the same layout'''
+        bases = ['A','C','G','T']
+        if bits: bases = ['0','1']
+        if rng is None: rng = np.random.default_rng() # Fresh entropy, forked workers do not share a generator
+        sequence = self.symbols(sequence,bases)
+
+        events,kept = self.bigram_events(len(sequence),reads,PI,PD,PS,rng)
+        output,emitted = self.emit(sequence,events,kept,bases,rng)
+
+        #Boolean indexing of the (reads,K) arrays keeps them read after read
+        self.output = output[emitted]
+        self.offsets = np.concatenate([[0],np.cumsum(emitted.sum(axis=1))])
+        self.changes = events[kept].astype(np.uint8)
+        self.change_offsets = np.concatenate([[0],np.cumsum(kept.sum(axis=1))])
+
+        return self.output,self.offsets
+
+    def realization(self):
+        '''Realization of the noise of the last call, its replay on the same input gives the same output'''
+        return Realization(self.changes,self.draws,self.change_offsets,self.symbol_count)
+
     def generate_input_output(self,n=10,Pi =0,Pd =0,Ps = 0.2,bits=False):
         self.__init__()
         self.generate_sequence(n,bits)
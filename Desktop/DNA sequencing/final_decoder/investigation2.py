@@ -4,37 +4,34 @@ import pandas as pd
 from Trellis3D import Trellis3D
 from channel import channel
 from sparsifier import Sparsifier
+import sequences
+import trellis_stats
 import time
 from pprint import pprint
 import multiprocessing
 from progress_bar import progress_bar
 
 
-def overall_decoder(rate,z,k,n,ps,pti,ptd,return_list):
+def overall_decoder(rate,z,k,n,ps,pti,ptd,return_list,budget=None,realization=None):
 
     c = ldpc.code(standard='802.16' ,z=z,rate = rate)
     m = np.random.randint(0,2,c.K) #This is the message
 
 
     S = Sparsifier()
-    x = c.encode(m) #Codeword
-    codeword = ''.join([str(b) for b in x])
+    x = c.encode(m) #Codeword, kept as a bit array
 
-    #print(f'Length of codeword {len(codeword)}')
+    #print(f'Length of codeword {len(x)}')
 
 
 
 
-    sparse = S.sparsify(codeword,k,n)
+    sparse = S.sparsify(x,k,n)
 
 
-    watermark =  np.random.randint(0,4,len(sparse))
+    watermark =  np.random.randint(0,4,len(sparse),dtype=np.uint8)
 
-    transmitted = (sparse + watermark) % 4
-
-
-    bases_mapping = {0:'A', 1:'C', 2:'G', 3:'T'}
-    transmitted = [bases_mapping[q] for q  in transmitted]
+    transmitted = (sparse + watermark) % 4 # uint8 codes of A,C,G,T, see sequences.py
 
     #print(f'Length of transmitted {len(transmitted)}')
 
@@ -47,7 +44,10 @@ def overall_decoder(rate,z,k,n,ps,pti,ptd,return_list):
     PD = [0.0,0.5,ps]
     PS = [pti,ptd,ps]
 
-    recieved = C.bigram_channel(transmitted,PI=PI,PD=PD,PS=PS)
+    if realization is None:
+        recieved = C.array_bigram_channel(transmitted,PI=PI,PD=PD,PS=PS)
+    else:
+        recieved = realization.replay(transmitted) # Recorded noise, channel.Realization, to compare variants on the same errors
 
 
     #print(f'Length of received {len(recieved)}')
@@ -57,29 +57,18 @@ def overall_decoder(rate,z,k,n,ps,pti,ptd,return_list):
 
 
 
-    watermark = [bases_mapping[q] for q  in watermark]
-
-    Trellis3d = Trellis3D(sparse_distribution)
+    Trellis3d = Trellis3D(sparse_distribution,budget=budget)
 
 
-    transmitted_likelihoods = Trellis3d.forward_backward(watermark,recieved,PI=PI,PD=PD,PS=PS)
+    transmitted_likelihoods = Trellis3d.forward_backward(watermark,recieved,PI=PI,PD=PD,PS=PS,engine='auto')
 
     #pprint(transmitted_likelihoods)
 
-    type1 = 0
-    type2 = 0
-
-
-    for i in range(len(sparse)):
-
-        index_l = transmitted_likelihoods[i]
-        decoded = max(index_l,key = lambda x : index_l[x])
+    decoded = sequences.probabilities(transmitted_likelihoods).argmax(axis=1)
+    wrong = decoded != transmitted
 
-        if decoded != transmitted[i]:
-
-            if sparse[i] == 0 : type1 +=1
-
-            else: type2 += 1
+    type1 = (wrong & (sparse == 0)).sum()
+    type2 = (wrong & (sparse != 0)).sum()
     
 
 
@@ -92,19 +81,16 @@ def overall_decoder(rate,z,k,n,ps,pti,ptd,return_list):
 
 
 
-    codeword_estimate = ['0' if a>0 else '1' for a in app  ]
-    codeword_estimate = ''.join(codeword_estimate)
+    codeword_estimate = ~(app > 0) #Bit 1 unless the loglikelihood favours 0
 
 
     #print(codeword == codeword_estimate)
 
 
-    o = [a[0] == a[1] for a in zip(codeword,codeword_estimate)]
-
-    m_error = o.count(False) *100.0/ len(o)
+    m_error = (x != codeword_estimate).sum() *100.0/ len(x)
 
 
-    return_list.append((type1*100.0/len(sparse) , type2*100.0/len(sparse) , m_error))
+    return_list.append((type1*100.0/len(sparse) , type2*100.0/len(sparse) , m_error , Trellis3d.stats.as_dict()))
 
     return type1*100.0/len(sparse) , type2*100.0/len(sparse) , m_error
 
@@ -124,6 +110,7 @@ if __name__ == '__main__':
     return_dict = manager.dict()
     return_list = manager.list()
     cores = multiprocessing.cpu_count()
+    budget = None # Bytes each worker's Trellis may use, above it trellis_budget.choose switches to the band, checkpoints or the window
 
     rate = '1/2'
     z = 5
@@ -147,6 +134,9 @@ if __name__ == '__main__':
     m_averages = []
     m_sd = []
 
+    trellis_seconds = [] # Mean wall time of the Trellis decodes at each point
+    trellis_calls = [] # TrellisStats.as_dict() of every decode of the sweep
+
     start = time.time()
 
 
@@ -156,7 +146,7 @@ if __name__ == '__main__':
         processes = []
 
         for i in range(cores):
-            processes.append(multiprocessing.Process(target=overall_decoder, args=(rate,z,k,n,ps,pti,ptd,return_list)))
+            processes.append(multiprocessing.Process(target=overall_decoder, args=(rate,z,k,n,ps,pti,ptd,return_list,budget)))
 
         
         for process in processes:
@@ -180,6 +170,9 @@ if __name__ == '__main__':
         m_averages.append(np.mean(m_error_list))
         m_sd.append(np.std(m_error_list))
 
+        trellis_calls += [element[3] for element in return_list]
+        trellis_seconds.append(trellis_stats.aggregate([element[3] for element in return_list])['mean seconds'])
+
         #print(f't1 average of {np.mean(t1_list)} and standard deviation {np.std(t1_list)} for {t1_list}')
         #print(f't2 average of {np.mean(t2_list)} and standard deviation {np.std(t2_list)} for {t2_list}')
         #print(f'm error average of {np.mean(m_error_list)} for {m_error_list}')
@@ -199,6 +192,7 @@ if __name__ == '__main__':
     data['t2 standard deviation'] = t2_sd
     data['m error average'] = m_averages
     data['m standard deviation'] = m_sd
+    data['trellis seconds'] = trellis_seconds
     data['codeword_length'] = code_word_lengths
     #data['rates'] = rates
 
@@ -206,5 +200,9 @@ if __name__ == '__main__':
 
     data.to_csv('new_data.csv')
 
+    #Where the Trellis time goes over the whole sweep
+    summary = trellis_stats.aggregate(trellis_calls)
+    print({key:value for key,value in summary.items() if key.startswith('total') and key.endswith('seconds')})
+
     print(f'Time taken {time.time()-start}s')
 
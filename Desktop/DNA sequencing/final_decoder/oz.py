@@ -3,6 +3,8 @@ import numpy as np
 from Trellis3D import Trellis3D
 from channel import channel
 from sparsifier import Sparsifier
+import sequences
+from turbo import turbo_decode
 import time
 from pprint import pprint
 
@@ -16,26 +18,21 @@ S = Sparsifier()
 
 
 x = c.encode(m) #Codeword
-codeword = ''.join([str(b) for b in x])
 
-print(f'Length of codeword {len(codeword)}')
+print(f'Length of codeword {len(x)}')
 
 
 k,n = 4,4
 
-#pprint(codeword)
+#pprint(sequences.decode(x,sequences.BITS))
 
-sparse = S.sparsify(codeword,k,n)
+sparse = S.sparsify(x,k,n)
 
 print(sparse)
 
-watermark =  np.random.randint(0,4,len(sparse))
+watermark =  np.random.randint(0,4,len(sparse),dtype=np.uint8)
 
-transmitted = (sparse + watermark) % 4
-
-
-bases_mapping = {0:'A', 1:'C', 2:'G', 3:'T'}
-transmitted = [bases_mapping[q] for q  in transmitted]
+transmitted = (sparse + watermark) % 4 # uint8 codes of A,C,G,T, see sequences.py
 
 print(f'Length of transmitted {len(transmitted)}')
 
@@ -51,10 +48,10 @@ PI = [0.5,0.0,ps]
 PD = [0.0,0.5,ps]
 PS = [pti,ptd,ps]
 
-recieved = C.bigram_channel(transmitted,PI=PI,PD=PD,PS=PS)
+recieved = C.array_bigram_channel(transmitted,PI=PI,PD=PD,PS=PS)
 
 
-#print(recieved)
+#print(sequences.decode(recieved))
 print(f'Length of received {len(recieved)}')
 
 
@@ -63,36 +60,27 @@ sparse_distribution = S.substitution_distribution(k,n)
 #print('sparse distribution',sparse_distribution)
 
 
-watermark = [bases_mapping[q] for q  in watermark]
-#print('watermark',watermark)
+#print('watermark',sequences.decode(watermark))
 
 Trellis3d = Trellis3D(sparse_distribution)
 
 
-transmitted_likelihoods = Trellis3d.forward_backward(watermark,recieved,PI=PI,PD=PD,PS=PS)
-#print(f'Trellis likelihoods {transmitted_likelihoods}')
-
-
-codeword_likelihoods = S.decoder(transmitted_likelihoods,watermark,k,n)
-
-
-app,it = c.decode(codeword_likelihoods) #Output loglikelihoods
+#Trellis --> Sparsifier decoder --> LDPC, with the LDPC extrinsic information fed back to the Trellis
+app,iterations = turbo_decode(Trellis3d,S,c,watermark,recieved,PI,PD,PS,k,n,iterations=5) #Output loglikelihoods
+print(f'Turbo iterations {iterations}')
 
 
 
 
 #pprint(app)
 
-codeword_estimate = ['0' if a>0 else '1' for a in app  ]
-codeword_estimate = ''.join(codeword_estimate)
-
-#print(codeword_estimate)
+codeword_estimate = (~(app > 0)).astype(np.uint8) #Bit 1 unless the loglikelihood favours 0
 
-print(codeword == codeword_estimate)
+#print(sequences.decode(codeword_estimate,sequences.BITS))
 
+print((x == codeword_estimate).all())
 
-o = [a[0] == a[1] for a in zip(codeword,codeword_estimate)]
 
-print(o.count(True) *100.0/ len(o))
+print((x == codeword_estimate).sum() *100.0/ len(x))
 
-print(list(codeword_estimate[:len(m)])) # m estimate
\ No newline at end of file
+print(list(sequences.decode(codeword_estimate[:len(m)],sequences.BITS))) # m estimate
\ No newline at end of file
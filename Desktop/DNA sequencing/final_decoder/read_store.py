@@ -0,0 +1,131 @@
+'''On disk pool of reads, 2 bits per base and memory-mapped
+
+A store is a directory with
+    bases.bin    the reads packed 4 bases per byte (sequences.pack), every read starting on a new byte
+    index.npy    (R,2) int64 array, byte offset and number of bases of every read
+    <name>.npy   any other arrays saved with the reads, e.g. the strand each read came from
+
+The bases are opened with np.memmap, so store[r] is a PackedSequence over a view of the mapped file,
+nothing is read or copied until its codes are used, and the operating system shares the pages between
+all the processes that open the store. A ReadStore pickles as its path, so it can be passed to
+multiprocessing workers, which map the same file again.
+
+Generating a pool once and reusing it across decoder sweeps:
+
+    C = channel()
+    batches = (C.coverage_bigram_channel(transmitted,1000,PI,PD,PS) for _ in range(100))
+    store = read_store.write('pool',batches,transmitted=transmitted)
+    ...
+    store = ReadStore('pool')
+    probabilities = trellis.array_reads(watermark,store.reads(range(10)),PI,PD,PS)
+'''
+
+
+import os
+import numpy as np
+import sequences
+from sequences import PackedSequence
+
+
+class ReadStore:
+
+
+    def __init__(self,path):
+        self.path = path
+        self.index = np.load(os.path.join(path,'index.npy'))
+        size = os.path.getsize(os.path.join(path,'bases.bin'))
+        #np.memmap can not map an empty file
+        self.bases = np.memmap(os.path.join(path,'bases.bin'),dtype=np.uint8,mode='r') if size else np.zeros(0,dtype=np.uint8)
+
+        self.arrays = {} # Name : memory-mapped array saved with the reads
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.npy') and name != 'index.npy':
+                self.arrays[name[:-4]] = np.load(os.path.join(path,name),mmap_mode='r')
+
+    @property
+    def lengths(self):
+        return self.index[:,1]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self,r):
+        '''Read r as a PackedSequence over the mapped bytes, no copy'''
+        start,length = self.index[r]
+        return PackedSequence(self.bases[start:start + (length+3)//4],int(length))
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self[r]
+
+    def read(self,r):
+        '''uint8 codes of read r'''
+        return self[r].codes()
+
+    def reads(self,indexes):
+        '''uint8 codes of the reads of indexes, the reads argument of Trellis3D.array_reads'''
+        return [self.read(r) for r in indexes]
+
+    def concatenated(self,indexes=None):
+        '''(output, offsets) of the reads of indexes in the layout of channel.coverage_bigram_channel'''
+        if indexes is None: indexes = range(len(self))
+        codes = self.reads(indexes)
+        offsets = np.concatenate([[0],np.cumsum([len(c) for c in codes])]).astype(int)
+        return (np.concatenate(codes) if codes else np.zeros(0,dtype=np.uint8)), offsets
+
+    def __getstate__(self):
+        return {'path':self.path}
+
+    def __setstate__(self,state):
+        self.__init__(state['path'])
+
+    def __repr__(self):
+        return f'ReadStore({self.path} reads={len(self)} bases={int(self.lengths.sum())} bytes={len(self.bases)})'
+
+
+def pack_reads(output,offsets):
+    '''Packed bytes and (R,2) index of the reads output[offsets[r]:offsets[r+1]], every read padded to whole bytes'''
+    output = sequences.encode(output)
+    offsets = np.asarray(offsets,dtype=np.int64)
+    lengths = np.diff(offsets)
+    starts = np.concatenate([[0],np.cumsum((lengths+3)//4)])
+
+    #Base j of read r goes to symbol 4*starts[r] + j - offsets[r] of the padded reads
+    destination = np.arange(len(output)) + np.repeat(4*starts[:-1] - offsets[:-1],lengths)
+    padded = np.zeros(4*starts[-1],dtype=np.uint8)
+    padded[destination] = output
+
+    return sequences.pack(padded), np.stack([starts[:-1],lengths],axis=1)
+
+
+def write(path,batches,**arrays):
+    '''Writes the reads of batches, (output, offsets) pairs or lists of sequences, to a new store at path
+
+    The batches are packed and written one at a time, so a generator of channel calls can write a pool
+    larger than the memory. arrays are saved next to the reads. Returns the opened ReadStore'''
+    if os.path.isdir(path) and os.listdir(path): raise ValueError(f'The store is written to a new or empty directory, recieved {path}')
+    if 'index' in arrays: raise ValueError('index is the name of the read index, recieved an array named index')
+    os.makedirs(path,exist_ok=True)
+    index = []
+    written = 0
+
+    with open(os.path.join(path,'bases.bin'),'wb') as f:
+        for batch in batches:
+            if isinstance(batch,tuple):
+                output,offsets = batch
+            else:
+                codes = [sequences.encode(read) for read in batch]
+                output = np.concatenate(codes) if codes else np.zeros(0,dtype=np.uint8)
+                offsets = np.concatenate([[0],np.cumsum([len(c) for c in codes])])
+
+            packed,batch_index = pack_reads(output,offsets)
+            batch_index[:,0] += written
+            f.write(packed.tobytes())
+            written += len(packed)
+            index.append(batch_index)
+
+    np.save(os.path.join(path,'index.npy'),np.concatenate(index) if index else np.zeros((0,2),dtype=np.int64))
+    for name,array in arrays.items():
+        np.save(os.path.join(path,f'{name}.npy'),np.asarray(array))
+
+    return ReadStore(path)
@@ -0,0 +1,124 @@
+'''Canonical form of the sequences of the decoder, uint8 arrays of symbol codes
+
+A, C, G, T are 0, 1, 2, 3 (the base_mapping of Trellis3D, Sparsifier and channel), bits are 0, 1 and
+sparse symbols 0 ... 3. channel, Trellis3D, Sparsifier and turbo_decode take these arrays directly.
+Letters, bit strings and lists are only converted at the edges, by encode() and decode() through a
+256 entry lookup table of the bytes instead of a dictionary lookup per symbol.
+
+PackedSequence holds the same codes 2 bits each, 4 symbols per byte, for storing many reads
+(read_store.py keeps them on disk), encode() unpacks it so it can go anywhere a sequence goes.
+'''
+
+
+import numpy as np
+
+
+BASES = 'ACGT'
+BITS = '01'
+
+TABLES = {} # Alphabet : 256 entry lookup of the code of every byte
+
+
+def table(alphabet):
+    '''Lookup of the code of every byte of alphabet, 255 for the bytes outside it'''
+    if alphabet not in TABLES:
+        lookup = np.full(256,255,dtype=np.uint8)
+        lookup[np.frombuffer(alphabet.encode('ascii'),dtype=np.uint8)] = np.arange(len(alphabet))
+        TABLES[alphabet] = lookup
+    return TABLES[alphabet]
+
+
+def encode(sequence,alphabet=BASES):
+    '''uint8 codes of a str or list of letters of alphabet, integer arrays and lists are taken as codes already'''
+    if isinstance(sequence,PackedSequence): return sequence.codes()
+
+    if isinstance(sequence,np.ndarray):
+        if sequence.dtype == np.uint8: return sequence
+        if sequence.dtype.kind in 'iub': return sequence.astype(np.uint8)
+        sequence = ''.join(sequence.tolist())
+
+    elif not isinstance(sequence,str):
+        sequence = list(sequence)
+        if sequence and not isinstance(sequence[0],str): return np.array(sequence,dtype=np.uint8)
+        sequence = ''.join(sequence)
+
+    codes = table(alphabet)[np.frombuffer(sequence.encode('ascii'),dtype=np.uint8)]
+    if (codes == 255).any(): raise ValueError(f'Sequence has symbols outside {alphabet}, recieved {sequence[:20]}')
+    return codes
+
+
+def decode(codes,alphabet=BASES):
+    '''str of the letters of the codes, for printing and the letter based code'''
+    letters = np.frombuffer(alphabet.encode('ascii'),dtype=np.uint8)
+    return letters[np.asarray(codes)].tobytes().decode('ascii')
+
+
+def probabilities(likelihoods):
+    '''(N,4) A,C,G,T array of Trellis3D likelihoods {0: {'A': pA, ... 'T': pT}, 1: {}, ...}, arrays are kept'''
+    if isinstance(likelihoods,np.ndarray): return likelihoods
+    return np.array([[likelihoods[i][base] for base in BASES] for i in range(len(likelihoods))])
+
+
+SHIFTS = np.array([0,2,4,6],dtype=np.uint8)
+
+
+def pack(codes):
+    '''uint8 array of the codes 4 per byte, the first code in the lowest 2 bits, the last byte padded with 0'''
+    codes = encode(codes)
+    if (codes > 3).any(): raise ValueError(f'Only codes 0 ... 3 can be packed, recieved {codes.max()}')
+
+    padded = np.zeros(4*((len(codes)+3)//4),dtype=np.uint8)
+    padded[:len(codes)] = codes
+    return np.bitwise_or.reduce(padded.reshape(-1,4) << SHIFTS,axis=1).astype(np.uint8)
+
+
+def unpack(packed,length):
+    '''The first length uint8 codes of a packed array'''
+    packed = np.asarray(packed,dtype=np.uint8)
+    return ((packed[:,None] >> SHIFTS) & 3).reshape(-1)[:length]
+
+
+class PackedSequence:
+    '''Sequence of codes 0 ... 3 stored 2 bits per symbol, a quarter of the uint8 codes
+
+    PackedSequence(sequence) packs a sequence, PackedSequence(packed,length) wraps packed bytes
+    without copying them, e.g. a slice of the memory-mapped bases of a ReadStore'''
+
+
+    def __init__(self,sequence,length=None):
+        if length is None:
+            codes = encode(sequence)
+            sequence,length = pack(codes),len(codes)
+
+        if len(sequence) != (length+3)//4: raise ValueError(f'{length} symbols need {(length+3)//4} bytes, recieved {len(sequence)}')
+        self.packed = sequence
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def codes(self):
+        '''uint8 codes of the whole sequence'''
+        return unpack(self.packed,self.length)
+
+    def __getitem__(self,index):
+        '''Code of symbol index, or uint8 codes of a slice, only the bytes it covers are unpacked'''
+        if isinstance(index,slice):
+            start,stop,step = index.indices(self.length)
+            if step != 1 or stop <= start: return self.codes()[index]
+            return unpack(self.packed[start//4:(stop+3)//4],stop - start//4*4)[start % 4:]
+
+        if index < 0: index += self.length
+        if not 0 <= index < self.length: raise IndexError(f'Index {index} out of a sequence of length {self.length}')
+        return (int(self.packed[index//4]) >> (2*(index % 4))) & 3
+
+    def __array__(self,dtype=None,copy=None):
+        codes = self.codes()
+        return codes if dtype is None else codes.astype(dtype)
+
+    def __eq__(self,other):
+        return np.array_equal(self.codes(),encode(other))
+
+    def __repr__(self):
+        letters = decode(self[:20])
+        return f"PackedSequence({letters}{'...' if self.length > 20 else ''} length={self.length})"
@@ -1,5 +1,6 @@
 import itertools
 import numpy as np
+import sequences
 from pprint import pprint
 
 
@@ -83,10 +84,18 @@ class Sparsifier:
         return sparse_sequence
 
     def sparsify(self,codeword,k,n):
-        """Creates the k --> n mapping and maps the codeword onto a sparse sequence"""
+        """Creates the k --> n mapping and maps the codeword (a '0'/'1' str or a bit array) onto a sparse
+        sequence of uint8 codes"""
         self.create_mapping(k,n)
+        if not isinstance(codeword,str): codeword = sequences.decode(codeword,sequences.BITS)
 
-        return np.array([int(q) for q in self.map(codeword,k)])
+        return sequences.encode(''.join(self.map(codeword,k)),'0123')
+
+    def code_arrays(self):
+        """(2**k,k) bits and (2**k,n) sparse symbols of every k bit sequence of the mapping, as integer arrays"""
+        codes = np.array([[int(b) for b in code] for code in self.mapping],dtype=int)
+        patterns = np.array([[int(q) for q in sparse] for sparse in self.mapping.values()],dtype=int)
+        return codes, patterns
 
     def substitution_distribution(self,k,n):
         """Returns the probability distribution for the transmission/substitution 
@@ -102,52 +111,52 @@ class Sparsifier:
         
         return self.substitutions
 
-    def decoder(self,transmitted_likelihoods,watermark,k,n):
-        """Use the likelihoods from the sparse vector to compute loglikelihoods of the codeword bits"""
+    def symbol_priors(self,llrs,k,n):
+        """Converts loglikelihoods log(p0/p1) of the codeword bits (e.g. LDPC extrinsic information) into
+        priors of the sparse symbols, an (len(llrs)/k * n, 4) array -- replaces the substitution distribution
+        of each index in the Trellis for the next iteration"""
 
-        """Look at values - the sparse sequences and for each choice loop through and do a product rule using self.substitutions"""
-        
-        codeword_likelihoods = []
-       
+        codes,patterns = self.code_arrays()
 
-        #Jumping each n codewords
-        for i in range(0,len(transmitted_likelihoods),n):
-            
-            p_ones = np.zeros(k)
-            p_zeros = np.zeros(k)
+        llrs = np.reshape(llrs,(-1,k))
 
-            log_liklihoods =[]
+        #log P(bit) of every bit of every k bit sequence, product over the bits for each sequence
+        log_zero = -np.logaddexp(0,-llrs)
+        log_one = -np.logaddexp(0,llrs)
+        log_codes = np.where(codes[None] == 0,log_zero[:,None,:],log_one[:,None,:]).sum(axis=-1)
 
-            for code,sparse in self.mapping.items():
-            
-                prob = 1
+        p_codes = np.exp(log_codes - log_codes.max(axis=1,keepdims=True))
+        p_codes /= p_codes.sum(axis=1,keepdims=True)
 
-                
+        #Sum over the sequences that put symbol q at each of the n indices
+        priors = np.stack([p_codes @ (patterns == q) for q in range(4)],axis=-1)
 
-                for j,q in enumerate(sparse):
-                    w_j = self.base_mapping[watermark[i+j]]
-                    t_j = (w_j + int(q))%4
-                    prob *= transmitted_likelihoods[i+j][self.q_mapping[t_j]]
-    
-                
-        
-                for l,b in enumerate(code):
-                    if b == '0': p_zeros[l] += prob
-                    elif b == '1': p_ones[l] += prob
-            '''
-            for p0,p1 in zip(p_zeros,p_ones):
-                if p0==0 and p1==0 : log_liklihoods.append(0)
+        return priors.reshape(-1,4)
+
+    def decoder(self,transmitted_likelihoods,watermark,k,n):
+        """Use the likelihoods from the sparse vector to compute loglikelihoods of the codeword bits
 
-                elif p0 == 0: log_liklihoods.append(float('-infinity'))
+        transmitted_likelihoods is the Trellis3D dictionary or an (N,4) A,C,G,T array and watermark
+        letters or uint8 codes. For every block of n indices the probability of each sparse sequence
+        is the product of the likelihoods of the symbols it and the watermark give, summed over the
+        k bit sequences with a 0 or a 1 at each bit"""
 
-                elif p1 == 0: log_liklihoods.append(float('infinity'))
+        probabilities = sequences.probabilities(transmitted_likelihoods)
+        watermark = sequences.encode(watermark).astype(int)
+        codes,patterns = self.code_arrays()
 
-                else: log_liklihoods.append(np.log(p0/p1))
-            '''
-            log_liklihoods = np.log(np.array(p_zeros) / np.array(p_ones))
-            codeword_likelihoods.extend(log_liklihoods)
-        
-        return np.array(codeword_likelihoods)
+        blocks = len(probabilities) // n
+        probabilities = probabilities[:blocks*n].reshape(blocks,n,4)
+        watermark = watermark[:blocks*n].reshape(blocks,n)
+
+        #(blocks,2**k,n) transmitted symbol of every sparse sequence at every index of every block
+        symbols = (watermark[:,None,:] + patterns[None,:,:]) % 4
+        prob = np.take_along_axis(probabilities[:,None,:,:],symbols[...,None],axis=3)[...,0].prod(axis=2)
+
+        p_zeros = prob @ (codes == 0)
+        p_ones = prob @ (codes == 1)
+
+        return np.log(p_zeros / p_ones).ravel()
                 
             
 
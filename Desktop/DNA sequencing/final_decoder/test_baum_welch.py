@@ -0,0 +1,43 @@
+import numpy as np
+from Trellis3D import Trellis3D
+from channel import channel
+
+
+def reads(PI,PD,PS,count=150,n=200,seed=0):
+    rng = np.random.default_rng(seed)
+    c = channel()
+    strands = [rng.integers(0,4,n).astype(np.uint8) for r in range(count)]
+    return [(strand,c.array_bigram_channel(strand,PI,PD,PS,rng=rng)) for strand in strands]
+
+
+def test_baum_welch_recovers_channel():
+    #Each list is Pi, Pd, Ps of leaving one depth, no deletion right after an insertion or insertion after
+    #a deletion (passed as 0) and Ps tied to a substitution probability of 0.05 of the transmissions
+    PI,PD,PS = [0.1,0.0,0.05*0.9],[0.0,0.1,0.05*0.9],[0.03,0.03,0.05*0.94]
+    pairs = reads(PI,PD,PS)
+
+    trellis = Trellis3D({0:{'0':1,'1':0,'2':0,'3':0}})
+    fit_PI,fit_PD,fit_PS = trellis.baum_welch(pairs,[0.2,0.0,0.01],[0.0,0.2,0.01],[0.01,0.01,0.01],iterations=30,max_drift=40)
+
+    assert fit_PI[1] == 0 and fit_PD[0] == 0
+    for fit,true in [(fit_PI[0],PI[0]),(fit_PD[1],PD[1]),(fit_PS[0],PS[0]),(fit_PS[1],PS[1])]:
+        assert abs(fit - true) < 0.015
+    assert abs(fit_PS[2] / (1 - fit_PS[0] - fit_PS[1]) - 0.05) < 0.01
+    assert abs(fit_PI[2] - PI[2]) < 0.02 and abs(fit_PD[2] - PD[2]) < 0.02
+
+    likelihoods = [history[0] for history in trellis.fit_history]
+    assert (np.diff(likelihoods) > -1e-6*abs(likelihoods[0])).all()
+
+
+def test_baum_welch_substitution_per_depth():
+    #The channel of data.py, the loop channel rounds Pt to 0.5 after an insertion or deletion so Ps is 0.02/1.02 there
+    PI,PD,PS = [0.5,0.0,0.02],[0.0,0.5,0.02],[0.035,0.035,0.02]
+    pairs = reads(PI,PD,PS,count=300,seed=1)
+
+    trellis = Trellis3D({0:{'0':1,'1':0,'2':0,'3':0}})
+    fit_PI,fit_PD,fit_PS = trellis.baum_welch(pairs,[0.2,0.0,0.01],[0.0,0.2,0.01],[0.01,0.01,0.01],iterations=30,max_drift=30)
+
+    for fit,true in [(fit_PI[0],0.5/1.02),(fit_PD[1],0.5/1.02),(fit_PS[0],0.035/0.99),(fit_PS[1],0.035/0.99)]:
+        assert abs(fit - true) < 0.03
+    for fit,true in [(fit_PI[2],0.02/1.02),(fit_PD[2],0.02/1.02),(fit_PS[2],0.02/0.99)]:
+        assert abs(fit - true) < 0.005
@@ -0,0 +1,122 @@
+import pytest
+import random
+import numpy as np
+import sequences
+from channel import channel, Realization, markov_events, INSERT, DELETE
+
+
+PI,PD,PS = [0.5,0.0,0.1],[0.0,0.5,0.1],[0.1,0.1,0.1]
+
+
+def call(c,method,sequence,rng):
+    if method == 'channel': c.channel(sequence,0.1,0.1,0.1)
+    elif method == 'bigram_channel': c.bigram_channel(sequence,PI,PD,PS)
+    elif method == 'array_channel': c.array_channel(sequence,0.1,0.1,0.1,rng=rng)
+    elif method == 'array_bigram_channel': c.array_bigram_channel(sequence,PI,PD,PS,rng=rng)
+    return sequences.encode(c.output)
+
+
+@pytest.mark.parametrize("method", ['channel','bigram_channel','array_channel','array_bigram_channel'])
+def test_change_log_of_last_call(method):
+    random.seed(0)
+    rng = np.random.default_rng(0)
+    c = channel()
+    for n in [50,80]:
+        sequence = rng.integers(0,4,n).astype(np.uint8)
+        output = call(c,method,sequence,rng)
+
+        #The log only holds this call, it consumes the whole input and emits the whole output
+        assert (c.changes != INSERT).sum() == n and (c.changes != DELETE).sum() == len(output)
+        assert len(c.draws) == len(c.changes)
+        assert c.offsets is None and c.change_offsets is None
+
+
+@pytest.mark.parametrize("method", ['channel','bigram_channel','array_channel','array_bigram_channel'])
+def test_realization_replay(method,tmp_path):
+    random.seed(1)
+    rng = np.random.default_rng(1)
+    c = channel()
+    sequence = rng.integers(0,4,100).astype(np.uint8)
+    output = call(c,method,sequence,rng)
+
+    realization = c.realization()
+    assert len(realization) == len(sequence)
+    assert np.array_equal(realization.replay(sequence),output)
+
+    #The same noise on another input: substitutions shift it, insertions are the drawn symbols
+    other = (sequence + 1) % 4
+    replayed = realization.replay(other)
+    kept = realization.changes[realization.changes != DELETE]
+    assert len(replayed) == len(output)
+    assert np.array_equal(replayed[kept == INSERT],output[kept == INSERT])
+    assert np.array_equal(replayed[kept != INSERT],(output[kept != INSERT] + 1) % 4)
+
+    realization.save(tmp_path / 'noise.npz')
+    assert np.array_equal(Realization.load(tmp_path / 'noise.npz').replay(sequence),output)
+
+    with pytest.raises(ValueError): realization.replay(sequence[:-1])
+
+
+def test_coverage_realization_replay():
+    rng = np.random.default_rng(2)
+    c = channel()
+    sequence = rng.integers(0,4,60).astype(np.uint8)
+    output,offsets = c.coverage_bigram_channel(sequence,5,PI,PD,PS,rng=rng)
+
+    replayed,replayed_offsets = c.realization().replay(sequence)
+    assert np.array_equal(replayed,output) and np.array_equal(replayed_offsets,offsets)
+
+
+def frequencies(changes,expected):
+    '''Checks the event and event to event frequencies of a change log against expected[previous event] within 5 sigma'''
+    pairs = np.bincount(4*changes[:-1].astype(int) + changes[1:],minlength=16).reshape(4,4)
+    previous = pairs.sum(axis=1)
+    events = np.bincount(changes,minlength=4) / len(changes)
+
+    #Stationary distribution of the chain of events
+    stationary = np.linalg.matrix_power(expected,64)[0]
+    assert (np.abs(events - stationary) < 5*np.sqrt(stationary*(1 - stationary)/len(changes)) + 1e-12).all()
+    assert (np.abs(pairs / previous[:,None] - expected) <= 5*np.sqrt(expected*(1 - expected)/previous[:,None])).all()
+
+
+@pytest.mark.parametrize("method", ['channel','bigram_channel','array_channel','array_bigram_channel'])
+def test_channel_statistics(method):
+    random.seed(3)
+    rng = np.random.default_rng(3)
+    c = channel()
+    sequence = rng.integers(0,4,20000).astype(np.uint8)
+    output = call(c,method,sequence,rng)
+
+    #Next event distribution after every event, the bigram channel draws from the list of the depth it left
+    if 'bigram' in method:
+        weights = np.array([[round(1 - Pi - Pd - Ps,1),Ps,Pi,Pd] for Pi,Pd,Ps in (PS,PS,PI,PD)])
+    else:
+        weights = np.tile([0.7,0.1,0.1,0.1],(4,1))
+    frequencies(c.changes,weights / weights.sum(axis=1,keepdims=True))
+
+    #Substitutions add 1 ... 3 and insertions draw any symbol, uniformly
+    for event,low in [(1,1),(INSERT,0)]:
+        draws = np.bincount(c.draws[c.changes == event],minlength=4)[low:]
+        assert (np.abs(draws / draws.sum() - 1/len(draws)) < 5*np.sqrt(1/draws.sum())).all()
+    assert np.array_equal(c.realization().replay(sequence),output)
+
+
+def test_markov_events_matches_loop():
+    rng = np.random.default_rng(4)
+    weights = rng.random((3,4)) * (rng.random((3,4)) > 0.2)
+    weights[:,0] += 0.1
+    cumulative = np.cumsum(weights / weights.sum(axis=1,keepdims=True),axis=1)
+    following = np.array([0,0,1,2])
+    uniforms = rng.random((5,333))
+    state = rng.integers(0,3,5)
+
+    events,last = markov_events(cumulative,following,uniforms,state)
+
+    #The same uniforms drawn one event at a time
+    for r in range(5):
+        current = state[r]
+        for k in range(uniforms.shape[1]):
+            event = min(int((uniforms[r,k] >= cumulative[current]).sum()),3)
+            assert events[r,k] == event
+            current = following[event]
+        assert last[r] == current
@@ -0,0 +1,68 @@
+import pytest
+import os
+import pickle
+import numpy as np
+import sequences
+import read_store
+from sequences import PackedSequence
+from read_store import ReadStore
+
+
+@pytest.mark.parametrize("length", [0,1,3,4,5,17,100])
+def test_pack_unpack(length):
+    codes = np.random.default_rng(length).integers(0,4,length).astype(np.uint8)
+    packed = sequences.pack(codes)
+    assert len(packed) == (length+3)//4
+    assert np.array_equal(sequences.unpack(packed,length),codes)
+
+
+def test_packed_sequence():
+    codes = np.random.default_rng(0).integers(0,4,23).astype(np.uint8)
+    sequence = PackedSequence(codes)
+
+    assert len(sequence) == 23 and sequence == codes
+    assert sequence == sequences.decode(codes)
+    assert np.array_equal(np.asarray(sequence),codes)
+    assert [sequence[i] for i in range(23)] == codes.tolist() and sequence[-1] == codes[-1]
+    for start,stop,step in [(0,23,1),(3,9,1),(5,6,1),(8,8,1),(1,20,3),(20,2,-2)]:
+        assert np.array_equal(sequence[start:stop:step],codes[start:stop:step])
+    with pytest.raises(IndexError): sequence[23]
+
+    #Wrapping packed bytes does not copy them
+    assert PackedSequence(sequence.packed,23).packed is sequence.packed
+    with pytest.raises(ValueError): PackedSequence(sequence.packed,30)
+    with pytest.raises(ValueError): sequences.pack([0,1,4])
+
+
+def test_read_store_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    batches = []
+    for lengths in [[5,0,9],[4,13]]:
+        reads = [rng.integers(0,4,n).astype(np.uint8) for n in lengths]
+        batches.append(reads)
+    batches[1] = (np.concatenate(batches[1]),np.array([0,4,17]))
+    expected = batches[0] + [batches[1][0][:4],batches[1][0][4:]]
+    strands = np.arange(5)
+
+    store = read_store.write(str(tmp_path / 'pool'),iter(batches),strands=strands)
+    assert len(store) == 5 and store.lengths.tolist() == [5,0,9,4,13]
+    assert all(np.array_equal(store.read(r),read) for r,read in enumerate(expected))
+    assert store[2] == expected[2]
+    assert np.array_equal(store.arrays['strands'],strands)
+
+    output,offsets = store.concatenated([4,0])
+    assert np.array_equal(output,np.concatenate([expected[4],expected[0]])) and offsets.tolist() == [0,13,18]
+
+    again = pickle.loads(pickle.dumps(store))
+    assert all(np.array_equal(again.read(r),read) for r,read in enumerate(expected))
+
+
+def test_read_store_write_checks(tmp_path):
+    with pytest.raises(ValueError): read_store.write(str(tmp_path / 'pool'),[[[0,1,2]]],index=np.zeros(1))
+    assert not os.path.exists(tmp_path / 'pool')
+
+    read_store.write(str(tmp_path / 'pool'),[[[0,1,2]]])
+    with pytest.raises(ValueError): read_store.write(str(tmp_path / 'pool'),[[[0,1,2]]])
+
+    assert len(ReadStore(str(tmp_path / 'pool'))) == 1
+    assert len(read_store.write(str(tmp_path / 'empty'),[])) == 0
@@ -0,0 +1,315 @@
+import pytest
+import random
+import numpy as np
+import sequences
+import trellis_arrays
+import trellis_stream
+from Trellis3D import Trellis3D
+from sparsifier import Sparsifier
+from channel import channel
+
+
+def case(k,n,blocks,seed=0,ps=0.02,pti=0.05,ptd=0.05):
+    '''Sparse distribution, watermark, read and channel of a small random codeword'''
+    random.seed(seed)
+    rng = np.random.default_rng(seed)
+    sparsifier = Sparsifier()
+    sparse = sparsifier.sparsify(rng.integers(0,2,k*blocks).astype(np.uint8),k,n)
+    watermark = rng.integers(0,4,len(sparse)).astype(np.uint8)
+    PI,PD,PS = [0.5,0.0,ps],[0.0,0.5,ps],[pti,ptd,ps]
+    recieved = channel().bigram_channel((sparse + watermark) % 4,PI,PD,PS)
+    return sparsifier.substitution_distribution(k,n),watermark,recieved,PI,PD,PS
+
+
+def array(likelihoods):
+    return np.array([[likelihoods[i][symbol] for symbol in 'ACGT'] for i in sorted(likelihoods)])
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_array_engine_matches_dict(seed):
+    table,watermark,recieved,PI,PD,PS = case(4,5,4,seed)
+    exact = Trellis3D(table)
+    expected = array(exact.forward_backward(watermark,recieved,PI,PD,PS))
+
+    trellis = Trellis3D(table)
+    assert np.allclose(array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array')),expected,atol=1e-12)
+
+
+@pytest.mark.parametrize("length", [0,1])
+def test_array_engine_short_reads(length):
+    table,watermark,recieved,PI,PD,PS = case(4,5,2)
+    expected = array(Trellis3D(table).forward_backward(watermark,recieved[:length],PI,PD,PS))
+    assert np.allclose(array(Trellis3D(table).forward_backward(watermark,recieved[:length],PI,PD,PS,engine='array')),expected,atol=1e-12)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_band(seed):
+    table,watermark,recieved,PI,PD,PS = case(4,5,8,seed)
+    trellis = Trellis3D(table)
+    expected = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array'))
+    full = trellis.log_likelihood
+
+    #A band wider than the lattice loses nothing
+    wide = len(watermark) + len(recieved)
+    assert np.allclose(array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=wide)),expected,atol=1e-12)
+    assert trellis.band_loss == 0
+
+    #band_loss is the share of the likelihood carried by the paths that leave the band, 1 - P_band / P
+    drift = abs(len(watermark) - len(recieved))
+    losses = []
+    for W in [drift+6,drift+3,drift+1]:
+        trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=W)
+        losses.append(float(trellis.band_loss))
+        assert np.isclose(trellis.band_loss,1 - np.exp(trellis.log_likelihood - full),rtol=1e-6,atol=1e-12)
+
+        trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=W,checkpoint=True)
+        assert np.isclose(trellis.band_loss,losses[-1],rtol=1e-9,atol=1e-15)
+    assert 0 < losses[0] <= losses[1] <= losses[2] <= 1
+
+
+@pytest.mark.parametrize("lag,block", [(None,None),(100,7),(100,1)])
+def test_windowed_matches_band(lag,block):
+    table,watermark,recieved,PI,PD,PS = case(4,5,8,1)
+    W = abs(len(watermark) - len(recieved)) + 6
+    trellis = Trellis3D(table)
+    expected = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=W))
+
+    #A long enough lag (the default 4*max_drift here) gives the banded likelihoods
+    windowed = list(trellis.windowed_forward_backward(watermark,recieved,PI,PD,PS,W,lag,block))
+    assert [i for i,likelihoods in windowed] == list(range(len(watermark)))
+    assert np.allclose(array(dict(windowed)),expected,atol=1e-12)
+
+    #A short lag is approximate
+    short = array(dict(trellis.windowed_forward_backward(watermark,recieved,PI,PD,PS,W,lag=24,block=5)))
+    assert np.abs(short - expected).max() < 0.05
+
+
+@pytest.mark.parametrize("checkpoint", [True,1,3,1000])
+@pytest.mark.parametrize("band", [None,6])
+def test_checkpoint_matches_array(checkpoint,band):
+    table,watermark,recieved,PI,PD,PS = case(4,5,6,2)
+    max_drift = None if band is None else abs(len(watermark) - len(recieved)) + band
+    trellis = Trellis3D(table)
+    expected = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=max_drift))
+    log_likelihood,band_loss = trellis.log_likelihood,trellis.band_loss
+
+    likelihoods = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=max_drift,checkpoint=checkpoint))
+    assert np.allclose(likelihoods,expected,atol=1e-12)
+    assert np.isclose(trellis.log_likelihood,log_likelihood) and np.isclose(trellis.band_loss,band_loss)
+    assert trellis.alphas is None and trellis.betas is None
+
+
+def paths(table,watermark,recieved,PI,PD,PS):
+    '''Every edit path through the Trellis by brute force, (operations, probability) pairs'''
+    insertion = [P[0] for P in (PS,PI,PD)] # Leaving the T, I and D planes
+    deletion = [P[1] for P in (PS,PI,PD)]
+    transmission = [1 - P[0] - P[1] for P in (PS,PI,PD)]
+    watermark,recieved = sequences.encode(watermark),sequences.encode(recieved)
+    N,M = len(watermark),len(recieved)
+    found = []
+
+    def walk(i,j,plane,operations,probability):
+        if (i,j) == (N,M): found.append((operations,probability))
+        if j < M: walk(i,j+1,1,operations + ['insert'],probability*insertion[plane])
+        if i < N: walk(i+1,j,2,operations + ['delete'],probability*deletion[plane])
+        if i < N and j < M:
+            gamma = table[i % len(table),(int(recieved[j]) - int(watermark[i])) % 4]
+            operation = 'transmit' if recieved[j] == watermark[i] else 'substitute'
+            walk(i+1,j+1,0,operations + [operation],probability*transmission[plane]*gamma)
+
+    walk(0,0,0,[],1.0)
+    return found
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_viterbi_matches_brute_force(seed):
+    table,watermark,recieved,PI,PD,PS = case(2,3,2,seed)
+    trellis = Trellis3D(table)
+    found = paths(trellis.table,watermark,recieved,PI,PD,PS)
+
+    #Sum-product over every path is the likelihood of the forward recursion
+    trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array')
+    assert np.isclose(np.log(sum(probability for operations,probability in found)),trellis.log_likelihood)
+
+    #Max-product is the best path, its probability and the path itself (up to ties)
+    path,log_probability = trellis.viterbi(watermark,recieved,PI,PD,PS)
+    best = max(probability for operations,probability in found)
+    assert np.isclose(log_probability,np.log(best))
+    operations = [trellis_arrays.OPERATIONS[code] for code in path]
+    assert np.isclose(dict((tuple(o),p) for o,p in found)[tuple(operations)],best)
+
+
+def test_viterbi_band_matches_brute_force():
+    table,watermark,recieved,PI,PD,PS = case(2,3,2,0)
+    W = abs(len(watermark) - len(recieved)) + 1
+    trellis = Trellis3D(table)
+
+    #Only the paths that stay in the band
+    def inside(operations):
+        i = j = 0
+        for operation in operations:
+            i += operation != 'insert'
+            j += operation != 'delete'
+            if abs(j - i) > W: return False
+        return True
+
+    best = max(probability for operations,probability in paths(trellis.table,watermark,recieved,PI,PD,PS) if inside(operations))
+    path,log_probability = trellis.viterbi(watermark,recieved,PI,PD,PS,max_drift=W)
+    assert np.isclose(log_probability,np.log(best))
+    assert inside([trellis_arrays.OPERATIONS[code] for code in path])
+
+
+def test_beam():
+    table,watermark,recieved,PI,PD,PS = case(4,5,8,3)
+    trellis = Trellis3D(table)
+    expected = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array'))
+
+    #Pruning nothing gives the exact recursions
+    assert np.allclose(array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',beam=1e-300)),expected,atol=1e-12)
+    assert trellis.pruned_mass == 0 and not trellis.beam_fallback
+
+    #pruned_mass is the share of the likelihood carried by the dropped paths, 1 - P_beam / P
+    full = trellis.log_likelihood
+    for beam in [1e-6,1e-4,1e-3]:
+        likelihoods = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',beam=beam,tolerance=1))
+        assert 0 < trellis.pruned_mass < 1e-2 and not trellis.beam_fallback
+        assert np.isclose(trellis.pruned_mass,1 - np.exp(trellis.log_likelihood - full),rtol=0.1)
+        assert np.abs(likelihoods - expected).max() < 2*trellis.pruned_mass
+
+    #Above tolerance the exact recursions are run instead
+    likelihoods = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',beam=1e-3))
+    assert 1e-4 < trellis.pruned_mass <= 1 and trellis.beam_fallback
+    assert np.allclose(likelihoods,expected,atol=1e-12)
+
+
+@pytest.mark.parametrize("chunks", [[1000],[1,2,3,5,8,13,1000],[1]*1000])
+def test_stream_matches_array(chunks):
+    table,watermark,recieved,PI,PD,PS = case(4,5,4,0)
+    trellis = Trellis3D(table)
+    expected = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array'))
+
+    trellis.start_read(watermark,PI,PD,PS)
+    start = 0
+    for size in chunks:
+        if start >= len(recieved): break
+        trellis.extend_read(recieved[start:start+size])
+        start += size
+
+        #Likelihoods of a partial read are probabilities too
+        partial = array(trellis.stream_likelihoods())
+        assert np.allclose(partial.sum(axis=1),1)
+
+    assert np.allclose(array(trellis.stream_likelihoods(complete=True)),expected,atol=1e-12)
+
+
+def test_stream_needs_start():
+    with pytest.raises(ValueError): Trellis3D(case(4,5,1)[0]).extend_read([0,1])
+
+
+@pytest.mark.parametrize("threads,tile", [(1,1),(3,1),(3,7),(2,8192)])
+@pytest.mark.parametrize("max_drift,checkpoint", [(None,None),(12,None),(None,4)])
+def test_wavefront_matches_array(threads,tile,max_drift,checkpoint):
+    table,watermark,recieved,PI,PD,PS = case(4,5,6,0)
+    expected = Trellis3D(table)
+    likelihoods = array(expected.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=max_drift,checkpoint=checkpoint))
+
+    with Trellis3D(table,threads=threads,tile=tile) as trellis:
+        pool = trellis.wavefront.pool
+        assert (pool is None) == (threads == 1)
+        assert np.allclose(array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=max_drift,checkpoint=checkpoint)),likelihoods,atol=1e-15)
+        assert np.isclose(trellis.log_likelihood,expected.log_likelihood)
+
+    #Leaving the with block shuts the threads down
+    assert trellis.wavefront is None
+    if pool is not None:
+        with pytest.raises(RuntimeError): pool.submit(int)
+
+
+@pytest.mark.parametrize("max_drift,batch", [(None,32),(20,2),(None,1)])
+def test_batch_matches_array(max_drift,batch):
+    cases = [case(4,5,blocks,seed) for seed,blocks in enumerate([2,3,3,4,6])]
+    table,PI,PD,PS = cases[0][0],cases[0][3],cases[0][4],cases[0][5]
+    trellis = Trellis3D(table)
+    likelihoods = trellis.batch_forward_backward([(w,r) for t,w,r,*P in cases],PI,PD,PS,max_drift=max_drift,batch=batch)
+
+    single = Trellis3D(table)
+    for (t,watermark,recieved,*P),got,log_likelihood in zip(cases,likelihoods,trellis.log_likelihood):
+        expected = array(single.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=max_drift))
+        assert np.allclose(got,expected,atol=1e-12)
+        assert np.isclose(log_likelihood,single.log_likelihood)
+
+
+@pytest.mark.parametrize("max_drift,rows", [(None,None),(3,None),(9,[5,7,2])])
+def test_lattice_size(max_drift,rows):
+    lattice = trellis_arrays.Lattice(7,[4,9,6],max_drift,rows)
+
+    #Count the nodes of every plane and the edges leaving them one by one
+    nodes,edges = 0,0
+    for N,M in zip(lattice.rows.tolist(),lattice.lengths.tolist()):
+        for i in range(N+1):
+            for j in range(M+1):
+                if max_drift is not None and abs(j-i) > max_drift: continue
+                for exists in [(i == 0) == (j == 0), j > 0, i > 0]:
+                    nodes += exists
+                    edges += exists * ((j < M) + (i < N) + (j < M and i < N))
+
+    assert lattice.size() == (nodes,edges)
+
+
+@pytest.mark.parametrize("n,block", [(0,None),(1,None),(64,None),(1000,None),(130,64)])
+def test_linear_runs(n,block):
+    c = np.random.default_rng(n).random((3,n))
+    for a in [0.0,0.3,0.9]:
+        x = np.zeros_like(c)
+        for k in range(n): x[:,k] = c[:,k] + (a*x[:,k-1] if k else 0)
+        assert np.allclose(trellis_stream.linear_runs(a,c,block),x,rtol=1e-12,atol=1e-15)
+
+
+def test_multi_read_matches_single_reads():
+    table,watermark,recieved,PI,PD,PS = case(4,5,6,3)
+    rng = np.random.default_rng(3)
+    reads = [recieved] + [channel().array_bigram_channel(watermark,PI,PD,PS,rng=rng) for r in range(2)]
+    for read in reads[1:]: read[:] = (read + rng.integers(0,4,len(read))*(rng.random(len(read)) < 0.3)) % 4
+
+    #Each read's likelihoods are prior * P(read | symbol), the joint ones prior * the product over the reads
+    trellis = Trellis3D(table)
+    single = np.array([array(trellis.forward_backward(watermark,read,PI,PD,PS,engine='array')) for read in reads])
+    rows = np.arange(len(watermark))
+    prior = np.zeros((len(watermark),4))
+    prior[rows[:,None],(watermark[:,None] + np.arange(4)) % 4] = trellis.table[rows % len(trellis.table)]
+    with np.errstate(invalid='ignore'):
+        expected = np.nan_to_num(single.prod(axis=0) / prior**2)
+    expected /= expected.sum(axis=1,keepdims=True)
+
+    joint = array(trellis.multi_read_forward_backward(watermark,reads,PI,PD,PS))
+    assert np.allclose(trellis.read_likelihoods,single,atol=1e-12)
+    assert np.allclose(joint,expected,atol=1e-12)
+
+
+def test_combine_reads_without_likelihoods():
+    table = np.array([[0.7,0.1,0.1,0.1],[0.5,0.5,0.0,0.0]])
+    watermark = np.zeros(4,dtype=np.uint8)
+    read = np.array([[0.1,0.2,0.3,0.4],[0.5,0.5,0.0,0.0]] * 2)
+    prior = np.array([[0.7,0.1,0.1,0.1],[0.5,0.5,0.0,0.0]] * 2)
+
+    #A read with no likelihoods at an index (undecodable or out of the band) says nothing about it
+    probabilities = np.stack([read,read,read * [[1],[1],[0],[0]]])
+    joint = trellis_arrays.combine_reads(probabilities,watermark,table)
+    with np.errstate(invalid='ignore'):
+        expected = np.nan_to_num(read**3 / prior**2)
+        expected[2:] = np.nan_to_num(read[2:]**2 / prior[2:])
+    assert np.allclose(joint,expected / expected.sum(axis=1,keepdims=True))
+
+    #Reads that rule out every symbol between them leave the prior
+    probabilities = np.stack([read,np.roll(read,2,axis=1)])
+    joint = trellis_arrays.combine_reads(probabilities,watermark,table)
+    assert not np.isnan(joint).any() and np.allclose(joint[1::2],prior[1::2])
+
+    #End to end, a read longer than the watermark without insertions can not be decoded
+    table,watermark,recieved,PI,PD,PS = case(4,5,2,1)
+    PI,PD,PS = [0.0,0.0,0.1],[0.0,0.0,0.1],[0.0,0.0,0.1]
+    reads = [(watermark + np.arange(len(watermark)) % 4 * (np.arange(len(watermark)) % 5 == 0)) % 4,watermark.copy(),np.append(watermark,0)]
+    trellis = Trellis3D(table)
+    joint = array(trellis.multi_read_forward_backward(watermark,reads,PI,PD,PS))
+    assert (trellis.read_likelihoods[2] == 0).all()
+    assert np.allclose(joint,array(trellis.multi_read_forward_backward(watermark,reads[:2],PI,PD,PS)),atol=1e-12)
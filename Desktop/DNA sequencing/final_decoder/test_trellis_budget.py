@@ -0,0 +1,92 @@
+import pytest
+import tracemalloc
+import numpy as np
+import trellis_budget
+from Trellis3D import Trellis3D
+from channel import channel
+from test_trellis import case, array
+
+
+def test_estimate():
+    full = trellis_budget.estimate(2000,2010,'array')
+    band = trellis_budget.estimate(2000,2010,'array',60)
+    checkpoint = trellis_budget.estimate(2000,2010,'checkpoint',60,True)
+    window = trellis_budget.estimate(2000,2010,'window',60)
+    assert full.bytes > band.bytes > window.bytes > checkpoint.bytes
+    assert checkpoint.seconds > band.seconds
+
+    #The band and the window grow with the band, the window keeps a fixed number of rows
+    assert trellis_budget.estimate(2000,2010,'array',120).bytes > band.bytes
+    assert trellis_budget.estimate(8000,8010,'window',60).bytes < 4*window.bytes
+    assert trellis_budget.estimate(8000,8010,'array',60).bytes > 3.9*band.bytes
+
+    with pytest.raises(ValueError): trellis_budget.estimate(2000,2010,'window')
+    with pytest.raises(ValueError): trellis_budget.estimate(2000,2010,'banded')
+
+
+@pytest.mark.parametrize("mode,checkpoint", [('array',None),('checkpoint',True),('window',None)])
+def test_estimate_matches_peak(mode,checkpoint):
+    rng = np.random.default_rng(0)
+    PI,PD,PS = [0.5,0.0,0.01],[0.0,0.5,0.01],[0.02,0.02,0.01]
+    watermark = rng.integers(0,4,1000).astype(np.uint8)
+    recieved = channel().array_bigram_channel(watermark,PI,PD,PS,rng=rng)
+    W = abs(len(watermark) - len(recieved)) + 40
+    trellis = Trellis3D({0:{'0':0.25,'1':0.25,'2':0.25,'3':0.25}})
+
+    tracemalloc.start()
+    if mode == 'window': list(trellis.windowed_forward_backward(watermark,recieved,PI,PD,PS,W))
+    else: trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=W,checkpoint=checkpoint)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    estimated = trellis_budget.estimate(len(watermark),len(recieved),mode,W,checkpoint).bytes
+    assert 0.5 < peak / estimated < 2
+
+
+def test_choose():
+    N,M,W = 2000,2010,60
+    full = trellis_budget.estimate(N,M,'array')
+    band = trellis_budget.estimate(N,M,'array',W)
+    checkpoint = trellis_budget.estimate(N,M,'checkpoint',W,True)
+
+    assert trellis_budget.choose(N,M,None,W).bytes == full.bytes
+    assert trellis_budget.choose(N,M,full.bytes,W).options['max_drift'] is None
+    assert trellis_budget.choose(N,M,full.bytes - 1,W).options['max_drift'] == W
+    chosen = trellis_budget.choose(N,M,band.bytes - 1,W)
+    assert chosen.mode == 'checkpoint' and chosen.options['checkpoint'] is True
+
+    #The window is the last resort, here made cheaper than the checkpoints
+    constants = dict(trellis_budget.CONSTANTS,checkpoint={'bytes':(0.0,1e3,0.0),'seconds':(0.0,0.0,0.0)})
+    window = trellis_budget.estimate(N,M,'window',W,constants=constants)
+    assert trellis_budget.choose(N,M,window.bytes,W,constants=constants).mode == 'window'
+    with pytest.raises(ValueError): trellis_budget.choose(N,M,window.bytes - 1,W,constants=constants)
+    with pytest.raises(ValueError): trellis_budget.choose(N,M,min(checkpoint.bytes,window.bytes) - 1,W)
+
+    #Without a band the default one covers the length difference
+    assert trellis_budget.choose(N,M,band.bytes,None).options['max_drift'] == trellis_budget.default_drift(N,M) > M - N
+
+
+def test_auto_engine():
+    table,watermark,recieved,PI,PD,PS = case(4,5,8,1)
+    N,M = len(watermark),len(recieved)
+    W = abs(N - M) + 6
+    trellis = Trellis3D(table)
+    banded = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=W))
+    full = array(trellis.forward_backward(watermark,recieved,PI,PD,PS,engine='array'))
+
+    auto = Trellis3D(table)
+    assert np.allclose(array(auto.forward_backward(watermark,recieved,PI,PD,PS,engine='auto',max_drift=W)),full,atol=1e-12)
+    assert auto.mode.mode == 'array' and auto.mode.options['max_drift'] is None
+
+    for budget,mode in [(trellis_budget.estimate(N,M,'array',W).bytes,'array'),(trellis_budget.estimate(N,M,'checkpoint',W,True).bytes,'checkpoint')]:
+        auto = Trellis3D(table,budget=budget)
+        assert np.allclose(array(auto.forward_backward(watermark,recieved,PI,PD,PS,engine='auto',max_drift=W)),banded,atol=1e-12)
+        assert auto.mode.mode == mode and auto.mode.options['max_drift'] == W
+        assert auto.stats.mode['policy'] == mode
+
+    #A policy of our own, here always the window
+    auto = Trellis3D(table,policy=lambda N,M,budget,max_drift : trellis_budget.estimate(N,M,'window',max_drift))
+    assert np.allclose(array(auto.forward_backward(watermark,recieved,PI,PD,PS,engine='auto',max_drift=W)),banded,atol=1e-12)
+    assert auto.mode.mode == 'window'
+
+    with pytest.raises(ValueError): Trellis3D(table,budget=1).forward_backward(watermark,recieved,PI,PD,PS,engine='auto',max_drift=W)
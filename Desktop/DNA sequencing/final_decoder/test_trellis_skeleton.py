@@ -0,0 +1,53 @@
+import gc
+import tracemalloc
+import trellis_skeleton
+from trellis_skeleton import Skeleton, SkeletonCache
+
+
+def test_memory_matches_tracemalloc():
+    gc.collect()
+    tracemalloc.start()
+    try:
+        skeleton = Skeleton(40,44)
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert abs(skeleton.size - held) < 0.1*held
+
+
+def test_lru_eviction():
+    sizes = {shape:Skeleton(*shape).size for shape in [(10,12),(11,12),(12,12)]}
+    cache = SkeletonCache(sizes[(10,12)] + sizes[(12,12)])
+
+    first = cache.get(10,12)
+    cache.get(11,12)
+    assert cache.get(10,12) is first and (cache.hits,cache.misses) == (1,2)
+
+    #(11,12) is now the least recently used and makes room for (12,12)
+    cache.get(12,12)
+    assert list(cache.skeletons) == [(10,12),(12,12)]
+    assert cache.bytes == sizes[(10,12)] + sizes[(12,12)] <= cache.max_bytes
+
+    #A skeleton larger than the whole budget is built but not kept
+    big = cache.get(30,30)
+    assert big.shape == (30,30) and (30,30) not in cache.skeletons
+    assert cache.get(12,12) is not None and (cache.hits,cache.misses) == (2,4)
+
+
+def test_resize():
+    cache = SkeletonCache()
+    for N in range(10,14): cache.get(N,12)
+    cache.get(10,12)
+    assert cache.bytes == sum(skeleton.size for skeleton in cache.skeletons.values())
+
+    #Shrinking drops the least recently used first
+    cache.resize(cache.skeletons[(13,12)].size + cache.skeletons[(10,12)].size)
+    assert list(cache.skeletons) == [(13,12),(10,12)]
+
+    cache.resize(0)
+    assert not cache.skeletons and cache.bytes == 0
+
+    cache.clear()
+    assert (cache.hits,cache.misses) == (0,0)
+    assert isinstance(trellis_skeleton.cache,SkeletonCache)
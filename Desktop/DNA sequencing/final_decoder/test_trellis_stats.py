@@ -0,0 +1,34 @@
+import tracemalloc
+import numpy as np
+import trellis_stats
+from trellis_stats import TrellisStats
+
+
+def test_peak_left_to_the_caller():
+    tracemalloc.start()
+    try:
+        big = np.ones(1_000_000)
+        del big
+        peak = tracemalloc.get_traced_memory()[1]
+
+        #A call below the caller's peak keeps it and has no peak of its own
+        stats = TrellisStats('array',10,10)
+        small = np.ones(1000)
+        stats.finish()
+        assert tracemalloc.get_traced_memory()[1] >= peak and stats.peak_memory is None
+
+        #A call above it reports the rise over its start
+        stats = TrellisStats('array',10,10)
+        bigger = np.ones(2_000_000)
+        del bigger
+        stats.finish()
+        assert stats.peak_memory >= 16_000_000
+
+        trellis_stats.reset_peak = True
+        stats = TrellisStats('array',10,10)
+        small = np.ones(1000)
+        stats.finish()
+        assert 0 < stats.peak_memory < 1_000_000
+    finally:
+        trellis_stats.reset_peak = False
+        tracemalloc.stop()
@@ -0,0 +1,36 @@
+import pytest
+import numpy as np
+import ldpc
+from Trellis3D import Trellis3D
+from sparsifier import Sparsifier
+from channel import channel
+from turbo import turbo_decode
+
+
+def ldpc_code():
+    '''The LDPC library is loaded from bin/ relative to the working directory, skip where it cannot be'''
+    code = ldpc.code(standard='802.16',z=10,rate='1/2')
+    try: code.decode(np.zeros(code.N))
+    except OSError as error: pytest.skip('c_ldpc library not loadable: {}'.format(error))
+    return code
+
+
+def test_turbo_zero_table():
+    k,n = 3,5 # The substitution table of this mapping has zero entries
+    code = ldpc_code()
+    rng = np.random.default_rng(1)
+    x = code.encode(rng.integers(0,2,code.K))
+
+    sparsifier = Sparsifier()
+    sparse = sparsifier.sparsify(x.astype(np.uint8),k,n)
+    watermark = rng.integers(0,4,len(sparse)).astype(np.uint8)
+    PI,PD,PS = [0.5,0.0,0.01],[0.0,0.5,0.01],[0.04,0.04,0.01]
+    recieved = channel().array_bigram_channel((sparse + watermark) % 4,PI,PD,PS,rng=rng)
+
+    trellis = Trellis3D(sparsifier.substitution_distribution(k,n))
+    assert (trellis.table == 0).any()
+
+    app,iterations = turbo_decode(trellis,sparsifier,code,watermark,recieved,PI,PD,PS,k,n,iterations=4)
+
+    assert not np.isnan(app).any()
+    assert np.mean((app < 0) != x) < 0.05
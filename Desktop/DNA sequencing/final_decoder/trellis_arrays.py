@@ -0,0 +1,961 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+'''Array kernels for the 3D watermark Trellis
+
+The lattice is stored as planes of shape (3, len(watermark)+1, width), one plane per depth in
+the order T, I, D (the same order as depth = [0,-2,2] in Trellis3D). Without a band the width is
+len(recieved)+1 and the planes are the full (i,j) rectangle, with max_drift = W only the nodes
+with |j-i| <= W are stored and row i holds j = i-W ... i+W. Several reads of the same watermark
+are stacked along a leading read axis, shorter reads are padded and masked.
+
+Every node on an anti-diagonal s = i + j only depends on the diagonals s-1 (insertion, deletion)
+and s-2 (transmission/substitution), so the recursions sweep the anti-diagonals and update a whole
+diagonal at once. In both layouts the nodes of a diagonal are evenly spaced in the flattened
+plane, so every diagonal is a plain strided slice (a view) of the planes.
+
+The alphas of each diagonal are divided by their sum c[s] so long sequences do not underflow,
+the stored alphas are alpha / (c[0]*...*c[s]). The betas are scaled with the same factors and
+divided by P(recieved | watermark), so alpha * gamma * beta of an edge is its posterior probability
+once the factors of the diagonals it skips are divided out.
+'''
+
+
+T,I,D = 0,1,2 # Plane of each depth
+OPERATIONS = ['transmit','substitute','insert','delete'] # Edit operation codes of the Viterbi path, as in channel
+
+
+class Lattice:
+    '''Layout of the trellis planes for a watermark of length N and reads of the given lengths
+
+    rows gives a watermark length of every read for batches of different watermarks padded to N,
+    the final node of read b is then (rows[b], lengths[b])'''
+
+    def __init__(self,N,lengths,max_drift=None,rows=None):
+        self.N = N
+        self.lengths = np.atleast_1d(np.array(lengths,dtype=int))
+        self.M = int(self.lengths.max())
+        self.max_drift = max_drift
+        self.rows = np.full(len(self.lengths),N) if rows is None else np.array(rows,dtype=int)
+        if (self.rows > N).any(): raise ValueError(f'Watermarks of the batch are longer than N = {N}')
+
+        if max_drift is None:
+            self.width = self.M+1
+            self.slope = 0 # Column of node (i,j) is j - slope*i + offset
+            self.offset = 0
+        else:
+            drift = np.abs(self.rows-self.lengths).max()
+            if drift > max_drift: raise ValueError(f'max_drift = {max_drift} does not reach the final node, the lengths differ by {drift}')
+            self.width = 2*max_drift+1
+            self.slope = 1
+            self.offset = max_drift
+
+        self.shape = (N+1,self.width)
+        self.step = self.width-1-self.slope # Flat distance between neighbouring nodes on a diagonal
+
+    def diagonal(self,s):
+        '''Range of watermark indices i on the anti-diagonal s, empty when lo > hi'''
+        lo,hi = max(0,s-self.M), min(self.N,s)
+
+        if self.max_drift is not None:
+            lo = max(lo,(s-self.max_drift+1)//2)
+            hi = min(hi,(s+self.max_drift)//2)
+
+        return lo,hi
+
+    def cells(self,s,lo,hi):
+        '''Flat slice of the nodes (lo,s-lo) ... (hi,s-hi) of the anti-diagonal s'''
+        start = s + self.offset + lo*self.step
+        if hi == lo: return slice(start,start+1)
+        return slice(start,start+(hi-lo)*self.step+1,self.step)
+
+    def cut(self,planes,s):
+        '''Nodes of the anti-diagonal s of flattened planes, empty when s is outside the lattice'''
+        lo,hi = self.diagonal(s)
+        if s < 0 or lo > hi: return planes[...,:0]
+        return planes[...,self.cells(s,lo,hi)]
+
+    def index(self,i,j):
+        '''Flat index of the node (i,j) in a plane'''
+        return i*self.width + j - self.slope*i + self.offset
+
+    def columns(self):
+        '''Recieved index j of every stored column, shape (N+1,width)'''
+        return np.arange(self.width)[None,:] + self.slope*np.arange(self.N+1)[:,None] - self.offset
+
+    def size(self):
+        '''Number of nodes and edges of the trellises of all the reads over the T, I and D planes, inside the band
+
+        Counted from the interval of j every row holds, without building anything the size of the planes'''
+        i = np.arange(self.N+1)[None,:]
+        rows,lengths = self.rows[:,None],self.lengths[:,None]
+        lo,hi = 0*i,lengths + 0*i
+        if self.max_drift is not None: lo,hi = np.maximum(i-self.max_drift,0),np.minimum(hi,i+self.max_drift)
+        hi = np.where(i <= rows,hi,-1)
+
+        nodes,edges = 0,0
+        for a,b in [(np.where(i == 0,0,np.maximum(lo,1)),np.where(i == 0,0,hi)), (np.maximum(lo,1),hi), (lo,np.where(i > 0,hi,-1))]: # T, I, D nodes that exist
+            count = np.maximum(b-a+1,0)
+            inserting = count - ((b == lengths) & (count > 0)) # Nodes with j < length
+            nodes += int(count.sum())
+            edges += int(np.where(i < rows,count + 2*inserting,inserting).sum()) # Insertion, deletion and transmission edges
+
+        return nodes, edges
+
+    def shift(self,planes,di,dj):
+        '''Values of planes[..., i+di, j+dj] at every stored (i,j) of the rows 0 ... N-di, zero outside the lattice'''
+        k = dj - self.slope*di # Column shift between the two nodes
+        rows = planes[...,di:,:]
+        shifted = np.zeros_like(rows)
+
+        if k >= 0: shifted[...,:self.width-k] = rows[...,k:]
+        else: shifted[...,-k:] = rows[...,:self.width+k]
+
+        return shifted
+
+
+def edge_probabilities(PI,PD,PS):
+    '''Insertion, deletion and transmission probabilities for leaving a T, I and D node'''
+    P = np.array([PS,PI,PD],dtype=float)
+
+    insertion = P[:,0]
+    deletion = P[:,1]
+    transmission = 1 - P[:,0] - P[:,1] # Normalisation of the transmission/substitution edges
+
+    return insertion, deletion, transmission
+
+
+def substitution_table(sparse_distribution):
+    '''Converts the Sparsifier substitution distribution {i: {'0':p0, ... '3':p3}} to an (n,4) array'''
+    return np.array([[sparse_distribution[i][str(q)] for q in range(4)] for i in range(len(sparse_distribution))],dtype=float)
+
+
+def pad_reads(reads):
+    '''Stacks integer reads of different lengths into an (R, longest) array padded with zeros'''
+    padded = np.zeros((len(reads),max(len(read) for read in reads)),dtype=int)
+    for b,read in enumerate(reads):
+        padded[b,:len(read)] = read
+
+    return padded
+
+
+def buckets(shapes,max_waste=0.1,size=64,max_drift=None):
+    '''Groups the (N,M) shapes of many (watermark, read) pairs into batches of at most size pairs
+
+    Every batch is padded to its longest watermark and read, a pair only joins a batch if at most
+    max_waste of the padded nodes are padding. Returns lists of positions in shapes'''
+    def nodes(N,M): return (N+1)*(M+1 if max_drift is None else 2*max_drift+1)
+
+    batches = []
+    batch,N,M,used = [],0,0,0
+
+    for b in sorted(range(len(shapes)),key = lambda b : tuple(shapes[b])):
+        n,m = shapes[b]
+        padded = (len(batch)+1)*nodes(max(N,n),max(M,m))
+
+        if batch and (len(batch) == size or 1 - (used + nodes(n,m))/padded > max_waste):
+            batches.append(batch)
+            batch,N,M,used = [],0,0,0
+
+        batch.append(b)
+        N,M,used = max(N,n),max(M,m),used + nodes(n,m)
+
+    if batch: batches.append(batch)
+
+    return batches
+
+
+def recieved_symbols(lattice,reads):
+    '''Recieved symbol of every read at every stored node, -1 where j is outside the read'''
+    j = lattice.columns()
+    valid = (j >= 0) & (j < lattice.lengths[:,None,None])
+
+    if lattice.M == 0: return np.full(valid.shape,-1,dtype=int)
+
+    symbols = reads[:,np.clip(j,0,lattice.M-1)]
+    return np.where(valid,symbols,-1)
+
+
+def transmission_gammas(lattice,table,watermark,reads):
+    '''Sparse distribution part of the transmission edge (i,j) --> (i+1,j+1), zero on the last row and column
+
+    watermark is shared by every read, or an (R,N) array with the padded watermark of each read'''
+    N = lattice.N
+    rows = np.arange(N+1)
+    symbols = recieved_symbols(lattice,reads)
+    symbols = np.where(rows[:,None] < lattice.rows[:,None,None],symbols,-1)
+
+    watermark = np.pad(np.atleast_2d(watermark),((0,0),(0,1)))
+    difference = (symbols - watermark[:,:,None]) % 4
+    gammas = table[rows % len(table)][rows[:,None],difference]
+
+    return np.where(symbols >= 0,gammas,0.0)
+
+
+class Wavefront:
+    '''Thread pool for the anti-diagonal recursions of a single large trellis
+
+    Every node of an anti-diagonal only depends on the two diagonals before it, so a diagonal is
+    split into tiles of at most tile nodes that run on threads at the same time. The NumPy kernels
+    release the GIL, which pays off once the diagonals are a few thousand nodes long. Handing a tile
+    to a thread costs about 20us, so the default tile keeps the diagonals of strands up to 8192 bases
+    in one piece that runs on the calling thread, and a single thread never dispatches at all; smaller
+    tiles only help with that many free cores. close() (or a with block) shuts the threads down'''
+
+    def __init__(self,threads,tile=8192):
+        if threads < 1 or tile < 1: raise ValueError('Wavefront needs at least one thread and one node per tile')
+        self.threads = threads
+        self.tile = tile
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def tiles(self,lo,hi):
+        return [(a,min(a+self.tile-1,hi)) for a in range(lo,hi+1,self.tile)]
+
+    def close(self):
+        if self.pool is not None: self.pool.shutdown()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exception):
+        self.close()
+
+
+def tiled(wavefront,lo,hi,R,step):
+    '''Values of the nodes lo ... hi of an anti-diagonal from step(a,b) on each tile a ... b, a single tile without a wavefront'''
+    if wavefront is None or wavefront.pool is None or hi-lo < wavefront.tile: return step(lo,hi)
+
+    output = np.zeros((R,3,hi-lo+1))
+
+    def run(tile):
+        a,b = tile
+        output[:,:,a-lo:b-lo+1] = step(a,b)
+
+    list(wavefront.pool.map(run,wavefront.tiles(lo,hi)))
+
+    return output
+
+
+def reachable(lattice,spans,s):
+    '''Span of the nodes of the anti-diagonal s with an edge from the spans of live nodes of s-1 and s-2'''
+    lo,hi = lattice.diagonal(s)
+    a1,b1 = spans.get(s-1,(1,0))
+    a2,b2 = spans.get(s-2,(1,0))
+
+    #Insertions and deletions from s-1 reach i ... i+1, transmissions from s-2 reach i+1
+    spans = [(a,b) for a,b in [(a1,b1+1),(a2+1,b2+1)] if a <= b]
+    if not spans: return 1,0
+
+    return max(lo,min(a for a,b in spans)), min(hi,max(b for a,b in spans))
+
+
+class Ghost:
+    '''Forward mass of the paths that leave the nodes a recursion keeps, pushed on through the same recursion
+
+    The paths that step out of the band or onto a node dropped by a Beam are lost to the likelihood.
+    Their alphas go on over the lattice of the ghost (no band for a band, the band itself for a beam),
+    scaled by the same c[s] as the live alphas, so at the final node ghost / (ghost + live) is the
+    fraction of P(recieved | watermark) the lost paths carried. Ghost nodes below precision times the
+    largest ghost alpha or floor times the largest live alpha of their anti-diagonal are dropped, so
+    nothing runs until some mass leaves and the ghost keeps to the nodes that matter.
+    gammas are the transmission_gammas of lattice when they are stored, else they are built on the fly'''
+
+    def __init__(self,lattice,table,watermark,reads,insertion,deletion,transmission,gammas=None,precision=1e-6,floor=1e-12):
+        self.lattice = lattice
+        self.table,self.watermark,self.reads = table,watermark,reads
+        self.gammas = gammas.reshape(len(lattice.lengths),-1) if gammas is not None else None
+        self.insertion,self.deletion,self.transmission = insertion,deletion,transmission
+        self.precision = precision
+        self.floor = floor
+
+        R = len(lattice.lengths)
+        self.spans = {} # s : first and last ghost node i of the last anti-diagonals s, empty when lo > hi
+        self.one,self.two = None,None # Ghost alphas of the spans of the anti-diagonals s-1 and s-2
+        self.shift = np.zeros(R) # log of the factor the ghost alphas are divided by on top of c[s], so they can not overflow
+        self.final = np.full(R,-np.inf) # log of the scaled ghost alpha of the toor
+        self.lost = np.zeros(R)
+
+        self.ending = {} # s : reads whose final node is on the anti-diagonal s
+        for b,s in enumerate(lattice.rows + lattice.lengths): self.ending.setdefault(s,[]).append(b)
+
+    def step(self,s,entering,scales,live):
+        '''Ghost alphas of the anti-diagonal s, once c[s] of the live alphas is known
+
+        entering holds (lo, unscaled alphas of the nodes lo ... of s) that left the live nodes onto s,
+        live is the largest scaled live alpha of every read on s'''
+        lattice = self.lattice
+        R = len(lattice.lengths)
+        unshift = np.exp(-self.shift)
+        cutoff = self.floor * live * unshift
+
+        entering = [(lo,block * (unshift / scales[:,s])[:,None,None]) for lo,block in entering]
+        entering = [(lo,block) for lo,block in entering if (block.max(axis=1) >= cutoff[:,None]).any()]
+
+        #The recursion only looks two diagonals back
+        self.spans.pop(s-3,None)
+        a,b = reachable(lattice,self.spans,s)
+        carried = a <= b
+        for lo,block in entering: a,b = min(a,lo), max(b,lo+block.shape[-1]-1)
+
+        if a > b:
+            self.spans[s] = (1,0)
+            self.one,self.two = None,self.one
+            return
+
+        target = np.zeros((R,3,b-a+1))
+        if carried:
+            (lo1,hi1),(lo2,hi2) = spans = self.spans.get(s-1,(1,0)),self.spans.get(s-2,(1,0))
+            inserting = (s-1 - np.arange(lo1,hi1+1)) < lattice.lengths[:,None]
+            if lo2 > hi2: gammas = None
+            elif self.gammas is not None: gammas = self.gammas[:,lattice.cells(s-2,lo2,hi2)]
+            else: gammas = diagonal_gammas(lattice,self.table,self.watermark,self.reads,s-2,(lo2,hi2))
+            one = self.one if lo1 <= hi1 else np.zeros((R,3,0))
+            target += forward_step(lattice,s,one,self.two,gammas,inserting,self.insertion,self.deletion,self.transmission,scales[:,s-1],(a,b),spans) / scales[:,s,None,None]
+
+        for lo,block in entering: target[:,:,lo-a:lo-a+block.shape[-1]] += block
+
+        node = target.max(axis=1)
+        alive = (node > 0) & (node >= np.maximum(cutoff,self.precision * node.max(axis=1))[:,None])
+        kept = np.nonzero(alive.any(axis=0))[0]
+        if len(kept) == 0:
+            self.spans[s] = (1,0)
+            self.one,self.two = None,self.one
+            return
+
+        target = np.where(alive[:,None],target,0.0)[:,:,kept[0]:kept[-1]+1]
+        a,b = a+kept[0],a+kept[-1]
+
+        #Divide out the ghost mass above 1 before it can overflow, the ghost of s-1 is used again by s+1
+        total = target.sum(axis=(1,2))
+        big = total > 1
+        if big.any():
+            target[big] /= total[big,None,None]
+            if self.one is not None: self.one[big] /= total[big,None,None]
+            self.shift[big] += np.log(total[big])
+
+        for k in self.ending.get(s,[]):
+            i = lattice.rows[k]
+            if a <= i <= b and target[k,:,i-a].sum() > 0: self.final[k] = np.log(target[k,:,i-a].sum()) + self.shift[k]
+
+        self.spans[s] = (a,b)
+        self.one,self.two = target,self.one
+
+    def finish(self,final):
+        '''Fraction of the likelihood of every read carried by the lost paths, from the scaled live alpha of the toor'''
+        with np.errstate(over='ignore',invalid='ignore'):
+            ratio = final * np.exp(-self.final)
+        self.lost = np.where(self.final == -np.inf,0.0,1 / (1 + ratio))
+        return self.lost
+
+
+class Beam:
+    '''Beam pruning of the forward recursion
+
+    After every anti-diagonal the nodes whose alphas are all below threshold times the largest alpha
+    of the diagonal are dropped, and only the span of nodes reachable from the live ones is computed
+    on the next diagonals and on the way back. The dropped alphas go on in ghost, a Ghost on the same
+    lattice, and self.pruned is the fraction of P(recieved | watermark) of each read that was lost'''
+
+    def __init__(self,threshold,ghost):
+        self.threshold = threshold
+        self.ghost = ghost
+        self.pruned = ghost.lost
+        self.spans = {0:(0,0)} # s : first and last node i still alive on the anti-diagonal s, empty when lo > hi
+
+    def reachable(self,lattice,s):
+        '''Span of the nodes of the anti-diagonal s with an edge from a live node'''
+        return reachable(lattice,self.spans,s)
+
+    def prune(self,s,lo,target):
+        '''Drops the nodes of target (the nodes lo ... of the anti-diagonal s) below the threshold,
+        returns the span left, its alphas and the dropped alphas of the nodes lo ...'''
+        node = target.max(axis=1)
+        alive = (node > 0) & (node >= self.threshold * node.max(axis=1,keepdims=True))
+        dropped = np.where(alive[:,None],0.0,target)
+
+        live = np.nonzero(alive.any(axis=0))[0]
+        if len(live) == 0:
+            self.spans[s] = (1,0)
+            return 1,0,target[:,:,:0],dropped
+
+        self.spans[s] = (lo+live[0],lo+live[-1])
+        target = np.where(alive[:,None],target,0.0)[:,:,live[0]:live[-1]+1]
+
+        return lo+live[0],lo+live[-1],target,dropped
+
+
+def forward_step(lattice,s,one,two,gammas_two,inserting_one,insertion,deletion,transmission,scale,tile=None,spans=None):
+    '''Unscaled alphas of the anti-diagonal s from the scaled alphas of s-1 (one) and s-2 (two)
+
+    gammas_two are the transmission gammas of the diagonal s-2, (R,3,n) when they depend on the plane
+    the edge leaves (see expectation), inserting_one masks the nodes of s-1
+    that can still insert a symbol and scale is the factor c[s-1] of the transmission edges.
+    tile = (lo,hi) only computes the nodes i = lo ... hi of the diagonal, spans = ((lo1,hi1),(lo2,hi2))
+    are the nodes of s-1 and s-2 the other arguments hold when they do not hold the whole diagonals'''
+    lo,hi = lattice.diagonal(s) if tile is None else tile
+    (lo1,hi1),(lo2,hi2) = spans or (lattice.diagonal(s-1),lattice.diagonal(s-2))
+    target = np.zeros((len(lattice.lengths),3,hi-lo+1))
+
+    #Insertion (i,j-1) --> (i,j)
+    a,b = max(lo,lo1), min(hi,hi1)
+    if a <= b:
+        target[:,I,a-lo:b-lo+1] = (insertion @ one[:,:,a-lo1:b-lo1+1]) * inserting_one[:,a-lo1:b-lo1+1]
+
+    #Deletion (i-1,j) --> (i,j)
+    a,b = max(lo,lo1+1), min(hi,hi1+1)
+    if a <= b:
+        target[:,D,a-lo:b-lo+1] = deletion @ one[:,:,a-1-lo1:b-lo1]
+
+    #Transmission (i-1,j-1) --> (i,j)
+    if two is not None:
+        a,b = max(lo,lo2+1), min(hi,hi2+1)
+        if a <= b:
+            if gammas_two.ndim == 3:
+                target[:,T,a-lo:b-lo+1] = np.einsum('p,rpn,rpn->rn',transmission,two[:,:,a-1-lo2:b-lo2],gammas_two[:,:,a-1-lo2:b-lo2]) / scale[:,None]
+            else:
+                target[:,T,a-lo:b-lo+1] = (transmission @ two[:,:,a-1-lo2:b-lo2]) * gammas_two[:,a-1-lo2:b-lo2] / scale[:,None]
+
+    return target
+
+
+def band_exits(lattice,s,one,insertion,deletion):
+    '''Unscaled alphas the anti-diagonal s-1 (one) sends out of the band onto s, as (i, (R,3,1) alphas of node i) for a Ghost
+
+    Only the insertions above the band and the deletions below it leave, a transmission keeps j - i'''
+    R = len(lattice.lengths)
+    lo1,hi1 = lattice.diagonal(s-1)
+    if lattice.max_drift is None or lo1 > hi1: return []
+
+    exits = []
+    if s - 2*lo1 > lattice.max_drift:
+        block = np.zeros((R,3,1))
+        block[:,I,0] = (one[:,:,0] @ insertion) * (s-1-lo1 < lattice.lengths)
+        exits.append((lo1,block))
+    if s - 2*(hi1+1) < -lattice.max_drift and hi1+1 <= lattice.N:
+        block = np.zeros((R,3,1))
+        block[:,D,0] = (one[:,:,-1] @ deletion) * (hi1+1 <= lattice.rows)
+        exits.append((hi1+1,block))
+
+    return exits
+
+
+def origin(lattice):
+    '''Alphas of the anti-diagonal 0, the start node (0,0) in the T plane'''
+    alpha = np.zeros((len(lattice.lengths),3,1))
+    alpha[:,T] = 1.0
+    return alpha
+
+
+def forward(lattice,gammas,insertion,deletion,transmission,wavefront=None,beam=None,leak=None):
+    '''Scaled alphas of every read at every stored node, shape (R,3,N+1,width)
+
+    Also returns the scaling factors c[s] of the anti-diagonals, shape (R,N+M+1), and the
+    fraction of P(recieved | watermark) of each read carried by the paths that leave the band,
+    measured by leak, a Ghost on the lattice without a band (0 without one).
+    With a Wavefront the tiles of every anti-diagonal are computed on its threads, with a Beam
+    only the live nodes are kept and the others stay 0'''
+    N,M = lattice.N,lattice.M
+    R = len(lattice.lengths)
+
+    alphas = np.zeros((R,3)+lattice.shape)
+    flat = alphas.reshape(R,3,-1)
+    g = gammas.reshape(gammas.shape[:-2]+(-1,))
+    scales = np.ones((R,N+M+1))
+
+    #Insertions may not run past the end of a shorter read
+    inserting = (lattice.columns() < lattice.lengths[:,None,None]).reshape(R,-1)
+
+    flat[:,:,lattice.cells(0,0,0)] = origin(lattice)
+
+    for s in range(1,N+M+1):
+        lo,hi = lattice.diagonal(s) if beam is None else beam.reachable(lattice,s)
+        one = lattice.cut(flat,s-1)
+        exits = band_exits(lattice,s,one,insertion,deletion) if leak is not None else []
+        dropped = []
+
+        if lo <= hi:
+            two = lattice.cut(flat,s-2) if s >= 2 else None
+            gammas_two,inserting_one = lattice.cut(g,s-2),lattice.cut(inserting,s-1)
+            target = tiled(wavefront,lo,hi,R,lambda a,b : forward_step(lattice,s,one,two,gammas_two,inserting_one,insertion,deletion,transmission,scales[:,s-1],(a,b)))
+
+            if beam is not None:
+                reached = lo
+                lo,hi,target,dropped = beam.prune(s,lo,target)
+                dropped = [(reached,dropped)]
+        elif beam is not None: beam.spans[s] = (lo,hi)
+
+        live = np.zeros(R)
+        if lo <= hi:
+            total = target.sum(axis=(1,2))
+            scales[total > 0,s] = total[total > 0]
+            target /= scales[:,s,None,None]
+            flat[:,:,lattice.cells(s,lo,hi)] = target
+            live = target.max(axis=(1,2))
+
+        if leak is not None: leak.step(s,exits,scales,live)
+        if beam is not None: beam.ghost.step(s,dropped,scales,live)
+
+    final = final_alpha(lattice,alphas)
+    if beam is not None: beam.pruned = beam.ghost.finish(final)
+    lost = leak.finish(final) if leak is not None else np.zeros(R)
+
+    return alphas, scales, lost
+
+
+def final_alpha(lattice,alphas):
+    '''Scaled alpha of the toor of every read, the final nodes lead to it with gamma 1'''
+    R = len(lattice.lengths)
+    ends = lattice.index(lattice.rows,lattice.lengths)
+
+    return alphas.reshape(R,3,-1)[np.arange(R),:,ends].sum(axis=1)
+
+
+def log_likelihood(final,scales,lattice=None):
+    '''log P(recieved | watermark) of every read from the scaled alpha of the toor
+
+    With the lattice of a padded batch only the scales up to the final node of each read count'''
+    if lattice is not None:
+        ends = lattice.rows + lattice.lengths
+        scales = np.where(np.arange(scales.shape[-1]) <= ends[:,None],scales,1.0)
+
+    with np.errstate(divide='ignore'): # -inf for the reads that can not be decoded
+        return np.log(final) + np.log(scales).sum(axis=-1)
+
+
+def backward_step(lattice,s,one,two,gammas,insertion,deletion,transmission,scales,final,tile=None):
+    '''Scaled betas of the anti-diagonal s from the scaled betas of s+1 (one) and s+2 (two), None past the end
+
+    gammas are the transmission gammas of the diagonal s, (R,3,n) per plane like in forward_step, and scales are the factors c padded with
+    two ones, the final node of every read ending on s is seeded with 1/final.
+    tile = (lo,hi) only computes the nodes i = lo ... hi of the diagonal'''
+    start = lattice.diagonal(s)[0]
+    lo,hi = (start,lattice.diagonal(s)[1]) if tile is None else tile
+    R = len(lattice.lengths)
+    output = np.zeros((R,3,hi-lo+1))
+
+    if one is not None:
+        lo1,hi1 = lattice.diagonal(s+1)
+
+        #Insertion (i,j) --> (i,j+1)
+        a,b = max(lo,lo1), min(hi,hi1)
+        if a <= b:
+            output[:,:,a-lo:b-lo+1] += insertion[:,None] * one[:,None,I,a-lo1:b-lo1+1]
+
+        #Deletion (i,j) --> (i+1,j)
+        a,b = max(lo,lo1-1), min(hi,hi1-1)
+        if a <= b:
+            output[:,:,a-lo:b-lo+1] += deletion[:,None] * one[:,None,D,a+1-lo1:b+2-lo1]
+
+    #Transmission (i,j) --> (i+1,j+1)
+    if two is not None:
+        lo2,hi2 = lattice.diagonal(s+2)
+        a,b = max(lo,lo2-1), min(hi,hi2-1)
+        if a <= b:
+            b_t = two[:,T,a+1-lo2:b+2-lo2] / scales[:,s+2,None]
+            if gammas.ndim == 3: output[:,:,a-lo:b-lo+1] += transmission[:,None] * b_t[:,None] * gammas[:,:,a-start:b-start+1]
+            else: output[:,:,a-lo:b-lo+1] += transmission[:,None] * (b_t * gammas[:,a-start:b-start+1])[:,None]
+
+    output /= scales[:,s+1,None,None]
+
+    #Every final node leads to the toor with gamma 1
+    ending = np.nonzero((lattice.rows + lattice.lengths == s) & (lo <= lattice.rows) & (lattice.rows <= hi))[0]
+    if len(ending): output[ending,:,lattice.rows[ending]-lo] = np.divide(1.0,final[ending],out=np.zeros(len(ending)),where=final[ending] > 0)[:,None]
+
+    return output
+
+
+def backward(lattice,gammas,insertion,deletion,transmission,scales,final,wavefront=None,beam=None):
+    '''Scaled betas of every read at every stored node, shape (R,3,N+1,width), only on the live nodes of the Beam of the forward pass'''
+    N,M = lattice.N,lattice.M
+    R = len(lattice.lengths)
+
+    betas = np.zeros((R,3)+lattice.shape)
+    flat = betas.reshape(R,3,-1)
+    g = gammas.reshape(gammas.shape[:-2]+(-1,))
+    scales = np.append(scales,np.ones((R,2)),axis=1)
+
+    for s in range(N+M,-1,-1):
+        lo,hi = lattice.diagonal(s) if beam is None else beam.spans[s]
+        if lo > hi: continue
+
+        one = lattice.cut(flat,s+1) if s+1 <= N+M else None
+        two = lattice.cut(flat,s+2) if s+2 <= N+M else None
+
+        gammas_s = lattice.cut(g,s)
+        flat[:,:,lattice.cells(s,lo,hi)] = tiled(wavefront,lo,hi,R,lambda a,b : backward_step(lattice,s,one,two,gammas_s,insertion,deletion,transmission,scales,final,(a,b)))
+
+    return betas
+
+
+def skipped_scales(lattice,scales):
+    '''Scaling factors c[s+1] and c[s+1]*c[s+2] skipped by the edges leaving each stored node of the rows 0 ... N-1'''
+    s = np.arange(lattice.N)[:,None] + lattice.columns()[:-1]
+    s = np.clip(s,0,lattice.N+lattice.M)
+
+    padded = np.append(scales,np.ones((len(scales),2)),axis=1)
+    one = padded[:,s+1]
+
+    return one, one*padded[:,s+2]
+
+
+def symbol_probabilities(lattice,alphas,betas,gammas,scales,watermark,reads,table,deletion,transmission):
+    '''Normalised likelihoods of each transmitted symbol for every read, shape (R,N,4) in the A,C,G,T order
+
+    Transmission edges out of row i vote for the recieved symbol, deletion edges spread
+    their alpha * gamma * beta over the symbols allowed by the sparse distribution'''
+    N = lattice.N
+    one,two = skipped_scales(lattice,scales)
+
+    #Transmission/substitution edges (i,j) --> (i+1,j+1)
+    a_t = np.tensordot(transmission,alphas[:,:,:N],(0,1))
+    values = a_t * gammas[:,:N] * lattice.shift(betas[:,T],1,1) / two
+    symbols = recieved_symbols(lattice,reads)[:,:N]
+    probabilities = np.stack([(values * (symbols == q)).sum(axis=-1) for q in range(4)],axis=-1)
+
+    #Deletion edges (i,j) --> (i+1,j)
+    a_d = np.tensordot(deletion,alphas[:,:,:N],(0,1))
+    deleted = (a_d * lattice.shift(betas[:,D],1,0) / one).sum(axis=-1)
+
+    return spread_deletions(probabilities,deleted,watermark,table)
+
+
+def spread_deletions(probabilities,deleted,watermark,table):
+    '''Adds the deletion edges of each row over the symbols allowed by the sparse distribution and normalises
+
+    watermark is shared by every read or is an (R,N) array, the padding rows of a batch stay 0'''
+    rows = np.arange(probabilities.shape[1])
+    symbols = np.broadcast_to((watermark[...,None] + np.arange(4)) % 4,probabilities.shape)
+    spread = np.zeros_like(probabilities)
+    np.put_along_axis(spread,symbols,deleted[:,:,None] * table[rows % len(table)],axis=-1)
+    probabilities += spread
+
+    total = probabilities.sum(axis=-1,keepdims=True)
+    return np.divide(probabilities,total,out=np.zeros_like(probabilities),where=total > 0)
+
+
+def combine_reads(probabilities,watermark,table):
+    '''Joint likelihoods of each transmitted symbol given all the reads, shape (N,4)
+
+    Every read likelihood is prior * P(read | symbol), so the joint one is the prior times the
+    product of P(read | symbol) over the reads, computed with logs so many reads do not underflow.
+    A read with all zero likelihoods at an index (it could not be decoded, or not in the band) is left
+    out there, and an index whose reads rule out every symbol between them gets the prior'''
+    N = probabilities.shape[1]
+    rows = np.arange(N)
+
+    prior = np.zeros((N,4))
+    prior[rows[:,None],(watermark[:,None] + np.arange(4)) % 4] = table[rows % len(table)]
+
+    informative = probabilities.sum(axis=-1) > 0 # (R,N)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        logs = np.where(informative[...,None],np.log(probabilities),0.0).sum(axis=0) - (informative.sum(axis=0)-1)[:,None]*np.log(prior)
+    logs[prior == 0] = -np.inf
+
+    top = logs.max(axis=1,keepdims=True)
+    joint = np.where(np.isfinite(top),np.exp(logs - np.where(np.isfinite(top),top,0.0)),prior)
+
+    return joint / joint.sum(axis=1,keepdims=True)
+
+
+def substitution_channel(table,substitution):
+    '''Sparse distribution (n,4) followed by a substitution to one of the 3 other symbols with probability substitution
+
+    Returns the (n,4) distribution of (recieved - watermark) % 4 on a transmission edge'''
+    noise = np.full(4,substitution/3)
+    noise[0] = 1 - substitution
+    circulant = noise[(np.arange(4)[None,:] - np.arange(4)[:,None]) % 4] # [q,d] probability of d from sparse symbol q
+
+    return table @ circulant
+
+
+def expected_counts(lattice,alphas,betas,gammas,substituted,scales,insertion,deletion,transmission):
+    '''Expected number of edges of every read leaving the T, I and D planes, shape (R,3,4) in the order of OPERATIONS
+
+    gammas are the (R,3,N+1,width) transmission gammas of the edges leaving each plane and substituted is
+    the part of them that comes from a substitution, the rest of the transmission edge counts as a
+    transmission. Reads that can not be decoded (final alpha 0) have no betas and count 0'''
+    N,M = lattice.N,lattice.M
+    R = len(lattice.lengths)
+
+    #Scaling factors c[s+1] and c[s+1]*c[s+2] skipped by the edges leaving each stored node of the rows 0 ... N
+    s = np.clip(np.arange(N+1)[:,None] + lattice.columns(),0,N+M)
+    padded = np.append(scales,np.ones((R,2)),axis=1)
+    one = padded[:,s+1]
+    two = one[:,:N] * padded[:,s[:N]+2]
+
+    counts = np.zeros((R,3,4))
+    planes = alphas.reshape(R,3,-1)
+    rows = planes[:,:,:N*lattice.width] # Alphas of the rows 0 ... N-1
+
+    def posterior(planes,following):
+        '''Sum over the nodes of alpha times the betas and gammas of the edge, per read and plane'''
+        if following.ndim == 4: return (planes * following.reshape(R,3,-1)).sum(axis=-1)
+        return (planes @ following.reshape(R,-1,1))[...,0]
+
+    #Insertion (i,j) --> (i,j+1)
+    counts[:,:,2] = posterior(planes,lattice.shift(betas[:,I],0,1) / one) * insertion
+
+    #Deletion (i,j) --> (i+1,j)
+    counts[:,:,3] = posterior(rows,lattice.shift(betas[:,D],1,0) / one[:,:N]) * deletion
+
+    #Transmission or substitution (i,j) --> (i+1,j+1)
+    following = (lattice.shift(betas[:,T],1,1) / two)[:,None]
+    substitutions = posterior(rows,following * substituted[:,:,:N]) * transmission
+    counts[:,:,0] = posterior(rows,following * gammas[:,:,:N]) * transmission - substitutions
+    counts[:,:,1] = substitutions
+
+    return counts
+
+
+def expectation(batch,tables,substituting,insertion,deletion,transmission,wavefront=None):
+    '''Expectation step of Baum-Welch on a padded batch (lattice, watermarks, reads), see Trellis3D.baum_welch
+
+    tables and substituting hold the (n,4) transmission distribution of the edges leaving the T, I and D
+    planes and the part of it that comes from a substitution. Returns the (3,4) expected counts summed
+    over the reads and their total log likelihood, the reads that can not be decoded are left out of both'''
+    lattice,w,r = batch
+    gammas = np.stack([transmission_gammas(lattice,table,w,r) for table in tables],axis=1)
+    substituted = np.stack([transmission_gammas(lattice,table,w,r) for table in substituting],axis=1)
+
+    alphas,scales,lost = forward(lattice,gammas,insertion,deletion,transmission,wavefront)
+    final = final_alpha(lattice,alphas)
+    betas = backward(lattice,gammas,insertion,deletion,transmission,scales,final,wavefront)
+
+    counts = expected_counts(lattice,alphas,betas,gammas,substituted,scales,insertion,deletion,transmission).sum(axis=0)
+    with np.errstate(divide='ignore'):
+        total = log_likelihood(final,scales,lattice)[final > 0].sum()
+
+    return counts, float(total)
+
+
+def channel_parameters(counts,PI,PD,PS):
+    '''Maximisation step of Baum-Welch, PI, PD and PS from the (3,4) expected counts
+
+    Each depth gets the share of insertions, deletions and substitutions among the edges leaving it,
+    a depth no edge left keeps its old probabilities'''
+    P = np.array([PS,PI,PD],dtype=float)
+    leaving = counts.sum(axis=1)
+    visited = leaving > 0
+
+    P[visited] = counts[visited][:,[2,3,1]] / leaving[visited,None]
+
+    PS,PI,PD = [[float(p) for p in row] for row in P]
+    return PI, PD, PS
+
+
+def diagonal_symbols(lattice,reads,s,tile=None):
+    '''Recieved symbol of every read at the nodes of the anti-diagonal s (or its nodes lo ... hi of tile), -1 where j is outside the read'''
+    lo,hi = lattice.diagonal(s) if tile is None else tile
+    j = s - np.arange(lo,hi+1)
+    valid = (j >= 0) & (j < lattice.lengths[:,None])
+
+    if lattice.M == 0: return np.full(valid.shape,-1,dtype=int)
+
+    return np.where(valid,reads[:,np.clip(j,0,lattice.M-1)],-1)
+
+
+def diagonal_gammas(lattice,table,watermark,reads,s,tile=None):
+    '''transmission_gammas of the nodes of the anti-diagonal s (or its nodes lo ... hi of tile)'''
+    lo,hi = lattice.diagonal(s) if tile is None else tile
+    i = np.arange(lo,hi+1)
+    symbols = diagonal_symbols(lattice,reads,s,tile)
+    symbols[:,i == lattice.N] = -1
+
+    difference = (symbols - np.append(watermark,0)[i]) % 4
+    gammas = table[i % len(table),difference]
+
+    return np.where(symbols >= 0,gammas,0.0)
+
+
+def alpha_diagonal(lattice,s,one,two,table,watermark,reads,insertion,deletion,transmission,scales,wavefront=None):
+    '''Unscaled alphas of the anti-diagonal s, the gammas and insertion masks are built on the fly'''
+    if s == 0: return origin(lattice)
+
+    lo,hi = lattice.diagonal(s)
+    lo1,hi1 = lattice.diagonal(s-1)
+    inserting = (s-1 - np.arange(lo1,hi1+1)) < lattice.lengths[:,None]
+    gammas = diagonal_gammas(lattice,table,watermark,reads,s-2) if s >= 2 else None
+
+    return tiled(wavefront,lo,hi,len(lattice.lengths),lambda a,b : forward_step(lattice,s,one,two,gammas,inserting,insertion,deletion,transmission,scales[:,s-1],(a,b)))
+
+
+def edge_values(lattice,s,alpha,one,two,gammas,scales,deletion,transmission):
+    '''Posterior of the transmission and deletion edges leaving the nodes of the anti-diagonal s, zero outside the lattice'''
+    lo,hi = lattice.diagonal(s)
+    i = np.arange(lo,hi+1)
+    R = len(lattice.lengths)
+
+    def target(betas,plane,t):
+        '''Betas of the nodes (i+1,.) on the anti-diagonal s+t'''
+        values = np.zeros((R,len(i)))
+        if betas is None: return values
+        lo_t,hi_t = lattice.diagonal(s+t)
+        inside = (i+1 >= lo_t) & (i+1 <= hi_t)
+        values[:,inside] = betas[:,plane,i[inside]+1-lo_t]
+        return values
+
+    transmitted = (transmission @ alpha) * gammas * target(two,T,2) / (scales[:,s+1,None] * scales[:,s+2,None])
+    deleted = (deletion @ alpha) * target(one,D,1) / scales[:,s+1,None]
+
+    return i, transmitted, deleted
+
+
+def checkpointed_probabilities(lattice,table,watermark,reads,insertion,deletion,transmission,spacing,wavefront=None,leak=None):
+    '''symbol_probabilities without storing the planes, shape (R,N,4)
+
+    The forward sweep only keeps the alphas of the two anti-diagonals before every spacing-th one.
+    The backward sweep recomputes the alphas of one segment of spacing diagonals at a time from its
+    checkpoint and adds up the edge posteriors as it goes, keeping two diagonals of betas. With
+    spacing ~ sqrt(N+M) this holds O(sqrt(N+M)) diagonals instead of the whole lattice, for about
+    twice the forward work. Also returns the scales, band leak and final alpha like forward and final_alpha'''
+    N,M = lattice.N,lattice.M
+    R = len(lattice.lengths)
+    S = N+M
+
+    scales = np.ones((R,S+1))
+    final = np.zeros(R)
+    checkpoints = {} # s : alphas of the diagonals s-2 and s-1
+
+    two,one = None,None
+    for s in range(S+1):
+        if s % spacing == 0: checkpoints[s] = (two,one)
+
+        alpha = alpha_diagonal(lattice,s,one,two,table,watermark,reads,insertion,deletion,transmission,scales,wavefront)
+        exits = band_exits(lattice,s,one,insertion,deletion) if leak is not None and s >= 1 else []
+
+        total = alpha.sum(axis=(1,2))
+        if s >= 1: scales[total > 0,s] = total[total > 0]
+        alpha /= scales[:,s,None,None]
+        if leak is not None and s >= 1: leak.step(s,exits,scales,alpha.max(axis=(1,2),initial=0))
+
+        lo,hi = lattice.diagonal(s)
+        ending = np.nonzero(N + lattice.lengths == s)[0]
+        if len(ending): final[ending] = alpha[ending,:,N-lo].sum(axis=1)
+
+        two,one = one,alpha
+
+    padded = np.append(scales,np.ones((R,2)),axis=1)
+    probabilities = np.zeros((R,N,4))
+    deleted = np.zeros((R,N))
+    reading = np.arange(R)[:,None]
+
+    two,one = None,None
+    for c in sorted(checkpoints,reverse=True):
+        #Recompute the alphas of the segment from its checkpoint
+        before,previous = checkpoints[c]
+        alphas = []
+        for s in range(c,min(c+spacing,S+1)):
+            alpha = alpha_diagonal(lattice,s,previous,before,table,watermark,reads,insertion,deletion,transmission,scales,wavefront)
+            alphas.append(alpha / scales[:,s,None,None])
+            before,previous = previous,alphas[-1]
+
+        for s in range(min(c+spacing,S+1)-1,c-1,-1):
+            gammas = diagonal_gammas(lattice,table,watermark,reads,s)
+            i,transmitted,deletions = edge_values(lattice,s,alphas[s-c],one,two,gammas,padded,deletion,transmission)
+
+            #Transmission edges vote for the recieved symbol, deletion edges are spread at the end
+            symbols = diagonal_symbols(lattice,reads,s)
+            voting = (symbols >= 0) & (i < N)
+            rows = np.broadcast_to(i,symbols.shape)
+            np.add.at(probabilities,(np.broadcast_to(reading,symbols.shape)[voting],rows[voting],symbols[voting]),transmitted[voting])
+            deleted[:,i[i < N]] += deletions[:,i < N]
+
+            lo,hi = lattice.diagonal(s)
+            beta = tiled(wavefront,lo,hi,R,lambda a,b : backward_step(lattice,s,one,two,gammas,insertion,deletion,transmission,padded,final,(a,b)))
+            two,one = one,beta
+
+    lost = leak.finish(final) if leak is not None else np.zeros(R)
+
+    return spread_deletions(probabilities,deleted,watermark,table), scales, lost, final
+
+
+def viterbi_step(lattice,s,one,two,gammas_two,inserting_one,insertion,deletion,transmission):
+    '''Best log probability of a path to every node of the anti-diagonal s and the plane it came from
+
+    one and two are the best log probabilities of s-1 and s-2, the edge probabilities are logs too'''
+    lo,hi = lattice.diagonal(s)
+    lo1,hi1 = lattice.diagonal(s-1)
+    R = len(lattice.lengths)
+    target = np.full((R,3,hi-lo+1),-np.inf)
+    pointers = np.zeros((R,3,hi-lo+1),dtype=np.int8)
+
+    def best(plane,a,b,candidates):
+        target[:,plane,a-lo:b-lo+1] = candidates.max(axis=1)
+        pointers[:,plane,a-lo:b-lo+1] = candidates.argmax(axis=1)
+
+    #Insertion (i,j-1) --> (i,j)
+    a,b = max(lo,lo1), min(hi,hi1)
+    if a <= b:
+        candidates = one[:,:,a-lo1:b-lo1+1] + insertion[:,None]
+        best(I,a,b,np.where(inserting_one[:,None,a-lo1:b-lo1+1],candidates,-np.inf))
+
+    #Deletion (i-1,j) --> (i,j)
+    a,b = max(lo,lo1+1), min(hi,hi1+1)
+    if a <= b: best(D,a,b,one[:,:,a-1-lo1:b-lo1] + deletion[:,None])
+
+    #Transmission (i-1,j-1) --> (i,j)
+    if two is not None:
+        lo2,hi2 = lattice.diagonal(s-2)
+        a,b = max(lo,lo2+1), min(hi,hi2+1)
+        if a <= b: best(T,a,b,two[:,:,a-1-lo2:b-lo2] + transmission[:,None] + gammas_two[:,None,a-1-lo2:b-lo2])
+
+    return target, pointers
+
+
+def viterbi(lattice,gammas,watermark,reads,insertion,deletion,transmission):
+    '''Most likely edit path of every read, max-product on the anti-diagonals in the log domain
+
+    Only the scores of two anti-diagonals and int8 planes of back pointers are kept. Returns the
+    path of each read as an int8 array of OPERATIONS codes in the order of the read, and its log probability'''
+    N,M = lattice.N,lattice.M
+    R = len(lattice.lengths)
+
+    with np.errstate(divide='ignore'):
+        insertion,deletion,transmission = np.log(insertion),np.log(deletion),np.log(transmission)
+        g = np.log(gammas).reshape(R,-1)
+
+        #Insertions may not run past the end of a shorter read
+        inserting = (lattice.columns() < lattice.lengths[:,None,None]).reshape(R,-1)
+
+        pointers = np.zeros((R,3,lattice.width*(N+1)),dtype=np.int8)
+        two,one = None,np.where(origin(lattice) > 0,0.0,-np.inf)
+        final = np.where(lattice.lengths[:,None] + N == 0,one[:,:,0],-np.inf)
+
+        for s in range(1,N+M+1):
+            lo,hi = lattice.diagonal(s)
+            if lo > hi: continue
+
+            scores,came = viterbi_step(lattice,s,one,two,lattice.cut(g,s-2),lattice.cut(inserting,s-1),insertion,deletion,transmission)
+            pointers[:,:,lattice.cells(s,lo,hi)] = came
+
+            ending = np.nonzero(N + lattice.lengths == s)[0]
+            if len(ending): final[ending] = scores[ending,:,N-lo]
+
+            two,one = one,scores
+
+    #Trace the best plane at every final node back to the start
+    paths = []
+    for b in range(R):
+        i,j,plane = N,lattice.lengths[b],int(final[b].argmax())
+        operations = []
+
+        while i > 0 or j > 0:
+            previous = pointers[b,plane,lattice.index(i,j)]
+
+            if plane == T:
+                i,j = i-1,j-1
+                operations.append(OPERATIONS.index('transmit' if reads[b,j] == watermark[i] else 'substitute'))
+            elif plane == I:
+                j -= 1
+                operations.append(OPERATIONS.index('insert'))
+            else:
+                i -= 1
+                operations.append(OPERATIONS.index('delete'))
+
+            plane = previous
+
+        paths.append(np.array(operations[::-1],dtype=np.int8))
+
+    return paths, final.max(axis=1)
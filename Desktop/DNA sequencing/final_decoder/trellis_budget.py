@@ -0,0 +1,170 @@
+'''Memory and time estimates of the Trellis3D engines, and the policy of engine='auto'
+
+Every mode is modelled as bytes = a + b * stored + c * steps and seconds = a + b * work + c * steps,
+where stored is what the mode keeps in memory (nodes, plane cells, checkpointed diagonals or window
+rows), work is the number of cells it computes and steps the number of Python level iterations
+(anti-diagonals or rows), which also counts what is kept per index or diagonal (scales, likelihoods).
+The constants below were fitted with calibrate() on a single core, rerun it on the machine of the
+sweep and pass the result as constants for better numbers.
+'''
+
+
+import time
+import tracemalloc
+import numpy as np
+
+
+MODES = ['dict','array','checkpoint','window']
+
+CONSTANTS = {
+    'dict' : {'bytes':(0.0,520.0,0.0),'seconds':(0.0,7.7e-6,0.0)},
+    'array' : {'bytes':(2.0e5,131.0,0.0),'seconds':(0.0,0.0,2.9e-4)},
+    'checkpoint' : {'bytes':(1.6e4,18.0,69.0),'seconds':(0.0,0.0,2.7e-4)},
+    'window' : {'bytes':(3.7e4,25.0,121.0),'seconds':(0.0,0.0,1.5e-4)},
+}
+
+
+class Estimate:
+
+
+    def __init__(self,mode,bytes,seconds,**options):
+        self.mode = mode
+        self.bytes = bytes
+        self.seconds = seconds
+        self.options = options # max_drift, checkpoint, lag, block the estimate was made for
+
+    def __repr__(self):
+        options = ' '.join(f'{key}={value}' for key,value in self.options.items() if value is not None)
+        return f'Estimate({self.mode} {options} {self.bytes/2**20:.1f} MB {self.seconds:.3g}s)'
+
+
+def sizes(N,M,mode,max_drift=None,checkpoint=None,reads=1,lag=None,block=None):
+    '''(stored, work, steps) of a mode, see the module docstring'''
+    width = M+1 if max_drift is None else min(M+1,2*max_drift+1)
+    cells = reads*(N+1)*width
+
+    if mode == 'dict':
+        nodes = 3*(N+1)*(M+1)
+        return nodes, nodes, 0
+
+    if mode == 'array':
+        return cells, cells, N+M
+
+    if mode == 'checkpoint':
+        if checkpoint is None or checkpoint is True: checkpoint = max(1,int(np.sqrt(N+M)))
+        diagonal = reads*(min(N,M)+1 if max_drift is None else max_drift+1)
+        return diagonal*(2*((N+M)//checkpoint) + checkpoint), 2*cells, 2*(N+M)
+
+    if mode == 'window':
+        if max_drift is None: raise ValueError('the window mode needs max_drift')
+        if lag is None: lag = 4*max_drift
+        if block is None: block = lag
+        return min(block+lag,N+1)*width, 2*N*width, 2*N
+
+    raise ValueError(f'Unknown mode {mode}, one of {MODES}')
+
+
+def estimate(N,M,mode='array',max_drift=None,checkpoint=None,reads=1,lag=None,block=None,constants=CONSTANTS):
+    '''Estimate of the peak memory above the inputs and of the wall time of one decode'''
+    stored,work,steps = sizes(N,M,mode,max_drift,checkpoint,reads,lag,block)
+    b0,b1,b2 = constants[mode]['bytes']
+    t0,t1,t2 = constants[mode]['seconds']
+
+    return Estimate(mode,b0 + b1*stored + b2*steps,t0 + t1*work + t2*steps,max_drift=max_drift,checkpoint=checkpoint,lag=lag,block=block)
+
+
+def default_drift(N,M):
+    '''Band used when the caller does not know max_drift, the length difference plus a few random walk deviations'''
+    return abs(N-M) + 4*int(np.sqrt(N+M)) + 1
+
+
+def choose(N,M,budget,max_drift=None,reads=1,constants=CONSTANTS):
+    '''Cheapest array engine setting that fits in budget bytes, the default policy of engine='auto'
+
+    Tries the full lattice, the band, the checkpointed band and then the fixed-lag window and returns
+    the first Estimate that fits, its mode and options are what Trellis3D runs'''
+    drift = default_drift(N,M) if max_drift is None else max_drift
+
+    candidates = [estimate(N,M,'array',None,reads=reads,constants=constants)]
+    if drift < max(N,M): candidates.append(estimate(N,M,'array',drift,reads=reads,constants=constants))
+    candidates.append(estimate(N,M,'checkpoint',drift if drift < max(N,M) else None,True,reads=reads,constants=constants))
+    if reads == 1: candidates.append(estimate(N,M,'window',drift,constants=constants))
+
+    if budget is None: return candidates[0]
+
+    for candidate in candidates:
+        if candidate.bytes <= budget: return candidate
+
+    raise ValueError(f'No Trellis mode fits in {budget} bytes for N = {N}, M = {M}, the smallest is {min(candidates,key = lambda c : c.bytes)}')
+
+
+def calibrate(shapes=((200,210),(400,420),(800,830),(1600,1650)),drifts=(40,160),seed=0):
+    '''Fits the constants of every mode by timing and tracing decodes of random sequences of the given (N,M)
+
+    The reads are the watermark with a few substitutions and the length difference made up by random
+    insertions or deletions, and the banded modes run with every band of drifts so the work per cell
+    and per step can be told apart. Returns a dictionary like CONSTANTS, the dict engine is only run
+    on the smallest shape'''
+    from Trellis3D import Trellis3D
+
+    rng = np.random.default_rng(seed)
+    bases = ['A','C','G','T']
+    uniform = {0:{'0':0.25,'1':0.25,'2':0.25,'3':0.25}}
+    PI,PD,PS = [0.5,0.0,0.02],[0.0,0.5,0.02],[0.02,0.02,0.02]
+
+    measured = {mode:[] for mode in MODES}
+
+    for N,M in shapes:
+        codes = rng.integers(0,4,N)
+        read = np.where(rng.random(N) < 0.02,rng.integers(0,4,N),codes)
+        if M > N: read = np.insert(read,np.sort(rng.integers(0,N+1,M-N)),rng.integers(0,4,M-N))
+        else: read = np.delete(read,rng.choice(N,N-M,replace=False))
+        watermark = [bases[q] for q in codes]
+        recieved = [bases[q] for q in read]
+
+        runs = [('array',None,None,lambda t : t.forward_backward(watermark,recieved,PI,PD,PS,engine='array'))]
+        for drift in sorted(set(max(drift,abs(N-M)+1) for drift in drifts)):
+            runs += [('array',drift,None,lambda t,drift=drift : t.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=drift)),
+                     ('checkpoint',drift,True,lambda t,drift=drift : t.forward_backward(watermark,recieved,PI,PD,PS,engine='array',max_drift=drift,checkpoint=True)),
+                     ('window',drift,None,lambda t,drift=drift : list(t.windowed_forward_backward(watermark,recieved,PI,PD,PS,drift)))]
+        if (N,M) == tuple(shapes[0]): runs.append(('dict',None,None,lambda t : t.forward_backward(watermark,recieved,PI,PD,PS)))
+
+        for mode,drift_used,checkpoint,run in runs:
+            #Best of two runs timed without tracemalloc, which slows every allocation down
+            seconds = []
+            for repeat in range(2):
+                start = time.perf_counter()
+                run(Trellis3D(uniform))
+                seconds.append(time.perf_counter() - start)
+            seconds = min(seconds)
+
+            tracing = tracemalloc.is_tracing()
+            if not tracing: tracemalloc.start()
+            trellis = Trellis3D(uniform)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            run(trellis)
+            peak = tracemalloc.get_traced_memory()[1] - base
+            if not tracing: tracemalloc.stop()
+
+            measured[mode].append((sizes(N,M,mode,drift_used,checkpoint),peak,seconds))
+
+    constants = {}
+    for mode,runs in measured.items():
+        stored = np.array([[1.0,s[0],s[2]] for s,peak,seconds in runs])
+        work = np.array([[1.0,s[1],s[2]] for s,peak,seconds in runs])
+        peaks = np.array([peak for s,peak,seconds in runs],dtype=float)
+        seconds = np.array([seconds for s,peak,seconds in runs])
+
+        #Too few runs for an intercept, everything goes in the slopes
+        if len(runs) < 4:
+            stored,work = stored[:,1:],work[:,1:]
+
+        #Relative errors, so the small runs count as much as the large ones
+        b = np.maximum(np.linalg.lstsq(stored/peaks[:,None],np.ones(len(runs)),rcond=None)[0],0)
+        t = np.maximum(np.linalg.lstsq(work/seconds[:,None],np.ones(len(runs)),rcond=None)[0],0)
+        if len(runs) < 4: b,t = np.append(0.0,b),np.append(0.0,t)
+
+        constants[mode] = {'bytes':tuple(float(x) for x in b),'seconds':tuple(float(x) for x in t)}
+
+    return constants
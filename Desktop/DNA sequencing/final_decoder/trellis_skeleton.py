@@ -0,0 +1,136 @@
+'''Topology of the Trellis3D node graph, which only depends on (len(watermark), len(recieved))
+
+The skeletons are kept in a process wide LRU cache so decoding many reads of the same
+lengths only recomputes the edge gammas and the recursions'''
+
+
+import sys
+import numpy as np
+from collections import OrderedDict
+
+
+class Skeleton:
+
+
+    def __init__(self,N,M):
+        self.shape = (N,M)
+        self.nodes = [] # List of nodes as their str values, '(i,j,d)'
+        self.tuples = {} # str node : tuple node
+        self.my_graph = {} # node --> [neighbour]
+        self.reverse_graph = {} # node <-- [neighbour]
+
+        depth = [0,-2,2]  # T , I , D
+
+        for j in range(M+1):
+            for i in range(N+1):
+                for d in depth:
+                    if d == -2 and j == 0: continue
+                    if d == 2 and i == 0: continue
+
+                    if d == 0 and ((j==0 and i!=0) or (i==0 and j!=0)): continue
+
+                    node = str((i,j,d))
+                    self.nodes.append(node)
+                    self.tuples[node] = (i,j,d)
+
+        self.toor = (N+2,M+2,0)
+        self.toor_name = str(self.toor)
+        self.nodes.append(self.toor_name)
+        self.tuples[self.toor_name] = self.toor
+
+        self.my_graph = {node:[] for node in self.nodes}
+        self.reverse_graph = {node:[] for node in self.nodes}
+
+        for node in self.nodes[:-1]:
+            i,j,d = self.tuples[node]
+
+            #Insertion, deletion and transmission neighbours in the order of the edges
+            neighbours = []
+            if j+1 <= M: neighbours.append(str((i,j+1,-2)))
+            if i+1 <= N: neighbours.append(str((i+1,j,2)))
+            if i+1 <= N and j+1 <= M: neighbours.append(str((i+1,j+1,0)))
+
+            for neighbour in neighbours:
+                self.my_graph[node].append(neighbour)
+                self.reverse_graph[neighbour].append(node)
+
+        for d in depth:
+            node = str((N,M,d))
+            if node not in self.tuples: continue
+            self.my_graph[node].append(self.toor_name)
+            self.reverse_graph[self.toor_name].append(node)
+
+        #Every edge goes from anti-diagonal i+j to a later one, so sorting by it is a topological order
+        self.order = sorted(self.nodes[:-1],key = lambda node : sum(self.tuples[node][:2])) + [self.toor_name]
+        self.reverse_order = self.order[::-1]
+
+        #Transmission and deletion edges as arrays of positions in self.nodes, for the likelihoods
+        position = {node:k for k,node in enumerate(self.nodes)}
+        self.planes = np.array([{0:0,-2:1,2:2}[d] for i,j,d in (self.tuples[node] for node in self.nodes)],dtype=int) # T, I, D plane of each node
+
+        transmissions = [(position[node],position[str((i+1,j+1,0))],i,j) for node,(i,j,d) in self.tuples.items() if i < N and j < M]
+        deletions = [(position[node],position[str((i+1,j,2))],i) for node,(i,j,d) in self.tuples.items() if i < N]
+
+        self.transmissions = np.array(transmissions,dtype=int).reshape(-1,4).T # sources, targets, i, j
+        self.deletions = np.array(deletions,dtype=int).reshape(-1,3).T # sources, targets, i
+
+        self.size = self.memory()
+
+    def memory(self):
+        '''Number of bytes held by the skeleton, within a few percent of what tracemalloc sees'''
+        size = sum(sys.getsizeof(x) for x in (self.nodes,self.tuples,self.my_graph,self.reverse_graph,self.order,self.reverse_order))
+        size += sum(sys.getsizeof(node) + sys.getsizeof(self.tuples[node]) for node in self.nodes)
+        size += sum(sys.getsizeof(self.my_graph[node]) + sys.getsizeof(self.reverse_graph[node]) for node in self.nodes)
+        size += sum(sys.getsizeof(neighbour) for node in self.nodes[:-1] for neighbour in self.my_graph[node] if neighbour is not self.toor_name) # Own copies of the neighbour names
+        size += self.planes.nbytes + self.transmissions.nbytes + self.deletions.nbytes
+        return size
+
+
+class SkeletonCache:
+
+
+    def __init__(self,max_bytes=512*2**20):
+        self.max_bytes = max_bytes # Memory budget of all the cached skeletons
+        self.skeletons = OrderedDict() # (N,M) : Skeleton, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,N,M):
+        '''Skeleton of the (N,M) trellis, built and cached on a miss'''
+        key = (N,M)
+
+        if key in self.skeletons:
+            self.hits += 1
+            self.skeletons.move_to_end(key)
+            return self.skeletons[key]
+
+        self.misses += 1
+        skeleton = Skeleton(N,M)
+
+        #A skeleton larger than the whole budget is used once and not kept
+        if skeleton.size <= self.max_bytes:
+            self.skeletons[key] = skeleton
+            self.bytes += skeleton.size
+            self.evict()
+
+        return skeleton
+
+    def evict(self):
+        '''Drops the least recently used skeletons until the cache fits in max_bytes'''
+        while self.bytes > self.max_bytes:
+            key,skeleton = self.skeletons.popitem(last=False)
+            self.bytes -= skeleton.size
+
+    def resize(self,max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        self.skeletons.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+cache = SkeletonCache()
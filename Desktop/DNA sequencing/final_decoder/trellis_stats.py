@@ -0,0 +1,92 @@
+'''Per call timings and sizes of the Trellis3D decoders
+
+Every decode leaves a TrellisStats in Trellis3D.stats with the wall time of each phase, the
+number of nodes and edges, the engine and band/checkpoint/pruning options it ran with and the
+peak memory of the call when tracemalloc is tracing (tracemalloc.start() in the driver).
+The tracemalloc peak belongs to the driver, so it is only reset before every decode with
+trellis_stats.reset_peak = True; otherwise a decode that stays below an earlier peak has no
+peak memory of its own to report.
+as_dict() flattens it to plain values, so the stats can go through a multiprocessing list
+and aggregate() sums and averages them over many decodes.
+'''
+
+
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+reset_peak = False # Reset the tracemalloc peak at the start of every decode, for exact peaks of each call
+
+class TrellisStats:
+
+
+    def __init__(self,engine,N,M,reads=1,**mode):
+        self.engine = engine
+        self.N = N # Length of the watermark (longest one of a batch)
+        self.M = M # Length of the longest read
+        self.reads = reads # Reads or pairs decoded together
+        self.mode = mode # Options of the call, max_drift, checkpoint, beam ...
+        self.phases = {} # Phase : seconds, in the order they ran
+        self.nodes = 0
+        self.edges = 0
+        self.peak_memory = None # Bytes above the memory at the start of the call, while tracemalloc is tracing and the call set a new peak
+        self.seconds = None
+
+        self.start = time.perf_counter()
+        self.base_memory = self.base_peak = None # Traced memory and peak at the start of the call
+        if tracemalloc.is_tracing():
+            if reset_peak: tracemalloc.reset_peak()
+            self.base_memory,self.base_peak = tracemalloc.get_traced_memory()
+
+    @contextmanager
+    def phase(self,name):
+        '''Adds the wall time of the block to the phase, a phase run several times is summed'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name,0.0) + time.perf_counter() - start
+
+    def finish(self,**mode):
+        '''Total wall time and peak memory of the call, mode adds options only known at the end'''
+        self.mode.update(mode)
+        self.seconds = time.perf_counter() - self.start
+        if self.base_memory is not None and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            if peak > self.base_peak or self.base_peak == self.base_memory: self.peak_memory = peak - self.base_memory
+        return self
+
+    def as_dict(self):
+        stats = {'engine':self.engine,'N':self.N,'M':self.M,'reads':self.reads,'nodes':self.nodes,'edges':self.edges,
+                 'peak memory':self.peak_memory,'seconds':self.seconds}
+        stats.update(self.mode)
+        stats.update({f'{name} seconds':seconds for name,seconds in self.phases.items()})
+        return stats
+
+    def __repr__(self):
+        phases = ', '.join(f'{name} {seconds:.3g}s' for name,seconds in self.phases.items())
+        return f'TrellisStats({self.engine} N={self.N} M={self.M} nodes={self.nodes} edges={self.edges} {self.seconds:.3g}s: {phases})'
+
+
+def aggregate(stats):
+    '''Sums and means of the numeric values of many TrellisStats (or their as_dict()), keys 'total <key>' and 'mean <key>'
+
+    Also counts the calls of each engine, e.g. 'engine array' : 12'''
+    stats = [s.as_dict() if isinstance(s,TrellisStats) else s for s in stats]
+    summary = {'calls':len(stats)}
+
+    for s in stats:
+        key = f"engine {s['engine']}"
+        summary[key] = summary.get(key,0) + 1
+
+    keys = []
+    for s in stats:
+        keys += [key for key,value in s.items() if key not in keys and isinstance(value,(int,float)) and not isinstance(value,bool)]
+
+    for key in keys:
+        values = [s[key] for s in stats if isinstance(s.get(key),(int,float)) and not isinstance(s.get(key),bool)]
+        summary[f'total {key}'] = sum(values)
+        summary[f'mean {key}'] = sum(values)/len(values)
+
+    return summary
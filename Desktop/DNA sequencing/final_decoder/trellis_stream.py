@@ -0,0 +1,158 @@
+'''Forward-backward of a watermark against a read that is still being sequenced
+
+Column j of the lattice holds the nodes (0,j) ... (N,j), the nodes reached once j recieved symbols
+have been read. Every new symbol only adds one column of alphas, each column divided by its own
+sum c[j]. The betas are only computed when the likelihoods are asked for. The last column is the
+end of what has been read, and all its continuations have total probability 1. The transmissions
+out of it (to symbols that have not been read yet) and its deletions are spread over the sparse
+distribution like the deletions everywhere else. Once the read is complete the betas start from the
+final node instead, which gives the same likelihoods as the other engines.
+'''
+
+
+import numpy as np
+from functools import lru_cache
+from trellis_arrays import T, I, D
+
+
+@lru_cache(maxsize=32)
+def triangular(a,n):
+    '''(n,n) lower triangular matrix of a**(row - column), cached as every row of a lattice needs the same ones'''
+    powers = np.subtract.outer(np.arange(n),np.arange(n))
+    return np.where(powers >= 0,float(a)**np.maximum(powers,0),0.0)
+
+
+def linear_runs(a,c,block=None):
+    '''x[k] = a*x[k-1] + c[k] along the last axis, exactly
+
+    c is cut in blocks (~sqrt(n) by default) solved together by one triangular matrix, the ends of
+    the blocks are then carried into the following blocks by a second one, so there is no Python loop over k'''
+    n = c.shape[-1]
+    block = block or max(1,int(np.ceil(np.sqrt(n))))
+    blocks = -(-n//block)
+
+    padded = np.zeros(c.shape[:-1] + (blocks*block,))
+    padded[...,:n] = c
+    x = padded.reshape(c.shape[:-1] + (blocks,block)) @ triangular(a,block).T
+
+    #Block b starts from every earlier block end decayed by a**block
+    ends = x[...,-1] @ triangular(float(a)**block,blocks).T
+    x[...,1:,:] += float(a)**np.arange(1,block+1) * ends[...,:-1,None]
+
+    return x.reshape(c.shape[:-1] + (blocks*block,))[...,:n]
+
+
+class Stream:
+
+
+    def __init__(self,watermark,table,insertion,deletion,transmission):
+        self.watermark = watermark
+        self.table = table
+        self.N = len(watermark)
+        self.insertion = insertion
+        self.deletion = deletion
+        self.transmission = transmission
+
+        self.read = [] # Recieved symbols so far
+        self.alphas = [] # Column j : (3,N+1) alphas divided by c[0] ... c[j]
+        self.scales = [] # c[j] of every column
+        self.betas = None # Columns of betas, None until they are asked for after the read grew
+        self.complete = None # Whether self.betas start from the final node or from the whole last column
+
+        column = np.zeros((3,self.N+1))
+        column[T,0] = 1.0
+        column[D] = self.deletions(column)
+        self.add(column)
+
+    def gammas(self,j):
+        '''Sparse distribution part of the transmission edges (i,j) --> (i+1,j+1), i = 0 ... N-1'''
+        i = np.arange(self.N)
+        return self.table[i % len(self.table),(self.read[j] - self.watermark) % 4]
+
+    def deletions(self,column):
+        '''D plane of a column from its T and I planes, deletion runs (i-1,j) --> (i,j) down the column'''
+        entering = np.zeros(self.N+1)
+        entering[1:] = self.deletion[T]*column[T,:-1] + self.deletion[I]*column[I,:-1]
+        return linear_runs(self.deletion[D],entering)
+
+    def add(self,column):
+        total = column.sum()
+        self.scales.append(total)
+        self.alphas.append(column / total)
+
+    def extend(self,symbols):
+        '''Reads more recieved symbols, one new column of alphas each'''
+        for symbol in symbols:
+            self.read.append(symbol)
+            j = len(self.read)
+            previous = self.alphas[-1]
+
+            column = np.zeros((3,self.N+1))
+            #Insertion (i,j-1) --> (i,j)
+            column[I] = self.insertion @ previous
+            #Transmission (i-1,j-1) --> (i,j)
+            column[T,1:] = (self.transmission @ previous[:,:-1]) * self.gammas(j-1)
+            column[D] = self.deletions(column)
+
+            self.add(column)
+
+        if len(symbols): self.betas = None
+
+    def column_betas(self,outside):
+        '''Betas of a column from the part of them that leaves it, adds the deletion runs (i,j) --> (i+1,j) up the column'''
+        deleting = np.zeros(self.N+1)
+        deleting[:-1] = linear_runs(self.deletion[D],outside[D,::-1])[::-1][1:]
+        return outside + self.deletion[:,None]*deleting
+
+    def backward(self,complete):
+        '''Betas of every column scaled like the alphas
+
+        The last column is 1 everywhere while the read is still growing, complete starts from the final node'''
+        M = len(self.read)
+        self.complete = complete
+        self.betas = [None]*(M+1)
+
+        if complete:
+            final = np.zeros((3,self.N+1))
+            final[:,self.N] = 1.0
+            self.betas[M] = self.column_betas(final)
+        else:
+            self.betas[M] = np.ones((3,self.N+1))
+
+        for j in range(M-1,-1,-1):
+            following = self.betas[j+1] / self.scales[j+1]
+
+            #Insertion (i,j) --> (i,j+1) and transmission (i,j) --> (i+1,j+1) leave the column
+            leaving = np.zeros((2,self.N+1))
+            leaving[0] = following[I]
+            leaving[1,:-1] = following[T,1:] * self.gammas(j)
+            outside = self.insertion[:,None]*leaving[0] + self.transmission[:,None]*leaving[1]
+
+            self.betas[j] = self.column_betas(outside)
+
+    def probabilities(self,complete=False):
+        '''Normalised A,C,G,T likelihoods of every transmitted symbol given the read so far, shape (N,4)'''
+        if self.betas is None or self.complete != complete: self.backward(complete)
+        M = len(self.read)
+        N = self.N
+
+        probabilities = np.zeros((N,4))
+        deleted = np.zeros(N)
+        rows = np.arange(N)
+
+        for j in range(M+1):
+            alpha,beta = self.alphas[j],self.betas[j]
+
+            #Deletion (i,j) --> (i+1,j)
+            deleted += (self.deletion @ alpha[:,:-1]) * beta[D,1:]
+
+            #Transmission (i,j) --> (i+1,j+1) votes for the recieved symbol, or is spread once it leaves the read
+            if j < M:
+                values = (self.transmission @ alpha[:,:-1]) * self.gammas(j) * self.betas[j+1][T,1:] / self.scales[j+1]
+                probabilities[rows,self.read[j]] += values
+            elif not complete:
+                deleted += self.transmission @ alpha[:,:-1]
+
+        probabilities[rows[:,None],(self.watermark[:,None] + np.arange(4)) % 4] += deleted[:,None] * self.table[rows % len(self.table)]
+
+        return probabilities / probabilities.sum(axis=1,keepdims=True)
@@ -0,0 +1,154 @@
+'''Fixed-lag forward-backward for very long reads
+
+Row i of the banded lattice holds the nodes (i, i-W) ... (i, i+W). The forward pass runs one row
+at a time and only keeps the alphas of the rows that have not been emitted yet. Once it is lag
+rows past the end of the current block, a backward pass starts from there with flat betas,
+and the likelihoods of the block are emitted. The state is O((block + lag) * band) whatever the
+length of the read. The rows closest to the end of the read are exact because the last backward
+pass starts from the final node.
+
+The likelihood of index i only uses the alphas of row i and the betas of row i+1, so every row is
+divided by its own sum and the scaling factors cancel when the likelihoods are normalised.
+'''
+
+
+import numpy as np
+from trellis_arrays import T, I, D, Lattice
+from trellis_stream import linear_runs
+
+
+class Window:
+    '''Rows of the banded lattice of one watermark and one read'''
+
+    def __init__(self,watermark,read,table,max_drift):
+        self.watermark = watermark
+        self.read = read
+        self.table = table
+        self.N = len(watermark)
+        self.M = len(read)
+        self.W = max_drift
+        self.width = Lattice(self.N,self.M,max_drift).width
+
+    def columns(self,i):
+        '''Recieved index j of every column of row i'''
+        return i + np.arange(self.width) - self.W
+
+    def valid(self,i):
+        j = self.columns(i)
+        return (j >= 0) & (j <= self.M)
+
+    def gammas(self,i):
+        '''Sparse distribution part of the transmission edges (i,j) --> (i+1,j+1) of row i'''
+        j = self.columns(i)
+        if i >= self.N or self.M == 0: return np.zeros(self.width)
+
+        inside = (j >= 0) & (j < self.M)
+        difference = (self.read[np.clip(j,0,self.M-1)] - self.watermark[i]) % 4
+        return np.where(inside,self.table[i % len(self.table),difference],0.0)
+
+    def symbols(self,i):
+        '''Recieved symbol of every column of row i, -1 outside the read'''
+        j = self.columns(i)
+        if self.M == 0: return np.full(self.width,-1)
+        return np.where((j >= 0) & (j < self.M),self.read[np.clip(j,0,self.M-1)],-1)
+
+
+def forward_row(window,i,previous,insertion,deletion,transmission):
+    '''Alphas of row i from the alphas of row i-1 (None for the first row), divided by their sum'''
+    alpha = np.zeros((3,window.width))
+
+    if previous is None:
+        alpha[T,window.W] = 1.0
+    else:
+        #Deletion (i-1,j) --> (i,j) is one column to the right in row i-1
+        alpha[D,:-1] = (deletion @ previous)[1:]
+        #Transmission (i-1,j-1) --> (i,j) is the same column in row i-1
+        alpha[T] = (transmission @ previous) * window.gammas(i-1)
+
+    #Insertion (i,j-1) --> (i,j) along the row
+    leaving = insertion[T]*alpha[T] + insertion[D]*alpha[D]
+    alpha[I,1:] = linear_runs(insertion[I],leaving[:-1])
+    alpha[:,~window.valid(i)] = 0
+    alpha[I,window.columns(i) == 0] = 0
+
+    return alpha / alpha.sum()
+
+
+def backward_row(window,i,following,seed,insertion,deletion,transmission):
+    '''Betas of row i from the betas of row i+1 (None for the last row), divided by their sum
+
+    seed is added to the betas of every node of the row, the final node leads to the toor with gamma 1'''
+    beta_d = np.zeros(window.width)
+    beta_t = np.zeros(window.width)
+
+    if following is not None:
+        #Deletion (i,j) --> (i+1,j) is one column to the left in row i+1
+        beta_d[1:] = following[D,:-1]
+        #Transmission (i,j) --> (i+1,j+1) is the same column in row i+1
+        beta_t = following[T] * window.gammas(i)
+
+    #Insertion (i,j) --> (i,j+1) along the row, the runs to the right are summed from the end of the row
+    entering = deletion[I]*beta_d + transmission[I]*beta_t + seed
+    inserted = np.zeros(window.width)
+    inserted[:-1] = linear_runs(insertion[I],entering[::-1])[::-1][1:]
+    inserted[window.columns(i)+1 > window.M] = 0
+
+    beta = deletion[:,None]*beta_d + transmission[:,None]*beta_t + insertion[:,None]*inserted + seed
+    beta[:,~window.valid(i)] = 0
+
+    return beta / beta.sum()
+
+
+def row_probabilities(window,i,alpha,following,deletion,transmission):
+    '''Normalised A,C,G,T likelihoods of the transmitted symbol i from the alphas of row i and the betas of row i+1'''
+    probabilities = np.zeros(4)
+
+    values = (transmission @ alpha) * window.gammas(i) * following[T]
+    symbols = window.symbols(i)
+    for q in range(4):
+        probabilities[q] += values[symbols == q].sum()
+
+    deleted = ((deletion @ alpha)[1:] * following[D,:-1]).sum()
+    probabilities[(window.watermark[i] + np.arange(4)) % 4] += deleted * window.table[i % len(window.table)]
+
+    return probabilities / probabilities.sum()
+
+
+def fixed_lag(watermark,read,table,insertion,deletion,transmission,max_drift,lag,block):
+    '''Yields (i, likelihoods of the transmitted symbol i in the A,C,G,T order) for i = 0 ... N-1 in order
+
+    The likelihoods of a block of rows are emitted once the forward pass is lag rows past it'''
+    window = Window(watermark,read,table,max_drift)
+    N = window.N
+
+    seed = np.zeros(window.width)
+    seed[window.columns(N) == window.M] = 1.0
+
+    alphas = {} # Row : alphas, only the rows from start onwards are kept
+    start = 0
+    previous = None
+
+    for i in range(N+1):
+        alphas[i] = previous = forward_row(window,i,previous,insertion,deletion,transmission)
+
+        if i < N and i - start < block + lag: continue
+
+        #Exact betas from the final node, flat betas lag rows past the block otherwise
+        if i == N:
+            end = N
+            following = backward_row(window,N,None,seed,insertion,deletion,transmission)
+        else:
+            end = start + block
+            following = window.valid(i) * np.ones((3,1))
+            following = following / following.sum()
+
+        emitted = []
+        for row in range(i-1,start-1,-1):
+            if row < end: emitted.append((row,row_probabilities(window,row,alphas[row],following,deletion,transmission)))
+            following = backward_row(window,row,following,0.0,insertion,deletion,transmission)
+
+        for row,probabilities in reversed(emitted):
+            yield row,probabilities
+            del alphas[row]
+
+        start = end
@@ -0,0 +1,47 @@
+'''Iterative (turbo) decoding of Trellis3D --> Sparsifier.decoder --> LDPC
+
+After each LDPC decode the extrinsic loglikelihoods of the codeword bits (app minus the
+channel loglikelihoods that went in) are converted into priors of the sparse symbols at every
+index, which replace the sparse distribution in the next Trellis pass. Only the gammas and
+the recursions of the array engine are rerun, the Trellis3D, its table and the LDPC code are
+built once. The priors are divided out of the Trellis likelihoods before they go back to the
+Sparsifier decoder so the LDPC decoder does not get its own information back.
+'''
+
+
+import numpy as np
+
+
+def turbo_decode(trellis,sparsifier,code,watermark,recieved,PI,PD,PS,k,n,iterations=5,max_drift=None,max_llr=20.0):
+    '''Decodes recieved into codeword loglikelihoods log(p0/p1), stops early once all the parity checks hold
+
+    Returns (app, number of Trellis/LDPC iterations run), with iterations = 1 it is the same
+    as running Trellis3D.forward_backward, Sparsifier.decoder and code.decode once'''
+
+    checks = code.pcmat()
+
+    w = trellis.symbols(watermark)
+    rows = np.arange(len(w))[:,None]
+    sparse = (np.arange(4)[None,:] - w[:,None]) % 4 # Sparse symbol behind each transmitted A,C,G,T
+
+    base = trellis.table[np.arange(len(w)) % len(trellis.table)] # Sparse distribution of each index
+    priors = base
+
+    for iteration in range(1,iterations+1):
+        probabilities = trellis.array_reads(watermark,[recieved],PI,PD,PS,max_drift,priors=priors)[0]
+
+        #Swap the LDPC priors for the sparse distribution again, symbols the table gives 0 stay 0
+        given = priors[rows,sparse]
+        extrinsic = np.divide(probabilities * base[rows,sparse],given,out=np.zeros_like(probabilities),where=given > 0)
+        extrinsic /= extrinsic.sum(axis=1,keepdims=True)
+
+        channel = sparsifier.decoder(extrinsic,watermark,k,n)
+        app,it = code.decode(channel)
+
+        if np.isfinite(app).all() and not ((checks @ (app < 0)) % 2).any(): break
+
+        #Bits the decoders are both certain of give inf - inf, they carry no new information
+        llrs = np.clip(np.nan_to_num(app - channel,nan=0.0),-max_llr,max_llr)
+        priors = sparsifier.symbol_priors(llrs,k,n)
+
+    return app, iteration
@@ -0,0 +1,58 @@
+import pytest
+import os
+import importlib.util
+import numpy as np
+import trellis
+
+
+def dna_trellis():
+    '''DNA/Trellis.py, the copy of trellis.py the DNA folder imports as Trellis'''
+    spec = importlib.util.spec_from_file_location('dna_trellis',os.path.join(os.path.dirname(os.path.abspath(__file__)),'DNA','Trellis.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def pair(n,bases,seed,errors=0.15):
+    '''Random transmitted string and a read of it with a few substitutions, insertions and deletions'''
+    rng = np.random.default_rng(seed)
+    transmitted = ''.join(rng.choice(list(bases),n))
+    recieved = []
+    for symbol in transmitted:
+        event = rng.choice(4,p=[1-errors,errors/3,errors/3,errors/3])
+        if event == 0: recieved.append(symbol)
+        elif event == 1: recieved.append(rng.choice([b for b in bases if b != symbol]))
+        elif event == 2: recieved += [rng.choice(list(bases)),symbol]
+    return transmitted, ''.join(recieved)
+
+
+@pytest.mark.parametrize("module", [trellis,dna_trellis()])
+@pytest.mark.parametrize("n,Pi,Pd,Ps,bases", [(5,0.1,0.1,0.2,'ACGT'),(60,0.02,0.02,0.1,'01'),(80,0.05,0.05,0.1,'ACGT'),(40,0.1,0.0,0.2,'ACGT'),(100,0.008,0.008,0.2,'01')])
+def test_array_engine_matches_dict(module,n,Pi,Pd,Ps,bases):
+    transmitted,recieved = pair(n,bases,n)
+    T = module.Trellis()
+    transitions = T.forward_backward(transmitted,recieved,Pi=Pi,Pd=Pd,Ps=Ps)
+    expected = np.array([transitions[i] for i in range(n)])
+
+    assert np.allclose(T.forward_backward(transmitted,recieved,Pi=Pi,Pd=Pd,Ps=Ps,engine='array'),expected,rtol=0,atol=1e-13)
+    with pytest.raises(ValueError): T.forward_backward(transmitted,recieved,engine='rows')
+
+
+@pytest.mark.parametrize("module", [trellis,dna_trellis()])
+def test_array_engine_equal_transmission_and_substitution(module):
+    #Pt rounds to 0.4 == Ps, the dict engine files every diagonal edge as a transmission
+    transmitted,recieved = pair(30,'ACGT',1)
+    T = module.Trellis()
+    T.forward_backward(transmitted,recieved,Pi=0.1,Pd=0.1,Ps=0.4)
+    assert all(p == (1.0,0.0) for p in T.transitions.values())
+
+    #Its edge values split by whether the symbols match
+    split = np.zeros((len(transmitted),2))
+    for (node,neighbour),value in T.values.items():
+        (i,j),(k,l) = T.tuples[node],T.tuples[neighbour]
+        if k == i+1 and l == j+1: split[i,int(transmitted[i] != recieved[j])] += value
+    split /= split.sum(axis=1,keepdims=True)
+
+    transitions = T.forward_backward(transmitted,recieved,Pi=0.1,Pd=0.1,Ps=0.4,engine='array')
+    assert np.allclose(transitions,split,rtol=0,atol=1e-13)
+    assert 0 < transitions[:,1].min() and transitions[:,1].max() < 1